@@ -5,13 +5,22 @@ from .annotations import (
     lstudio_label_mapping_to_dict,
     update_df_review_labels,
 )
+from .batching import LengthBucketBatchSampler, pad_collate
+from .corpus import iter_corpus_batches, iter_reviews, load_corpus, reservoir_sample
+from .gru_classifier import GRUClassifier, GRUPredictor
 from .ollama_topic_classification import Model, OllamaClassifier, Topic
 from .review_dataloader import SteamReviewDataset_old
+from .sparse_ffn import SparseBatches, SparseFFN, fit_vectorizer
 from .steam_review_dataset import SteamReviewDataset
-from .multilabel_classification_evaluator import MultiLabelEvaluator
+from .token_store import TokenStore
+from .multilabel_classification_evaluator import (
+    IncrementalEvaluator,
+    MultiLabelEvaluator,
+)
 
 __all__ = [
     "MultiLabelEvaluator",
+    "IncrementalEvaluator",
     "get_one_hot_labels_df_",
     "lstudio_label_mapping_to_dict",
     "update_df_review_labels",
@@ -20,4 +29,16 @@ __all__ = [
     "Topic",
     "SteamReviewDataset_old",
     "SteamReviewDataset",
+    "TokenStore",
+    "LengthBucketBatchSampler",
+    "pad_collate",
+    "load_corpus",
+    "iter_corpus_batches",
+    "iter_reviews",
+    "reservoir_sample",
+    "GRUClassifier",
+    "GRUPredictor",
+    "SparseBatches",
+    "SparseFFN",
+    "fit_vectorizer",
 ]
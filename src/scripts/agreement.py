@@ -0,0 +1,230 @@
+"""agreement between the results of several classification runs
+
+Model vs. model agreement is a cheap proxy for the label quality on reviews
+without annotations. `align` lays N result files out on one review x topic
+grid by review id, with an explicit mask of which file has an answer for which
+review. All pairwise numbers (exact match, label agreement, per topic Cohen's
+kappa) come from a few einsums over that grid, Krippendorff's alpha from the
+per review label counts; nothing loops over reviews.
+
+Missing reviews are handled by the `missing` policy of `align`:
+    pairwise: every pair of files is compared on the reviews both have answers for
+    common: only reviews every file has answers for are kept
+    empty: a missing review counts as an answer without topics
+
+Usage:
+    results = [load_results(f) for f in files]
+    aligned = align(results)
+    print(pairwise_exact_match(aligned))
+    print(krippendorff_alpha(aligned))
+"""
+
+import json
+import warnings
+from collections.abc import Iterable, Mapping, Sequence
+from typing import Literal
+
+import numpy as np
+import pandas as pd
+
+from multilabel_classification_evaluator import binarize
+
+Missing = Literal["pairwise", "common", "empty"]
+
+
+class AlignedResults:
+    """Results of several runs on one review x topic grid
+
+    Attributes:
+        names: name of every run
+        review_ids: ids of the rows
+        categories: topics of the columns
+        labels: (runs, reviews, topics) bool array of the found topics
+        present: (runs, reviews) bool array, whether a run has an answer for a review
+    """
+
+    def __init__(
+        self,
+        names: list[str],
+        review_ids: pd.Index,
+        categories: pd.Index,
+        labels: np.ndarray,
+        present: np.ndarray,
+    ) -> None:
+        self.names = names
+        self.review_ids = review_ids
+        self.categories = categories
+        self.labels = labels
+        self.present = present
+
+    def missing(self) -> pd.Series:
+        """Number of reviews every run has no answer for"""
+        return pd.Series((~self.present).sum(axis=1), index=self.names, name="missing")
+
+
+def load_results(path: str) -> dict[int, list[str]]:
+    with open(path, "r", encoding="utf-8") as f:
+        return {int(k): v for k, v in json.load(f).items()}
+
+
+def align(
+    results: Sequence[Mapping[int, Iterable[str]]],
+    names: Sequence[str] | None = None,
+    categories: Iterable[str] | None = None,
+    missing: Missing = "pairwise",
+) -> AlignedResults:
+    """Lays the results of several runs out on one grid, aligned by review id
+
+    Args:
+        results: mapping of review id to topics per run
+        names: name per run [default] run0, run1, ...
+        categories: topics of the columns [default] every topic of the results,
+            topics outside of the given ones are ignored
+        missing: how reviews without an answer of some run are handled, see module docs
+    """
+    if missing not in ("pairwise", "common", "empty"):
+        raise ValueError(f"unknown missing policy '{missing}'")
+    names = (
+        list(names) if names is not None else [f"run{i}" for i in range(len(results))]
+    )
+    if len(names) != len(results):
+        raise ValueError("one name per result is needed")
+
+    if categories is None:
+        categories = {c for res in results for topics in res.values() for c in topics}
+    else:
+        categories = set(categories)
+        results = [
+            {id: [c for c in topics if c in categories] for id, topics in res.items()}
+            for res in results
+        ]
+    category_index = pd.Index(sorted(categories))
+    review_index = pd.Index(sorted(set().union(*results)))
+
+    labels = np.stack([binarize(res, review_index, category_index) for res in results])
+    present = np.stack([review_index.isin(list(res.keys())) for res in results])
+    if missing == "common":
+        keep = present.all(axis=0)
+        review_index = review_index[keep]
+        labels = labels[:, keep]
+        present = present[:, keep]
+    elif missing == "empty":
+        present = np.ones_like(present)
+    return AlignedResults(names, review_index, category_index, labels, present)
+
+
+def _pair_counts(aligned: AlignedResults) -> tuple[np.ndarray, ...]:
+    """Per topic contingency counts of every pair of runs on the reviews both answered
+
+    Returns:
+        (runs, runs) reviews per pair and (runs, runs, topics) counts of
+        both 1, both 0, only the first run 1 and only the second run 1
+    """
+    presence = aligned.present.astype(np.float64)
+    masked = aligned.labels * presence[:, :, None]
+    n = presence @ presence.T
+    both = np.einsum("rnc,snc->rsc", masked, masked)
+    first = np.einsum("rnc,sn->rsc", masked, presence)
+    second = first.transpose(1, 0, 2)
+    neither = n[:, :, None] - first - second + both
+    return n, both, neither, first - both, second - both
+
+
+def pairwise_exact_match(aligned: AlignedResults) -> pd.DataFrame:
+    """Share of the reviews both runs answered with exactly the same topics"""
+    presence = aligned.present
+    codes = np.packbits(aligned.labels, axis=2)
+    same = (codes[:, None] == codes[None, :]).all(axis=3)
+    both = presence[:, None] & presence[None, :]
+    n = both.sum(axis=2)
+    matches = (same & both).sum(axis=2)
+    res = np.divide(matches, n, out=np.full(n.shape, np.nan), where=n != 0)
+    return pd.DataFrame(res, index=aligned.names, columns=aligned.names)
+
+
+def pairwise_label_agreement(aligned: AlignedResults) -> pd.DataFrame:
+    """Share of the (review, topic) decisions both runs agree on (1 - hamming loss)"""
+    n, both, neither, _, _ = _pair_counts(aligned)
+    cells = n * len(aligned.categories)
+    agree = (both + neither).sum(axis=2)
+    res = np.divide(agree, cells, out=np.full(cells.shape, np.nan), where=cells != 0)
+    return pd.DataFrame(res, index=aligned.names, columns=aligned.names)
+
+
+def cohen_kappa(aligned: AlignedResults) -> np.ndarray:
+    """Cohen's kappa of every pair of runs per topic
+
+    Returns:
+        (runs, runs, topics) array, nan where a topic is never or always found by
+        both runs of a pair (kappa is undefined there)
+    """
+    n, both, neither, only_first, only_second = _pair_counts(aligned)
+    n = n[:, :, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        observed = (both + neither) / n
+        first_rate = (both + only_first) / n
+        second_rate = (both + only_second) / n
+        expected = first_rate * second_rate + (1 - first_rate) * (1 - second_rate)
+        kappa = (observed - expected) / (1 - expected)
+    kappa[~np.isfinite(kappa)] = np.nan
+    return kappa
+
+
+def pairwise_kappa(aligned: AlignedResults) -> pd.DataFrame:
+    """Mean Cohen's kappa over the topics of every pair of runs"""
+    kappa = cohen_kappa(aligned)
+    with warnings.catch_warnings():
+        # pairs without any defined kappa stay nan
+        warnings.simplefilter("ignore", RuntimeWarning)
+        res = np.nanmean(kappa, axis=2)
+    return pd.DataFrame(res, index=aligned.names, columns=aligned.names)
+
+
+def topic_kappa(aligned: AlignedResults) -> pd.DataFrame:
+    """Cohen's kappa per topic of every pair of runs, one row per pair"""
+    kappa = cohen_kappa(aligned)
+    first, second = np.triu_indices(len(aligned.names), k=1)
+    index = [f"{aligned.names[i]} vs {aligned.names[j]}" for i, j in zip(first, second)]
+    return pd.DataFrame(kappa[first, second], index=index, columns=aligned.categories)
+
+
+def krippendorff_alpha(aligned: AlignedResults) -> pd.Series:
+    """Krippendorff's alpha (nominal) of all runs per topic and over all topics
+
+    Every review is a unit coded by the runs that answered it, units with less
+    than two answers are not pairable and left out.
+    """
+    presence = aligned.present
+    coders = presence.sum(axis=0)
+    pairable = coders >= 2
+    ones = (aligned.labels & presence[:, :, None]).sum(axis=0)[pairable]
+    coders = coders[pairable][:, None]
+    zeros = coders - ones
+
+    # disagreeing pairs per unit, weighted with 1 / (coders - 1)
+    disagreement = ones * zeros / (coders - 1)
+    res = {}
+    for name, d, n1, n0 in (
+        ("all topics", disagreement.sum(), ones.sum(), zeros.sum()),
+        *zip(
+            aligned.categories,
+            disagreement.sum(axis=0),
+            ones.sum(axis=0),
+            zeros.sum(axis=0),
+        ),
+    ):
+        n = n1 + n0
+        res[name] = 1 - (n - 1) * d / (n1 * n0) if n1 * n0 else np.nan
+    return pd.Series(res, name="krippendorff alpha", dtype=np.float64)
+
+
+def agreement_report(aligned: AlignedResults) -> dict[str, pd.DataFrame | pd.Series]:
+    """All agreement tables of the runs"""
+    return {
+        "missing": aligned.missing(),
+        "exact match": pairwise_exact_match(aligned),
+        "label agreement": pairwise_label_agreement(aligned),
+        "mean kappa": pairwise_kappa(aligned),
+        "topic kappa": topic_kappa(aligned),
+        "krippendorff alpha": krippendorff_alpha(aligned),
+    }
@@ -1,5 +1,6 @@
 import json
 import sys
+from itertools import chain
 
 import numpy as np
 import pandas as pd
@@ -32,45 +33,72 @@ def lstudio_label_mapping_to_dict(json_path: str) -> dict[int, list[str]]:
 def update_df_review_labels(
     df: pd.DataFrame, labels: dict, mode: str = "dummy", dropna: bool = False
 ) -> tuple[pd.DataFrame, list[str]]:
-    """updates dataset dataframe by left joining the one hot encoded annotation label columns (uncovered will be NaN)"""
+    """updates dataset dataframe by left joining the annotation labels (uncovered will be NaN)
 
-    if mode == "dummy":
-        dummy_cols, all_labels = get_one_hot_labels_df_(labels)
-        dummy_cols.reset_index(names="review_id", inplace=True)
-
-        # join review df with encoded labels
-        dummified_df = pd.merge(df, dummy_cols, on="review_id", how="left")
-        if dropna:
-            dummified_df.dropna(
-                inplace=True,
-                ignore_index=True,
-                how="all",
-                subset=all_labels,
-            )
-        return dummified_df, list(all_labels)
+    mode "dummy" adds one one hot encoded column per label, mode "strlist" adds a
+    single `labels` column holding the list of labels of every review. The join
+    aligns `df["review_id"]` on a hash index of the label keys instead of a full
+    merge, the order and the rows of `df` are kept (index is reset like a merge).
+    """
+
+    keys, all_labels, one_hot = _encode_one_hot(labels)
+    # position of every review of df in labels, -1 if it is not annotated
+    positions = keys.get_indexer(df["review_id"])
+    covered = positions >= 0
 
+    if mode == "dummy":
+        if covered.all():
+            values = one_hot[positions]
+        else:
+            values = np.full((len(df), len(all_labels)), np.nan)
+            values[covered] = one_hot[positions[covered]]
+        label_df = pd.DataFrame(values, columns=all_labels)
     elif mode == "strlist":
-        NotImplementedError("TODO")
+        label_lists = np.empty(len(keys), dtype=object)
+        label_lists[:] = list(labels.values())
+        values = np.full(len(df), np.nan, dtype=object)
+        values[covered] = label_lists[positions[covered]]
+        label_df = pd.DataFrame({"labels": values})
     else:
         raise ValueError(f"Unknown mode '{mode}'")
 
+    # join review df with encoded labels
+    joined_df = pd.concat([df.reset_index(drop=True), label_df], axis=1)
+    if dropna:
+        joined_df = joined_df[covered].reset_index(drop=True)
+    return joined_df, all_labels
+
 
 def get_one_hot_labels_df_(labels: dict) -> tuple[pd.DataFrame, set[str]]:
     """builds dataframe from dict containing labels (values) per id (key) by one hot encoding them into columns"""
     # see https://discuss.pytorch.org/t/multi-label-classification-in-pytorch/905/44
 
-    # get unique labels
-    all_labels = set(
-        [l for label in labels.values() for l in label]
-    )  # flatten list of all unique labels
-
-    # for each label, create a hot one encoded column
-    dummy_cols = pd.DataFrame(
-        {
-            label: [1 if label in labels[key] else 0 for key in labels]
-            for label in all_labels
-        },
-        index=labels.keys(),
-    )
-
-    return dummy_cols, all_labels
+    keys, all_labels, one_hot = _encode_one_hot(labels)
+    dummy_cols = pd.DataFrame(one_hot, columns=all_labels, index=keys)
+
+    return dummy_cols, set(all_labels)
+
+
+def _encode_one_hot(labels: dict) -> tuple[pd.Index, list[str], np.ndarray]:
+    """one hot encodes the labels per id into a uint8 matrix
+
+    Returns:
+        index of the ids (rows), sorted unique labels (columns) and the matrix
+    """
+    keys = pd.Index(np.asarray(list(labels.keys())))
+
+    # flatten list of all labels, factorize them and map the codes to sorted columns
+    counts = np.fromiter(map(len, labels.values()), dtype=np.intp, count=len(labels))
+    flat = np.empty(int(counts.sum()), dtype=object)
+    flat[:] = list(chain.from_iterable(labels.values()))
+    codes, uniques = pd.factorize(flat)
+    order = np.argsort(uniques.astype(str))
+    all_labels = [str(uniques[i]) for i in order]
+    column_of_code = np.empty(len(uniques), dtype=np.intp)
+    column_of_code[order] = np.arange(len(uniques))
+
+    # scatter a 1 into (row of the id, column of the label) for every label
+    one_hot = np.zeros((len(keys), len(all_labels)), dtype=np.uint8)
+    one_hot[np.repeat(np.arange(len(keys)), counts), column_of_code[codes]] = 1
+
+    return keys, all_labels, one_hot
@@ -0,0 +1,277 @@
+"""load balancing of chat requests over several ollama hosts
+
+`BackendPool` has the `chat` method of `ollama.Client`, so it can be passed as
+`client` to the `OllamaClassifier`. Every request goes to one host (the one
+with the fewest requests in flight or the next one in turn). A failed request
+is sent again to another host right away. A host that fails `max_failures`
+times in a row is ejected for `eject_seconds` and then gets another chance;
+`health_check` (or the background checks of `start_health_checks`) ejects hosts
+that do not answer the request for their models and reinstates them once they
+answer again. Hosts ejected for failed chat requests stay ejected until their
+time is up, a host that lists its models may still fail every chat request.
+
+Usage:
+    pool = BackendPool(["http://gpu1:11434", "http://gpu2:11434"])
+    o = OllamaClassifier(..., client=pool, concurrency=8)
+"""
+
+import itertools
+import threading
+import time
+from collections.abc import Iterator, Sequence
+from logging import Logger, getLogger
+from typing import Any, Literal
+
+import httpx
+from ollama import ChatResponse, Client, RequestError, ResponseError
+
+# errors after which a request may be worth another try (server hiccup, timeout, ...),
+# `is_retryable` sorts out the client errors among them
+RETRYABLE_ERRORS = (ResponseError, ConnectionError, httpx.TransportError)
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether a request that failed with `error` is worth another try, maybe on another host
+
+    Server errors (5xx), rate limits (429) and transport errors are; client
+    errors like an unknown model (404) or a bad option (400) fail the same way
+    on every attempt and every host.
+    """
+    if isinstance(error, ResponseError):
+        return error.status_code >= 500 or error.status_code == 429
+    return isinstance(error, (ConnectionError, httpx.TransportError))
+
+
+Routing = Literal["least_loaded", "round_robin"]
+
+
+class Backend:
+    """One ollama host of a `BackendPool` and its bookkeeping"""
+
+    def __init__(self, host: str, client: Client) -> None:
+        self.host = host
+        self.client = client
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        # ejected by `health_check` (unreachable) rather than by failed chat requests
+        self.unreachable = False
+
+    def is_available(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "ejected": self.ejected_until > time.monotonic(),
+        }
+
+
+class BackendPool:
+    """Routes chat requests over several ollama hosts
+
+    Args:
+        hosts: base urls of the ollama servers
+        routing: `least_loaded` picks the host with the fewest requests in
+            flight, `round_robin` takes the hosts in turn
+        timeout: timeout of every request in seconds
+        max_failures: failures in a row after which a host is ejected
+        eject_seconds: how long an ejected host gets no requests
+        connections: keep-alive connections kept open per host
+        logger: logger for ejections and failovers
+    """
+
+    def __init__(
+        self,
+        hosts: Sequence[str],
+        routing: Routing = "least_loaded",
+        timeout: float | None = None,
+        max_failures: int = 3,
+        eject_seconds: float = 30.0,
+        connections: int = 20,
+        logger: Logger = getLogger(__name__),
+    ) -> None:
+        if not hosts:
+            raise ValueError("BackendPool needs at least one host")
+        if routing not in ("least_loaded", "round_robin"):
+            raise ValueError(f"unknown routing '{routing}'")
+        limits = httpx.Limits(max_keepalive_connections=connections)
+        self.backends = [
+            Backend(h, Client(host=h, timeout=timeout, limits=limits)) for h in hosts
+        ]
+        self.routing = routing
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._next = 0
+        self._stop_checks = threading.Event()
+        self._checker: threading.Thread | None = None
+
+    @property
+    def clients(self) -> list[Client]:
+        """Clients of all hosts, e.g. to load the model everywhere"""
+        return [b.client for b in self.backends]
+
+    def chat(self, *args, **kwargs) -> ChatResponse | Iterator[ChatResponse]:
+        """`Client.chat` on one of the hosts, failing over to the other hosts
+
+        A streamed request fails over until its first chunk arrived, the host
+        counts as busy until the stream is exhausted. Client errors (see
+        `is_retryable`) are raised right away and do not count against the host.
+
+        Raises:
+            the client error, or the error of the last host if the request
+            failed on every host
+        """
+        tried: set[int] = set()
+        last_error: Exception | None = None
+        while True:
+            backend = self._acquire(tried)
+            if backend is None:
+                raise last_error
+            tried.add(id(backend))
+            try:
+                response = backend.client.chat(*args, **kwargs)
+                if kwargs.get("stream"):
+                    # the request is only sent when the stream is read
+                    chunks = iter(response)
+                    first = next(chunks, None)
+                    if first is None:
+                        raise ResponseError("empty streamed response", status_code=502)
+            except Exception as e:
+                if not is_retryable(e):
+                    self._release(backend, ok=False, count_failure=False)
+                    raise
+                self._release(backend, ok=False)
+                self._logger.warning(f"request to {backend.host} failed: {e!r}")
+                last_error = e
+                continue
+            if kwargs.get("stream"):
+                return self._stream(backend, itertools.chain([first], chunks))
+            self._release(backend, ok=True)
+            return response
+
+    def health_check(self) -> dict[str, bool]:
+        """Asks every host for its models, ejecting unreachable hosts
+
+        Hosts this check ejected are reinstated as soon as they answer again,
+        hosts ejected for failed chat requests are left to their ejection time.
+
+        Returns:
+            mapping of host to whether it answered
+        """
+        res = {}
+        for backend in self.backends:
+            try:
+                backend.client.list()
+                healthy = True
+            except (RequestError, *RETRYABLE_ERRORS):
+                healthy = False
+            with self._lock:
+                if healthy and backend.unreachable:
+                    backend.unreachable = False
+                    backend.consecutive_failures = 0
+                    backend.ejected_until = 0.0
+                elif not healthy and backend.ejected_until <= time.monotonic():
+                    self._eject(backend)
+                    backend.unreachable = True
+            res[backend.host] = healthy
+        return res
+
+    def start_health_checks(self, interval: float = 10.0) -> None:
+        """Runs `health_check` every `interval` seconds in a background thread"""
+
+        def run() -> None:
+            while not self._stop_checks.wait(interval):
+                self.health_check()
+
+        self._stop_checks.clear()
+        self._checker = threading.Thread(target=run, daemon=True)
+        self._checker.start()
+
+    def close(self) -> None:
+        self._stop_checks.set()
+        if self._checker is not None:
+            self._checker.join()
+            self._checker = None
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        with self._lock:
+            return {b.host: b.stats() for b in self.backends}
+
+    def __enter__(self) -> "BackendPool":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def _stream(
+        self, backend: Backend, chunks: Iterator[ChatResponse]
+    ) -> Iterator[ChatResponse]:
+        ok = False
+        try:
+            yield from chunks
+            ok = True
+        finally:
+            self._release(backend, ok=ok)
+
+    def _acquire(self, tried: set[int]) -> Backend | None:
+        """Picks the host for the next attempt and counts the request as in flight
+
+        Ejected hosts are only used when every host is ejected, then the one that
+        comes back first is tried.
+        """
+        with self._lock:
+            candidates = [b for b in self.backends if id(b) not in tried]
+            if not candidates:
+                return None
+            now = time.monotonic()
+            available = [b for b in candidates if b.is_available(now)]
+            if not available:
+                available = [min(candidates, key=lambda b: b.ejected_until)]
+
+            if self.routing == "round_robin":
+                n = len(self.backends)
+                order = [self.backends[(self._next + i) % n] for i in range(n)]
+                backend = next(b for b in order if b in available)
+                self._next = (self.backends.index(backend) + 1) % n
+            else:
+                backend = min(available, key=lambda b: (b.in_flight, b.requests))
+
+            backend.in_flight += 1
+            backend.requests += 1
+            return backend
+
+    def _release(self, backend: Backend, ok: bool, count_failure: bool = True) -> None:
+        """Ends a request on the host
+
+        Args:
+            ok: whether the request succeeded
+            count_failure: whether a failed request counts towards the ejection
+                of the host (not for client errors)
+        """
+        with self._lock:
+            backend.in_flight -= 1
+            if ok:
+                backend.consecutive_failures = 0
+                return
+            backend.errors += 1
+            if not count_failure:
+                return
+            backend.consecutive_failures += 1
+            backend.unreachable = False
+            # requests that were in flight while the host got ejected do not extend the ejection
+            if (
+                backend.consecutive_failures >= self.max_failures
+                and backend.is_available(time.monotonic())
+            ):
+                self._eject(backend)
+
+    def _eject(self, backend: Backend) -> None:
+        backend.ejected_until = time.monotonic() + self.eject_seconds
+        self._logger.warning(f"ejecting {backend.host} for {self.eject_seconds}s")
@@ -0,0 +1,120 @@
+"""length bucketing and dynamic padding for the review datasets
+
+Most reviews are much shorter than `max_len`, so padding every sample to
+`max_len` lets the GRU spend most of its time on padding tokens. Batches built
+by `LengthBucketBatchSampler` contain reviews of similar length and
+`pad_collate` pads them only to the longest review of the batch. The returned
+lengths can be passed to `torch.nn.utils.rnn.pack_padded_sequence`.
+
+Usage:
+    dataset = SteamReviewDataset(df, tokenizer, padding="longest")
+    loader = DataLoader(
+        dataset,
+        batch_sampler=LengthBucketBatchSampler(dataset.token_lengths(), 32),
+        collate_fn=partial(pad_collate, padding_value=tokenizer.pad_id()),
+    )
+    for tokens, labels, lengths in loader:
+        ...
+"""
+
+from collections.abc import Iterator, Sequence
+
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import Sampler
+
+
+def pad_collate(
+    batch: Sequence[tuple[torch.Tensor, torch.Tensor]], padding_value: int = 0
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Pads a batch of variable length samples to its longest sample
+
+    Empty reviews are given one padding token, because packed sequences must not
+    contain zero length sequences.
+
+    Args:
+        batch: list of (tokens, label) samples
+        padding_value: token id used for padding
+
+    Returns:
+        tokens (batch, longest), labels (batch, ...) and lengths (batch,) on the CPU
+    """
+    tokens, labels = zip(*batch)
+    tokens = [t if len(t) > 0 else torch.tensor([padding_value]) for t in tokens]
+    lengths = torch.tensor([len(t) for t in tokens], dtype=torch.int64)
+    padded = pad_sequence(tokens, batch_first=True, padding_value=padding_value)
+    return padded, torch.stack(labels), lengths
+
+
+class LengthBucketBatchSampler(Sampler[list[int]]):
+    """Batch sampler that groups samples of similar length
+
+    The indices are shuffled, cut into pools of `batch_size * pool_factor`
+    samples, every pool is sorted by length and cut into batches and finally the
+    batches are shuffled. This keeps most of the randomness of plain shuffling
+    while the batches need very little padding.
+
+    Args:
+        lengths: (token) length of every sample of the dataset
+        batch_size: number of samples per batch
+        shuffle: shuffle samples and batches every epoch, without shuffling all
+            samples are sorted by length (useful for evaluation)
+        pool_factor: pool size in batches
+        drop_last: drop the last incomplete batch of every pool
+        seed: seed of the shuffling
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int] | np.ndarray,
+        batch_size: int,
+        shuffle: bool = True,
+        pool_factor: int = 50,
+        drop_last: bool = False,
+        seed: int | None = None,
+    ) -> None:
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_factor = pool_factor
+        self.drop_last = drop_last
+        self._rng = np.random.default_rng(seed)
+
+    def _batches(self) -> list[np.ndarray]:
+        if not self.shuffle:
+            order = np.argsort(self.lengths, kind="stable")
+            pools = [order]
+        else:
+            order = self._rng.permutation(len(self.lengths))
+            pool_size = self.batch_size * self.pool_factor
+            pools = [
+                pool[np.argsort(self.lengths[pool], kind="stable")]
+                for pool in np.split(order, range(pool_size, len(order), pool_size))
+            ]
+
+        batches = []
+        for pool in pools:
+            for start in range(0, len(pool), self.batch_size):
+                batch = pool[start : start + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in self._rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self) -> Iterator[list[int]]:
+        for batch in self._batches():
+            yield batch.tolist()
+
+    def __len__(self) -> int:
+        if not self.shuffle:
+            pool_size, n_pools, rest = len(self.lengths), 0, len(self.lengths)
+        else:
+            pool_size = self.batch_size * self.pool_factor
+            n_pools, rest = divmod(len(self.lengths), pool_size)
+        if self.drop_last:
+            return n_pools * (pool_size // self.batch_size) + rest // self.batch_size
+        return n_pools * -(-pool_size // self.batch_size) + -(-rest // self.batch_size)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""benchmark fixed padding vs. length bucketing + dynamic padding
+
+Trains the GRU of `gru_review_classifier.ipynb` (or `gru_topics_classifier.ipynb`
+with `--setup topics`) for a number of batches, once with the old pipeline
+(every review padded to `max_len`, default collate, last time step of the padded
+sequence) and once with `LengthBucketBatchSampler`, `pad_collate` and packed
+sequences, and reports tokens/sec for both.
+
+Like the notebook, the topics setup trains on the annotated reviews of an
+annotation results file (`--labels`) with one output per topic.
+
+Usage:
+    python benchmark_batching.py -n 20000 --batches 200
+    python benchmark_batching.py --setup topics --labels results/annotations-....json
+"""
+
+import json
+import time
+from argparse import ArgumentParser
+from functools import partial
+
+import pandas as pd
+import sentencepiece as spm
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+
+from annotations import update_df_review_labels
+from batching import LengthBucketBatchSampler, pad_collate
+from corpus import load_corpus
+from gru_classifier import GRUClassifier
+from steam_review_dataset import SteamReviewDataset
+
+# (embedding_dim, gru_layers, hidden_dim, batch_size) of the notebooks
+SETUPS = {"review": (128, 1, 256, 32), "topics": (512, 2, 1024, 16)}
+
+
+def run(model, loader, batches: int, device, pad_idx: int, packed: bool) -> dict:
+    criterion = nn.BCEWithLogitsLoss()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    model.train()
+    real_tokens = padded_tokens = samples = 0
+    start = time.perf_counter()
+    done = 0
+    while done < batches:
+        for batch in loader:
+            if packed:
+                tokens, labels, lengths = batch
+            else:
+                tokens, labels = batch
+                lengths = (tokens != pad_idx).sum(dim=1)
+            tokens, labels = tokens.to(device), labels.to(device)
+
+            optimizer.zero_grad()
+            outputs = model(tokens, lengths if packed else None)
+            loss = criterion(outputs.squeeze(1), labels)
+            loss.backward()
+            optimizer.step()
+
+            real_tokens += int(lengths.sum())
+            padded_tokens += tokens.numel()
+            samples += len(labels)
+            done += 1
+            if done >= batches:
+                break
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    seconds = time.perf_counter() - start
+    return {
+        "seconds": round(seconds, 2),
+        "samples/sec": round(samples / seconds, 1),
+        "tokens/sec": round(real_tokens / seconds, 1),
+        "padded tokens/sec": round(padded_tokens / seconds, 1),
+        "padding share": round(1 - real_tokens / padded_tokens, 3),
+    }
+
+
+def main():
+    ap = ArgumentParser()
+    ap.add_argument(
+        "-c", "--csv", type=str, default="../../data/reviews_100k_cleaned_new.csv.bz2"
+    )
+    ap.add_argument(
+        "-m", "--model", type=str, default="../../data/reviews_unigram.model"
+    )
+    ap.add_argument("-n", "--number", type=int, default=20_000, help="reviews to use")
+    ap.add_argument("-b", "--batches", type=int, default=200, help="batches per run")
+    ap.add_argument("-s", "--setup", choices=list(SETUPS), default="review")
+    ap.add_argument(
+        "-l",
+        "--labels",
+        type=str,
+        default=None,
+        help="annotation results (review id -> topics) for the topics setup",
+    )
+    ap.add_argument("--max-len", type=int, default=200)
+    args = ap.parse_args()
+    if args.setup == "topics" and args.labels is None:
+        ap.error("--setup topics needs the annotation results as --labels")
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(1234)
+    df = load_corpus(args.csv, columns=["review_id", "review", "voted_up"])
+    topics = None
+    if args.setup == "topics":
+        with open(args.labels, "r", encoding="utf-8") as f:
+            labels = {int(k): v for k, v in json.load(f).items()}
+        df, topics = update_df_review_labels(df, labels, dropna=True)
+    df = df.head(args.number)
+    tokenizer = spm.SentencePieceProcessor(model_file=args.model)
+    pad_idx = tokenizer.pad_id()
+    embedding_dim, gru_layers, hidden_dim, batch_size = SETUPS[args.setup]
+
+    def make_model():
+        torch.manual_seed(1234)
+        return GRUClassifier(
+            tokenizer.get_piece_size(),
+            embedding_dim,
+            gru_layers,
+            hidden_dim,
+            dropout=0,
+            output_dim=len(topics) if topics else 1,
+            pad_idx=pad_idx,
+        ).to(device)
+
+    topic_mode = {"topic_mode": topics is not None, "topics": topics}
+    fixed = SteamReviewDataset(df, tokenizer, max_len=args.max_len, **topic_mode)
+    before = run(
+        make_model(),
+        DataLoader(fixed, batch_size=batch_size, shuffle=True),
+        args.batches,
+        device,
+        pad_idx,
+        packed=False,
+    )
+
+    dynamic = SteamReviewDataset(
+        df, tokenizer, max_len=args.max_len, padding="longest", **topic_mode
+    )
+    after = run(
+        make_model(),
+        DataLoader(
+            dynamic,
+            batch_sampler=LengthBucketBatchSampler(dynamic.token_lengths(), batch_size),
+            collate_fn=partial(pad_collate, padding_value=pad_idx),
+        ),
+        args.batches,
+        device,
+        pad_idx,
+        packed=True,
+    )
+
+    table = pd.DataFrame({"fixed padding": before, "bucketing + packing": after})
+    table["speedup"] = table["bucketing + packing"] / table["fixed padding"]
+    print(
+        f"{args.setup} setup on {device}, {args.batches} batches of {batch_size}, "
+        f"{len(df)} reviews"
+    )
+    print(
+        table.loc[["samples/sec", "tokens/sec", "padded tokens/sec", "padding share"]]
+    )
+
+
+if __name__ == "__main__":
+    main()
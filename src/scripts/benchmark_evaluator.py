@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""benchmark the vectorized `MultiLabelEvaluator` against the sklearn metrics
+
+Generates random true and predicted labels for N reviews and T topics, times
+the binarization, `evaluate` and `review_metrics` of the evaluator and checks
+that the micro/macro scores, the hamming loss and the jaccard score match the
+sklearn functions the evaluator used to call.
+
+Usage:
+    python benchmark_evaluator.py -n 1000000 -t 50
+"""
+
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+from sklearn.metrics import (
+    f1_score,
+    hamming_loss,
+    jaccard_score,
+    precision_score,
+    recall_score,
+)
+
+from multilabel_classification_evaluator import MultiLabelEvaluator
+
+
+def random_labels(
+    n: int, topics: list[str], density: float, seed: int
+) -> dict[int, list[str]]:
+    rng = np.random.default_rng(seed)
+    matrix = rng.random((n, len(topics))) < density
+    names = np.array(topics)
+    return {i: names[row].tolist() for i, row in enumerate(matrix)}
+
+
+def sklearn_metrics(evaluator: MultiLabelEvaluator) -> dict[str, float]:
+    t, p = evaluator.true_matrix, evaluator.pred_matrix
+    return {
+        "Micro F1": f1_score(t, p, average="micro", zero_division=0),
+        "Macro F1": f1_score(t, p, average="macro", zero_division=0),
+        "Micro Precision": precision_score(t, p, average="micro", zero_division=0),
+        "Macro Precision": precision_score(t, p, average="macro", zero_division=0),
+        "Micro Recall": recall_score(t, p, average="micro", zero_division=0),
+        "Macro Recall": recall_score(t, p, average="macro", zero_division=0),
+        "Hamming Loss": hamming_loss(t, p),
+        "Jaccard Score": jaccard_score(t, p, average="samples", zero_division=0),
+    }
+
+
+def main():
+    ap = ArgumentParser()
+    ap.add_argument("-n", "--reviews", type=int, default=1_000_000)
+    ap.add_argument("-t", "--topics", type=int, default=50)
+    ap.add_argument(
+        "-d", "--density", type=float, default=0.05, help="share of set labels"
+    )
+    ap.add_argument("--skip-sklearn", action="store_true", default=False)
+    args = ap.parse_args()
+
+    topics = [f"topic {i}" for i in range(args.topics)]
+    true_labels = random_labels(args.reviews, topics, args.density, seed=0)
+    pred_labels = random_labels(args.reviews, topics, args.density, seed=1)
+
+    start = time.perf_counter()
+    evaluator = MultiLabelEvaluator.from_labels(true_labels, pred_labels)
+    binarize = time.perf_counter() - start
+    start = time.perf_counter()
+    metrics = evaluator.evaluate()
+    evaluate = time.perf_counter() - start
+    start = time.perf_counter()
+    evaluator.review_metrics()
+    review = time.perf_counter() - start
+    print(f"{args.reviews} reviews x {args.topics} topics")
+    print(
+        f"binarize: {binarize:.2f}s evaluate: {evaluate:.2f}s review_metrics: {review:.2f}s"
+    )
+
+    if args.skip_sklearn:
+        return
+    start = time.perf_counter()
+    reference = sklearn_metrics(evaluator)
+    print(
+        f"sklearn (same metrics on the same matrices): {time.perf_counter() - start:.2f}s"
+    )
+    for name, value in reference.items():
+        ours = metrics.loc[name, "precision"]
+        if not np.isclose(ours, value, rtol=0, atol=1e-12):
+            raise AssertionError(f"{name}: {ours} != sklearn {value}")
+    print("all metrics match sklearn")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""benchmark single review prompts vs. batch prompts with K reviews
+
+Classifies the hand annotated reviews once per batch size K and reports the
+throughput next to the quality of the answers (computed by the
+`MultiLabelEvaluator` against the annotations), so K can be chosen by the
+accuracy/throughput trade-off.
+
+Usage:
+    python benchmark_prompt_batching.py -m llama3.2 -k 1 2 4 8 16
+    python benchmark_prompt_batching.py --host http://127.0.0.1:11435 -n 50
+"""
+
+import json
+import os
+import time
+from argparse import ArgumentParser
+from datetime import datetime
+
+import pandas as pd
+from ollama import Client
+
+from multilabel_classification_evaluator import MultiLabelEvaluator
+from ollama_topic_classification import (
+    BATCH_PROMPT_FILE,
+    JSON_PATH,
+    PROMPT_VERSIONS,
+    Model,
+    OllamaClassifier,
+    annotated_reviews,
+    default_topics,
+    load_prompts,
+)
+
+
+def main():
+    ap = ArgumentParser()
+    ap.add_argument("-m", "--model", type=Model, default=Model.LLAMA3B)
+    ap.add_argument(
+        "-v", "--prompt-version", type=int, default=1, choices=list(PROMPT_VERSIONS)
+    )
+    ap.add_argument("-n", "--number", type=int, default=-1, help="reviews to classify")
+    ap.add_argument("-k", "--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    ap.add_argument("--batch-tokens", type=int, default=1024)
+    ap.add_argument("--structured", action="store_true", default=False)
+    ap.add_argument("--num-predict", type=int, default=None)
+    ap.add_argument("-j", "--concurrency", type=int, default=1)
+    ap.add_argument("-t", "--timeout", type=float, default=None)
+    ap.add_argument(
+        "--host", type=str, default=None, help="ollama host [default] $OLLAMA_HOST"
+    )
+    args = ap.parse_args()
+
+    sys_prompt, prompt_template = load_prompts(args.prompt_version)
+    with open(BATCH_PROMPT_FILE, "r", encoding="utf-8") as f:
+        batch_prompt_template = f.read()
+
+    ids, reviews = annotated_reviews(args.number)
+    topics = default_topics()
+    client = Client(host=args.host, timeout=args.timeout)
+    os.makedirs("./results", exist_ok=True)
+
+    rows = {}
+    for k in args.batch_sizes:
+        o = OllamaClassifier(
+            args.model,
+            sys_prompt,
+            prompt_template,
+            reviews,
+            ids,
+            topics,
+            client=client,
+            concurrency=args.concurrency,
+            batch_size=k,
+            batch_tokens=args.batch_tokens,
+            batch_prompt_template=batch_prompt_template,
+            structured=args.structured,
+            num_predict=args.num_predict,
+        )
+        start = time.perf_counter()
+        data = o.get_all_topic_eval()
+        seconds = time.perf_counter() - start
+
+        results_file = f"./results/batching-k{k}-{datetime.now().isoformat()}-{str(args.model)}.json".replace(
+            ":", "_"
+        )
+        with open(results_file, "w") as f:
+            json.dump(data, f)
+        # with -n only the first n annotated reviews were classified
+        metrics = MultiLabelEvaluator(
+            JSON_PATH, results_file, only_predicted=True
+        ).evaluate()
+
+        stats = o.batch_stats
+        usage = o.metrics.summary()
+        rows[k] = {
+            "reviews/sec": len(data) / seconds,
+            "requests": stats["batches"] + stats["fallbacks"] if k > 1 else len(data),
+            "fallback share": stats["fallbacks"] / stats["reviews"] if k > 1 else 0.0,
+            "micro F1": metrics.loc["Micro F1", "precision"],
+            "macro F1": metrics.loc["Macro F1", "precision"],
+            "jaccard": metrics.loc["Jaccard Score", "precision"],
+            "prompt tokens/review": usage["prompt tokens/review"],
+            "eval tokens/review": usage["eval tokens/review"],
+        }
+
+    table = pd.DataFrame.from_dict(rows, orient="index")
+    table.index.name = "K"
+    table["speedup"] = table["reviews/sec"] / table["reviews/sec"].iloc[0]
+    print(f"{len(reviews)} reviews, {args.model}, prompt v{args.prompt_version}")
+    print(table.round(3).to_string())
+
+
+if __name__ == "__main__":
+    main()
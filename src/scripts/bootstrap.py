@@ -0,0 +1,219 @@
+"""bootstrap confidence intervals and paired significance tests of the evaluation
+
+All scores are computed from per review counts: a resample of the reviews is a
+row of multinomial weights, so the TP, prediction and annotation counts of
+thousands of resamples are one matrix product of the weights with the per
+review counts of the binarized label matrices. The resamples are drawn in
+chunks on a thread pool (numpy releases the GIL), every chunk has its own
+seeded generator, so the results only depend on the seed.
+
+Usage:
+    true_labels, _ = annotation_labels(json.load(f))
+    t, a, b = paired_matrices(true_labels, results_a, results_b)
+    print(confidence_intervals(t, a))
+    print(paired_test(t, a, b))
+"""
+
+import os
+from collections.abc import Callable, Iterable, Mapping
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from multilabel_classification_evaluator import binarize, precision_recall_f1
+
+# scores with intervals, same names as the rows of `MultiLabelEvaluator.evaluate`
+METRICS = ["Micro F1", "Macro F1", "Jaccard Score"]
+
+# resamples per chunk of the thread pool
+CHUNK_SIZE = 250
+
+
+def paired_matrices(
+    true_labels: Mapping[int, Iterable[str]],
+    *pred_labels: Mapping[int, Iterable[str]],
+) -> tuple[np.ndarray, ...]:
+    """Binarizes the annotations and the results of several runs on the same reviews and topics
+
+    The rows are the union of all review ids (as in `MultiLabelEvaluator`), so
+    a review one run has no answer for counts as an empty prediction.
+
+    Returns:
+        true matrix followed by one prediction matrix per run
+    """
+    ids = set(true_labels)
+    categories = {c for labels in true_labels.values() for c in labels}
+    for pred in pred_labels:
+        ids.update(pred)
+        categories.update(c for labels in pred.values() for c in labels)
+    review_index = pd.Index(sorted(ids))
+    category_index = pd.Index(sorted(categories))
+    return tuple(
+        binarize(labels, review_index, category_index)
+        for labels in (true_labels, *pred_labels)
+    )
+
+
+def review_counts(true_matrix: np.ndarray, pred_matrix: np.ndarray) -> np.ndarray:
+    """Per review counts a resample is weighted with
+
+    Returns:
+        (reviews, 3 * topics + 1) matrix of the TP, prediction and annotation
+        indicators per topic and the jaccard score of every review
+    """
+    tp = true_matrix & pred_matrix
+    union = (true_matrix | pred_matrix).sum(axis=1)
+    jaccard = np.zeros(len(true_matrix))
+    np.divide(tp.sum(axis=1), union, out=jaccard, where=union != 0)
+    return np.hstack([tp, pred_matrix, true_matrix, jaccard[:, None]]).astype(
+        np.float64
+    )
+
+
+def scores(counts: np.ndarray, reviews: int) -> dict[str, np.ndarray]:
+    """Micro/macro F1 and jaccard score from (resamples, 3 * topics + 1) weighted counts"""
+    topics = (counts.shape[1] - 1) // 3
+    tp, pred, true = (counts[:, i * topics : (i + 1) * topics] for i in range(3))
+    _, _, f1 = precision_recall_f1(tp, pred, true)
+    _, _, micro_f1 = precision_recall_f1(
+        tp.sum(axis=1), pred.sum(axis=1), true.sum(axis=1)
+    )
+    return {
+        "Micro F1": micro_f1,
+        "Macro F1": f1.mean(axis=1) if topics else np.zeros(len(counts)),
+        "Jaccard Score": counts[:, -1] / reviews,
+    }
+
+
+def confidence_intervals(
+    true_matrix: np.ndarray,
+    pred_matrix: np.ndarray,
+    resamples: int = 2000,
+    confidence: float = 0.95,
+    seed: int = 0,
+    workers: int | None = None,
+) -> pd.DataFrame:
+    """Percentile bootstrap intervals of micro/macro F1 and the jaccard score
+
+    Returns:
+        table with the score on all reviews and the lower and upper bound per metric
+    """
+    counts = review_counts(true_matrix, pred_matrix)
+    n = len(counts)
+    estimate = scores(counts.sum(axis=0, keepdims=True), n)
+    resampled = scores(_resample(counts, resamples, seed, workers), n)
+    alpha = (1 - confidence) / 2
+    return pd.DataFrame(
+        {
+            metric: {
+                "score": float(estimate[metric][0]),
+                "low": float(np.quantile(resampled[metric], alpha)),
+                "high": float(np.quantile(resampled[metric], 1 - alpha)),
+            }
+            for metric in METRICS
+        }
+    ).transpose()
+
+
+def paired_test(
+    true_matrix: np.ndarray,
+    pred_a: np.ndarray,
+    pred_b: np.ndarray,
+    resamples: int = 2000,
+    permutations: int = 2000,
+    confidence: float = 0.95,
+    seed: int = 0,
+    workers: int | None = None,
+) -> pd.DataFrame:
+    """Paired bootstrap and permutation test of run B against run A on the same reviews
+
+    The bootstrap resamples the reviews of both runs with the same weights and
+    gives an interval of the difference B - A; its p-value is the share of
+    resamples whose difference (shifted to the null hypothesis) is at least as
+    extreme as the observed one. The permutation test swaps the predictions
+    of A and B of random reviews.
+
+    Returns:
+        table with the scores of both runs, the difference, its interval and the
+        two-sided p-values of both tests per metric
+    """
+    counts_a = review_counts(true_matrix, pred_a)
+    counts_b = review_counts(true_matrix, pred_b)
+    n = len(counts_a)
+    width = counts_a.shape[1]
+    estimate_a = scores(counts_a.sum(axis=0, keepdims=True), n)
+    estimate_b = scores(counts_b.sum(axis=0, keepdims=True), n)
+
+    # one matrix product for both runs keeps the resamples paired
+    resampled = _resample(np.hstack([counts_a, counts_b]), resamples, seed, workers)
+    boot_a = scores(resampled[:, :width], n)
+    boot_b = scores(resampled[:, width:], n)
+
+    # swapping review i adds its difference to A and subtracts it from B
+    diff = counts_b - counts_a
+    swapped = _permute(diff, permutations, seed, workers)
+    perm_a = scores(counts_a.sum(axis=0) + swapped, n)
+    perm_b = scores(counts_b.sum(axis=0) - swapped, n)
+
+    alpha = (1 - confidence) / 2
+    res = {}
+    for metric in METRICS:
+        observed = float(estimate_b[metric][0] - estimate_a[metric][0])
+        deltas = boot_b[metric] - boot_a[metric]
+        perm_deltas = perm_b[metric] - perm_a[metric]
+        res[metric] = {
+            "A": float(estimate_a[metric][0]),
+            "B": float(estimate_b[metric][0]),
+            "B - A": observed,
+            "low": float(np.quantile(deltas, alpha)),
+            "high": float(np.quantile(deltas, 1 - alpha)),
+            "bootstrap p": float(
+                (1 + np.sum(np.abs(deltas - observed) >= abs(observed)))
+                / (resamples + 1)
+            ),
+            "permutation p": float(
+                (1 + np.sum(np.abs(perm_deltas) >= abs(observed) - 1e-12))
+                / (permutations + 1)
+            ),
+        }
+    return pd.DataFrame(res).transpose()
+
+
+def _resample(
+    counts: np.ndarray, resamples: int, seed: int, workers: int | None
+) -> np.ndarray:
+    """Weighted counts of `resamples` bootstrap resamples of the reviews"""
+    n = len(counts)
+
+    def chunk(rng: np.random.Generator, size: int) -> np.ndarray:
+        weights = rng.multinomial(n, np.full(n, 1 / n), size=size).astype(np.float64)
+        return weights @ counts
+
+    return _chunked(chunk, resamples, seed, workers)
+
+
+def _permute(
+    diff: np.ndarray, permutations: int, seed: int, workers: int | None
+) -> np.ndarray:
+    """Summed differences of the swapped reviews of `permutations` random swaps"""
+
+    def chunk(rng: np.random.Generator, size: int) -> np.ndarray:
+        swaps = rng.integers(0, 2, size=(size, len(diff))).astype(np.float64)
+        return swaps @ diff
+
+    return _chunked(chunk, permutations, seed, workers)
+
+
+def _chunked(
+    fn: Callable[[np.random.Generator, int], np.ndarray],
+    total: int,
+    seed: int,
+    workers: int | None,
+) -> np.ndarray:
+    sizes = [min(CHUNK_SIZE, total - start) for start in range(0, total, CHUNK_SIZE)]
+    rngs = [
+        np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(len(sizes))
+    ]
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        return np.vstack(list(executor.map(fn, rngs, sizes)))
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""cheap local pre-classifier in front of the LLM
+
+A TF-IDF + logistic regression model (one per topic) is trained on the topics
+the LLM found for already classified reviews. Its confidence in a review is the
+confidence of its least certain topic decision, `max(p, 1 - p)`. The threshold
+is calibrated on held out reviews: it is the lowest confidence at which the
+reviews above it still agree with the LLM labels with a micro F1 of at least
+`--target`. Reviews above the threshold are labeled locally, all others are
+sent to the LLM.
+
+With `--cascade models/cascade.pkl` the classification and annotation scripts
+write the locally labeled reviews into the checkpoint of the run (answer
+"cascade"), so the classifier skips them and `--resume` keeps them.
+
+Usage:
+    python cascade.py train -l results/annotations-v3-...-llama3.2.json --corpus ../../data/reviews_100k_cleaned_new.csv.bz2
+    python cascade.py report -c models/cascade.pkl -r results/results-v3-...-llama3.2.json
+"""
+
+import json
+import os
+import pickle
+from argparse import ArgumentParser
+from collections.abc import Iterable, Sequence
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import train_test_split
+from sklearn.multiclass import OneVsRestClassifier
+from sklearn.preprocessing import MultiLabelBinarizer
+
+from bootstrap import paired_matrices, paired_test
+from checkpoint import JsonlCheckpoint
+from corpus import load_corpus
+from dedup import DedupIndex
+from multilabel_classification_evaluator import MultiLabelEvaluator, annotation_labels
+
+DEFAULT_CASCADE_PATH = "../../models/cascade.pkl"
+
+# answer stored in the checkpoint for reviews the cascade labeled
+CASCADE_ANSWER = "cascade"
+
+# attributes of a `CascadeClassifier` that are saved
+STATE = ["vectorizer", "binarizer", "model", "threshold", "calibration", "trained_ids"]
+
+
+class CascadeClassifier:
+    """TF-IDF + linear topic classifier with a calibrated confidence threshold
+
+    Args:
+        max_features: size of the TF-IDF vocabulary (uni- and bigrams)
+        c: inverse regularization strength of the logistic regressions
+    """
+
+    def __init__(self, max_features: int = 50_000, c: float = 4.0) -> None:
+        self.vectorizer = TfidfVectorizer(
+            ngram_range=(1, 2), min_df=2, max_features=max_features, sublinear_tf=True
+        )
+        self.binarizer = MultiLabelBinarizer()
+        self.model = OneVsRestClassifier(
+            LogisticRegression(C=c, max_iter=1000), n_jobs=-1
+        )
+        # nothing is labeled locally before `calibrate`
+        self.threshold = np.inf
+        self.calibration: dict[str, float] = {}
+        # reviews used for training and calibration, `report` leaves them out
+        self.trained_ids: set[int] = set()
+
+    @property
+    def topics(self) -> list[str]:
+        return list(self.binarizer.classes_)
+
+    def fit(
+        self, texts: Sequence[str], labels: Sequence[Iterable[str]]
+    ) -> "CascadeClassifier":
+        y = self.binarizer.fit_transform(labels)
+        self.model.fit(self.vectorizer.fit_transform(texts), y)
+        return self
+
+    def predict(self, texts: Sequence[str]) -> tuple[list[list[str]], np.ndarray]:
+        """Topics and confidence of every review
+
+        Returns:
+            topics per review and the confidence of its least certain topic
+        """
+        proba = self.model.predict_proba(self.vectorizer.transform(texts))
+        found = proba >= 0.5
+        confidence = np.maximum(proba, 1 - proba).min(axis=1)
+        topics = np.array(self.topics)
+        return [topics[row].tolist() for row in found], confidence
+
+    def calibrate(
+        self, texts: Sequence[str], labels: Sequence[Iterable[str]], target: float = 0.9
+    ) -> float:
+        """Sets the threshold to the lowest confidence whose reviews reach `target` micro F1
+
+        The reviews are sorted by confidence, the micro F1 of every prefix against
+        `labels` follows from the cumulative TP, prediction and label counts.
+
+        Returns:
+            the threshold (inf if not even the most confident review reaches the target)
+        """
+        predicted, confidence = self.predict(texts)
+        true = self.binarizer.transform(labels).astype(bool)
+        pred = self.binarizer.transform(predicted).astype(bool)
+        order = np.argsort(-confidence, kind="stable")
+        tp = np.cumsum((true & pred).sum(axis=1)[order])
+        total = np.cumsum(true.sum(axis=1)[order] + pred.sum(axis=1)[order])
+        # a prefix without any topic in labels and predictions is a perfect match
+        f1 = np.divide(2.0 * tp, total, out=np.ones(len(tp)), where=total != 0)
+        reached = np.flatnonzero(f1 >= target)
+        if len(reached) == 0:
+            self.threshold = np.inf
+            coverage, f1_at = 0.0, float("nan")
+        else:
+            last = reached[-1]
+            self.threshold = float(confidence[order][last])
+            coverage = float(np.mean(confidence >= self.threshold))
+            f1_at = float(f1[last])
+        self.calibration = {"target": target, "coverage": coverage, "micro F1": f1_at}
+        return self.threshold
+
+    def route(
+        self, ids: Sequence[int], reviews: Sequence[str]
+    ) -> tuple[dict[int, list[str]], list[int], list[str]]:
+        """Splits the reviews into the ones labeled locally and the ones for the LLM
+
+        Returns:
+            topics of the locally labeled reviews by id and the ids and texts of
+            the reviews that go to the LLM
+        """
+        if len(reviews) == 0:
+            return {}, [], []
+        predicted, confidence = self.predict(reviews)
+        accepted = {}
+        routed_ids, routed_reviews = [], []
+        for id, review, topics, conf in zip(ids, reviews, predicted, confidence):
+            if conf >= self.threshold:
+                accepted[id] = topics
+            else:
+                routed_ids.append(id)
+                routed_reviews.append(review)
+        return accepted, routed_ids, routed_reviews
+
+    def save(self, path: str) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # the fitted parts only, so the file does not depend on where the class was defined
+        state = {name: getattr(self, name) for name in STATE}
+        with open(path, "wb") as f:
+            pickle.dump(state, f)
+
+    @classmethod
+    def load(cls, path: str) -> "CascadeClassifier":
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        cascade = cls.__new__(cls)
+        # files saved before `trained_ids` existed
+        cascade.trained_ids = set()
+        for name in STATE:
+            if name in state:
+                setattr(cascade, name, state[name])
+        return cascade
+
+
+def prelabel(
+    path: str, ids: Sequence[int], reviews: Sequence[str], checkpoint: JsonlCheckpoint
+) -> int:
+    """Labels the confident reviews with the cascade and writes them into the checkpoint
+
+    Reviews that are already in the checkpoint are left alone.
+
+    Returns:
+        number of reviews labeled by the cascade
+    """
+    cascade = CascadeClassifier.load(path)
+    todo = [(id, r) for id, r in zip(ids, reviews) if id not in checkpoint]
+    accepted, _, _ = cascade.route([id for id, _ in todo], [r for _, r in todo])
+    checkpoint.extend((id, topics, CASCADE_ANSWER) for id, topics in accepted.items())
+    print(
+        f"cascade labeled {len(accepted)} of {len(todo)} reviews "
+        f"({len(accepted) / max(len(todo), 1):.1%} of the LLM calls saved)"
+    )
+    return len(accepted)
+
+
+def load_labels(paths: Sequence[str]) -> dict[int, list[str]]:
+    """Merges result files (review id -> topics), later files win"""
+    labels = {}
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            labels.update({int(k): v for k, v in json.load(f).items()})
+    return labels
+
+
+def corpus_texts(ids: Iterable[int], corpus: str) -> dict[int, str]:
+    """Texts of the given review ids from the corpus"""
+    df = load_corpus(corpus, columns=["review_id", "review"])
+    df = df[df["review_id"].isin(set(ids))]
+    return dict(zip(df["review_id"].tolist(), df["review"].astype(str).tolist()))
+
+
+def annotated_texts(annotations: str) -> tuple[dict[int, set[str]], dict[int, str]]:
+    with open(annotations, "r", encoding="utf-8") as f:
+        return annotation_labels(json.load(f))
+
+
+def train(args) -> None:
+    labels = load_labels(args.labels)
+    texts = corpus_texts(labels.keys(), args.corpus) if args.corpus else {}
+    if args.annotations:
+        true_labels, review_texts = annotated_texts(args.annotations)
+        labels.update({k: sorted(v) for k, v in true_labels.items()})
+        texts.update(review_texts)
+    ids = [id for id in labels if id in texts]
+    if len(ids) < len(labels):
+        print(f"no text for {len(labels) - len(ids)} of {len(labels)} labeled reviews")
+    # including dropped duplicates, they are as good as seen in training
+    trained_ids = set(ids)
+    if args.dedup:
+        # copies would end up on both sides of the calibration split
+        ids, _, copies = DedupIndex.load(args.dedup).collapse(
+            ids, [texts[i] for i in ids]
+        )
+        print(f"dedup: dropped {len(copies)} duplicate reviews from the training data")
+
+    train_ids, calibration_ids = train_test_split(
+        ids, test_size=args.calibration_share, random_state=args.seed
+    )
+    cascade = CascadeClassifier(max_features=args.max_features, c=args.c)
+    cascade.trained_ids = trained_ids
+    cascade.fit([texts[i] for i in train_ids], [labels[i] for i in train_ids])
+    threshold = cascade.calibrate(
+        [texts[i] for i in calibration_ids],
+        [labels[i] for i in calibration_ids],
+        args.target,
+    )
+    cascade.save(args.out)
+    print(
+        f"trained on {len(train_ids)} reviews, threshold {threshold:.3f} labels "
+        f"{cascade.calibration['coverage']:.1%} of the {len(calibration_ids)} held out reviews "
+        f"locally (micro F1 {cascade.calibration['micro F1']:.3f} against the LLM), saved to {args.out}"
+    )
+
+
+def report(args) -> None:
+    """Saved LLM calls and quality of the cascade vs. the LLM alone on the annotated reviews
+
+    Annotated reviews the cascade was trained or calibrated on (`train
+    --annotations`) are left out, they would inflate its accuracy.
+    """
+    cascade = CascadeClassifier.load(args.cascade)
+    true_labels, review_texts = annotated_texts(args.annotations)
+    llm = load_labels([args.results])
+    annotated = [id for id in llm if id in review_texts]
+    ids = [id for id in annotated if id not in cascade.trained_ids]
+    if len(ids) < len(annotated):
+        print(
+            f"left out {len(annotated) - len(ids)} annotated reviews the cascade was trained on"
+        )
+    if not ids:
+        raise SystemExit(
+            "no annotated reviews left that the cascade was not trained on"
+        )
+    true_labels = {id: true_labels[id] for id in ids}
+    accepted, _, _ = cascade.route(ids, [review_texts[i] for i in ids])
+    combined = {id: accepted[id] if id in accepted else llm[id] for id in ids}
+    llm = {id: llm[id] for id in ids}
+
+    print(
+        f"{len(accepted)} of {len(ids)} reviews labeled locally ({len(accepted) / len(ids):.1%} of the LLM calls saved)"
+    )
+    rows = ["Micro F1", "Macro F1", "Jaccard Score", "Hamming Loss"]
+    llm_scores = MultiLabelEvaluator.from_labels(true_labels, llm).evaluate()
+    cascade_scores = MultiLabelEvaluator.from_labels(true_labels, combined).evaluate()
+    for row in rows:
+        a, b = llm_scores.loc[row, "precision"], cascade_scores.loc[row, "precision"]
+        print(f"{row:14} LLM {a:.3f} cascade {b:.3f} delta {b - a:+.3f}")
+    t, pred_llm, pred_cascade = paired_matrices(true_labels, llm, combined)
+    print(paired_test(t, pred_llm, pred_cascade).round(4).to_string())
+
+
+def main():
+    ap = ArgumentParser()
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    t = sub.add_parser("train", help="train and calibrate the cascade on LLM labels")
+    t.add_argument(
+        "-l",
+        "--labels",
+        type=str,
+        nargs="+",
+        required=True,
+        help="result files with the LLM topics",
+    )
+    t.add_argument(
+        "--corpus",
+        type=str,
+        default=None,
+        help="corpus with the texts of the labeled reviews",
+    )
+    t.add_argument(
+        "--annotations",
+        type=str,
+        default=None,
+        help="also train on the hand annotated reviews",
+    )
+    t.add_argument(
+        "--target",
+        type=float,
+        default=0.9,
+        help="micro F1 the locally labeled reviews have to reach",
+    )
+    t.add_argument("--calibration-share", type=float, default=0.2)
+    t.add_argument("--max-features", type=int, default=50_000)
+    t.add_argument("--c", type=float, default=4.0)
+    t.add_argument("--seed", type=int, default=0)
+    t.add_argument(
+        "--dedup",
+        type=str,
+        default=None,
+        help="train on one review per cluster of this index",
+    )
+    t.add_argument("-o", "--out", type=str, default=DEFAULT_CASCADE_PATH)
+    t.set_defaults(run=train)
+
+    r = sub.add_parser(
+        "report", help="saved calls and accuracy delta on the annotated reviews"
+    )
+    r.add_argument("-c", "--cascade", type=str, default=DEFAULT_CASCADE_PATH)
+    r.add_argument(
+        "-r",
+        "--results",
+        type=str,
+        required=True,
+        help="results of the LLM on the annotated reviews",
+    )
+    r.add_argument(
+        "--annotations", type=str, default="../../data/lstudio_annotations.json"
+    )
+    r.set_defaults(run=report)
+
+    args = ap.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
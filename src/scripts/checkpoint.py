@@ -0,0 +1,120 @@
+"""append-only checkpoints for long annotation runs
+
+Every finished review is appended as one JSON line
+`{"review_id": ..., "topics": [...], "answer": "..."}` and flushed to disk right
+away, so an interrupted run can be resumed by skipping the ids that are already
+in the file.
+"""
+
+import json
+import os
+import sys
+import threading
+from collections.abc import Iterable
+
+
+class JsonlCheckpoint:
+    """JSONL checkpoint file of finished reviews
+
+    Args:
+        path: path of the checkpoint file (parent directories are created)
+        resume: keep and load an existing checkpoint instead of starting a new one
+    """
+
+    def __init__(self, path: str, resume: bool = False) -> None:
+        self.path = path
+        self._records: dict[int, dict] = {}
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if resume:
+            self._records, valid_size = self._load(path)
+            if os.path.exists(path) and os.path.getsize(path) > valid_size:
+                # drop a half written last line before appending to the file
+                os.truncate(path, valid_size)
+            print(f"resuming with {len(self._records)} reviews from '{path}'")
+        elif os.path.exists(path) and os.path.getsize(path) > 0:
+            print(f"starting new checkpoint, overwriting '{path}'", file=sys.stderr)
+        self._file = open(path, "a" if resume else "w", encoding="utf-8")
+
+    @staticmethod
+    def _load(path: str) -> tuple[dict[int, dict], int]:
+        """Reads all complete records of a checkpoint file
+
+        Lines that can not be parsed are skipped, only a last line without a
+        newline (cut off when the process got killed mid-write) is left out of
+        the valid size, so truncating to it never drops records after a bad line.
+
+        Returns:
+            the records by review id and the size in bytes up to the end of the
+            last complete line
+        """
+        records: dict[int, dict] = {}
+        valid_size = 0
+        skipped = 0
+        if not os.path.exists(path):
+            return records, valid_size
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    print(f"dropping incomplete last line of '{path}'", file=sys.stderr)
+                    break
+                valid_size += len(line)
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    records[int(record["review_id"])] = record
+                except (ValueError, KeyError, TypeError):
+                    skipped += 1
+        if skipped:
+            print(f"skipped {skipped} broken lines of '{path}'", file=sys.stderr)
+        return records, valid_size
+
+    @property
+    def done_ids(self) -> set[int]:
+        return set(self._records.keys())
+
+    def __contains__(self, review_id: int) -> bool:
+        return int(review_id) in self._records
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def results(self) -> dict[int, list[str]]:
+        """Returns the review id -> topics mapping of all checkpointed reviews"""
+        return {k: v["topics"] for k, v in self._records.items()}
+
+    def append(self, review_id: int, topics: list[str], answer: str) -> None:
+        record = {"review_id": int(review_id), "topics": topics, "answer": answer}
+        with self._lock:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._records[record["review_id"]] = record
+
+    def extend(self, records: Iterable[tuple[int, list[str], str]]) -> None:
+        """Appends many (review id, topics, answer) records with a single sync"""
+        lines = []
+        new_records = {}
+        for review_id, topics, answer in records:
+            record = {"review_id": int(review_id), "topics": topics, "answer": answer}
+            lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+            new_records[record["review_id"]] = record
+        with self._lock:
+            self._file.writelines(lines)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._records.update(new_records)
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self) -> "JsonlCheckpoint":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
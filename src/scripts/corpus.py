@@ -0,0 +1,238 @@
+"""fast loading of the review corpus
+
+Parsing `reviews_100k*.csv.bz2` means single threaded bz2 decompression plus CSV
+parsing on every script start. `load_corpus` converts the CSV once into an
+uncompressed Arrow IPC (Feather v2) file next to the source and memory maps that
+file on later loads, reading only the requested columns.
+
+Dumps that do not fit into memory are read with `iter_corpus_batches` and
+`iter_reviews` in bounded memory, `reservoir_sample` draws a uniform sample of
+such a dump in a single pass.
+
+Usage:
+    from corpus import load_corpus
+
+    reviews_df = load_corpus("../../data/reviews_100k.csv.bz2", columns=["review_id", "review"])
+"""
+
+import os
+from collections.abc import Callable, Iterator
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+# bump when the conversion changes so that old caches get rebuilt
+CACHE_VERSION = "1"
+
+
+def corpus_cache_path(path: str) -> str:
+    """Path of the Arrow cache of a corpus file (`reviews.csv.bz2` -> `reviews.arrow`)"""
+    base = path
+    for suffix in (".bz2", ".gz", ".xz", ".zip", ".csv"):
+        if base.endswith(suffix):
+            base = base[: -len(suffix)]
+    return base + ".arrow"
+
+
+def _source_signature(path: str) -> dict[bytes, bytes]:
+    stat = os.stat(path)
+    return {
+        b"corpus_cache_version": CACHE_VERSION.encode(),
+        b"source_size": str(stat.st_size).encode(),
+        b"source_mtime_ns": str(stat.st_mtime_ns).encode(),
+    }
+
+
+def _cache_is_fresh(path: str, cache: str) -> bool:
+    if not os.path.exists(cache):
+        return False
+    try:
+        with pa.memory_map(cache) as source:
+            metadata = pa.ipc.open_file(source).schema.metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return False
+    signature = _source_signature(path)
+    return all(metadata.get(k) == v for k, v in signature.items())
+
+
+def convert_corpus(path: str, cache: str | None = None) -> str:
+    """Converts a (compressed) CSV corpus into an uncompressed Arrow IPC file
+
+    The `review` column is stored as string (like every consumer used to do with
+    `.astype(str)`), the other columns keep the dtypes pandas infers.
+
+    Returns:
+        path of the written cache file
+    """
+    if cache is None:
+        cache = corpus_cache_path(path)
+    df = pd.read_csv(path, low_memory=False)
+    if "review" in df.columns:
+        df["review"] = df["review"].astype(str)
+    for col in df.columns[df.dtypes == object]:
+        # mixed object columns (e.g. str and float NaN) can not be stored as is
+        df[col] = df[col].astype("string")
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata(
+        {**(table.schema.metadata or {}), **_source_signature(path)}
+    )
+    tmp = f"{cache}.tmp-{os.getpid()}"
+    try:
+        feather.write_feather(table, tmp, compression="uncompressed")
+        os.replace(tmp, cache)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return cache
+
+
+def load_corpus(path: str, columns: list[str] | None = None) -> pd.DataFrame:
+    """Loads a review corpus, converting it to the Arrow cache on first use
+
+    Args:
+        path: path of the source CSV (may be compressed)
+        columns: columns to load [default] all columns
+
+    Returns:
+        DataFrame of the corpus
+    """
+    cache = corpus_cache_path(path)
+    if not _cache_is_fresh(path, cache):
+        print(f"converting '{path}' to '{cache}' (one time) ..")
+        convert_corpus(path, cache)
+    table = feather.read_table(cache, columns=columns, memory_map=True)
+    return table.to_pandas()
+
+
+def iter_corpus_batches(
+    path: str,
+    batch_size: int = 10_000,
+    columns: list[str] | None = None,
+    filter: Callable[[pd.DataFrame], pd.Series] | None = None,
+    sample_rate: float | None = None,
+    seed: int | None = None,
+) -> Iterator[pd.DataFrame]:
+    """Streams a corpus in batches of at most `batch_size` rows
+
+    Only one batch is held in memory at a time, so this also works for dumps
+    that do not fit into memory. If a fresh Arrow cache of the corpus exists it
+    is streamed from the memory mapped file, otherwise the CSV is parsed in
+    chunks (no cache is written).
+
+    Args:
+        path: path of the source CSV (may be compressed)
+        batch_size: rows per parsed chunk
+        columns: columns to load [default] all columns
+        filter: function that gets a batch and returns a boolean mask of the
+            rows to keep
+        sample_rate: keep every row with this probability (Bernoulli sampling)
+        seed: seed of the sampling
+
+    Yields:
+        DataFrames with the (filtered and sampled) rows of every chunk
+    """
+    rng = np.random.default_rng(seed)
+    cache = corpus_cache_path(path)
+    if _cache_is_fresh(path, cache):
+        source = pa.memory_map(cache)
+        reader = pa.ipc.open_file(source)
+        # columns of the cache that were asked for
+        names = columns if columns is not None else reader.schema.names
+
+        def chunks() -> Iterator[pd.DataFrame]:
+            try:
+                for i in range(reader.num_record_batches):
+                    batch = reader.get_batch(i).select(names)
+                    for start in range(0, batch.num_rows, batch_size):
+                        yield batch.slice(start, batch_size).to_pandas()
+            finally:
+                source.close()
+
+    else:
+
+        def chunks() -> Iterator[pd.DataFrame]:
+            with pd.read_csv(
+                path, chunksize=batch_size, usecols=columns, low_memory=False
+            ) as reader:
+                for chunk in reader:
+                    if "review" in chunk.columns:
+                        chunk["review"] = chunk["review"].astype(str)
+                    yield chunk
+
+    for chunk in chunks():
+        if filter is not None:
+            chunk = chunk[filter(chunk).to_numpy(dtype=bool)]
+        if sample_rate is not None:
+            chunk = chunk[rng.random(len(chunk)) < sample_rate]
+        if len(chunk):
+            yield chunk
+
+
+def iter_reviews(
+    path: str, id_column: str = "review_id", **kwargs
+) -> Iterator[tuple[int, str]]:
+    """Streams (review_id, review) pairs, e.g. for `OllamaClassifier.classify_stream`
+
+    Args:
+        path: path of the source CSV (may be compressed)
+        id_column: column holding the review id
+        **kwargs: see `iter_corpus_batches`
+    """
+    for batch in iter_corpus_batches(path, columns=[id_column, "review"], **kwargs):
+        yield from zip(batch[id_column].tolist(), batch["review"].tolist())
+
+
+def reservoir_sample(
+    path: str,
+    n: int,
+    columns: list[str] | None = None,
+    filter: Callable[[pd.DataFrame], pd.Series] | None = None,
+    seed: int | None = None,
+    batch_size: int = 10_000,
+) -> pd.DataFrame:
+    """Draws a uniform sample of `n` rows without replacement in one streaming pass
+
+    Every row gets a random key and the `n` rows with the smallest keys are kept
+    (bottom-k reservoir sampling), so memory is bounded by `n + batch_size` rows.
+    Replaces `DataFrame.sample(n=...)` on a fully loaded corpus.
+
+    Args:
+        path: path of the source CSV (may be compressed)
+        n: sample size, a negative number returns all (filtered) rows
+        columns: columns to load [default] all columns
+        filter: function that gets a batch and returns a boolean mask of the
+            rows to keep
+        seed: seed of the sampling
+        batch_size: rows per parsed chunk
+
+    Returns:
+        DataFrame with min(n, number of rows) rows in random order
+    """
+    rng = np.random.default_rng(seed)
+    if n < 0:
+        batches = list(iter_corpus_batches(path, batch_size, columns, filter))
+        if not batches:
+            return pd.DataFrame(columns=columns)
+        everything = pd.concat(batches, ignore_index=True)
+        return everything.iloc[rng.permutation(len(everything))].reset_index(drop=True)
+
+    reservoir: pd.DataFrame | None = None
+    keys = np.empty(0)
+    for batch in iter_corpus_batches(path, batch_size, columns, filter):
+        batch = batch.reset_index(drop=True)
+        batch_keys = rng.random(len(batch))
+        if reservoir is None:
+            reservoir, keys = batch, batch_keys
+        else:
+            reservoir = pd.concat([reservoir, batch], ignore_index=True)
+            keys = np.concatenate([keys, batch_keys])
+        if n < len(reservoir):
+            keep = np.argpartition(keys, n)[:n]
+            reservoir, keys = reservoir.iloc[keep].reset_index(drop=True), keys[keep]
+
+    if reservoir is None:
+        return pd.DataFrame(columns=columns)
+    return reservoir.iloc[np.argsort(keys)].reset_index(drop=True)
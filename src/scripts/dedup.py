@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+"""exact and near duplicate detection of reviews
+
+Steam reviews are full of copy-pasted texts. `build_index` clusters a corpus in
+one streaming pass:
+
+1. exact duplicates: reviews with the same normalized text (lower case,
+   without punctuation and repeated whitespace) share a 64 bit hash
+2. near duplicates: every distinct text gets a MinHash signature of its word
+   shingles, LSH (bands of the signature) proposes candidate pairs and pairs
+   whose estimated jaccard similarity reaches `threshold` are connected, the
+   connected components are the clusters
+
+Every cluster is represented by its first review. The `DedupIndex` is stored as
+Arrow file and used by the classification, annotation and cascade scripts
+(`--dedup`): only one review per cluster is sent to the LLM, its topics are
+copied to the other reviews of the cluster.
+
+Usage:
+    python dedup.py --corpus ../../data/reviews_100k_cleaned_new.csv.bz2 -o ../../data/reviews_dedup.arrow
+"""
+
+import hashlib
+import json
+import string
+from argparse import ArgumentParser
+from collections.abc import Iterable, Mapping, Sequence
+from itertools import chain, islice
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from checkpoint import JsonlCheckpoint
+from corpus import iter_reviews
+
+# answer stored in the checkpoint for reviews that got the topics of their cluster
+DEDUP_ANSWER = "dedup"
+
+# punctuation is replaced by spaces, str.translate is about twice as fast as a regex
+PUNCTUATION = str.maketrans({c: " " for c in string.punctuation})
+
+# combines the word hashes of a shingle
+SHINGLE_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+# shingles per chunk of the signature computation
+CHUNK_SHINGLES = 1 << 16
+
+
+def normalize(text: str) -> str:
+    return " ".join(str(text).lower().translate(PUNCTUATION).split())
+
+
+def exact_hash(normalized: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(normalized.encode(), digest_size=8).digest(), "little"
+    )
+
+
+def shingle_hashes(
+    normalized: Sequence[str], shingle_size: int = 3
+) -> tuple[np.ndarray, np.ndarray]:
+    """64 bit hashes of the word n-grams of many texts
+
+    The words of all texts are hashed at once, an n-gram hash is a combination
+    of the hashes of its words. A text with fewer words than `shingle_size` is
+    a single shingle.
+
+    Returns:
+        flat array of the shingle hashes and the number of shingles per text
+    """
+    words = [text.split() or [""] for text in normalized]
+    lengths = np.fromiter((len(w) for w in words), dtype=np.int64, count=len(words))
+    word_hashes = pd.util.hash_array(
+        np.array(list(chain.from_iterable(words)), dtype=object)
+    )
+    total = len(word_hashes)
+    doc = np.repeat(np.arange(len(words)), lengths)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+
+    shingles = word_hashes.copy()
+    with np.errstate(over="ignore"):
+        for offset in range(1, shingle_size):
+            same_text = doc[offset:] == doc[:-offset]
+            following = np.where(same_text, word_hashes[offset:], np.uint64(0))
+            shingles[: total - offset] = (
+                shingles[: total - offset] * SHINGLE_MULTIPLIER + following
+            )
+    counts = np.maximum(lengths - shingle_size + 1, 1)
+    position = np.arange(total) - starts[doc]
+    return shingles[position < counts[doc]], counts
+
+
+class MinHasher:
+    """MinHash signatures with multiply-shift hash functions, vectorized over many texts"""
+
+    def __init__(
+        self, num_perm: int = 64, shingle_size: int = 3, seed: int = 0
+    ) -> None:
+        rng = np.random.default_rng(seed)
+        self.shingle_size = shingle_size
+        # odd multipliers, (a * x + b) mod 2^64 >> 32 is a universal 32 bit hash
+        self._a = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64) * np.uint64(
+            2
+        ) + np.uint64(1)
+        self._b = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+
+    def signatures(self, normalized: Sequence[str]) -> np.ndarray:
+        """(texts, num_perm) uint32 signatures"""
+        shingles, counts = shingle_hashes(normalized, self.shingle_size)
+        ends = np.cumsum(counts)
+        res = np.empty((len(counts), len(self._a)), dtype=np.uint32)
+        # (num_perm, shingles) intermediate of at most ~32 MB per chunk
+        first = 0
+        while first < len(counts):
+            start = ends[first - 1] if first else 0
+            last = max(
+                int(np.searchsorted(ends, start + CHUNK_SHINGLES, side="right")),
+                first + 1,
+            )
+            chunk = shingles[start : ends[last - 1]]
+            with np.errstate(over="ignore"):
+                hashed = (
+                    self._a[:, None] * chunk[None, :] + self._b[:, None]
+                ) >> np.uint64(32)
+            offsets = np.concatenate([[0], ends[first : last - 1] - start])
+            res[first:last] = np.minimum.reduceat(hashed, offsets, axis=1).T
+            first = last
+        return res
+
+
+def near_duplicate_components(
+    signatures: np.ndarray, bands: int = 16, threshold: float = 0.8
+) -> np.ndarray:
+    """Connected components of the texts whose estimated jaccard similarity reaches `threshold`
+
+    Every band of the signatures puts the texts into buckets; a text is compared
+    with the first text of its bucket only, so the work is linear in the number
+    of texts.
+
+    Returns:
+        component label per text
+    """
+    n, num_perm = signatures.shape
+    if num_perm % bands:
+        raise ValueError(f"{num_perm} permutations can not be split into {bands} bands")
+    rows = num_perm // bands
+    sources, targets = [], []
+    for band in range(bands):
+        keys = np.ascontiguousarray(signatures[:, band * rows : (band + 1) * rows])
+        keys = keys.view(np.dtype((np.void, keys.dtype.itemsize * rows))).ravel()
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        partner = first[inverse]
+        candidates = np.flatnonzero(partner != np.arange(n))
+        similarity = (signatures[candidates] == signatures[partner[candidates]]).mean(
+            axis=1
+        )
+        keep = candidates[similarity >= threshold]
+        sources.append(keep)
+        targets.append(partner[keep])
+    sources = np.concatenate(sources)
+    targets = np.concatenate(targets)
+    graph = coo_matrix(
+        (np.ones(len(sources), dtype=np.int8), (sources, targets)), shape=(n, n)
+    )
+    _, labels = connected_components(graph, directed=False)
+    return labels
+
+
+class DedupIndex:
+    """Cluster of every review of a corpus
+
+    Attributes:
+        review_ids: ids of all reviews
+        representatives: id of the review that represents the cluster of every review
+        parameters: parameters the index was built with
+        stats: number of reviews, exact and near duplicates and clusters
+    """
+
+    def __init__(
+        self,
+        review_ids: np.ndarray,
+        representatives: np.ndarray,
+        parameters: Mapping[str, float],
+        stats: Mapping[str, int],
+    ) -> None:
+        self.review_ids = review_ids
+        self.representatives = representatives
+        self.parameters = dict(parameters)
+        self.stats = dict(stats)
+        self._index = pd.Index(review_ids)
+
+    def __len__(self) -> int:
+        return len(self.review_ids)
+
+    def collapse(
+        self, ids: Sequence[int], reviews: Sequence[str], done: Iterable[int] = ()
+    ) -> tuple[list[int], list[str], dict[int, int]]:
+        """Keeps the first review of every cluster among the given reviews
+
+        Reviews that are not in the index are kept.
+
+        Args:
+            ids: ids of the reviews
+            reviews: texts of the reviews
+            done: ids that already have results (e.g. from a resumed checkpoint),
+                reviews of their clusters are dropped as copies of them
+
+        Returns:
+            ids and texts of the kept reviews and the kept (or done) id of every
+            dropped review
+        """
+        done = list(done)
+        done_clusters = self._clusters(done)
+        kept_by_cluster: dict[int, int] = dict(zip(done_clusters.tolist(), done))
+        clusters = self._clusters(ids)
+        kept_ids, kept_reviews, copies = [], [], {}
+        for id, review, cluster in zip(ids, reviews, clusters.tolist()):
+            kept = kept_by_cluster.setdefault(cluster, id)
+            if kept == id:
+                kept_ids.append(id)
+                kept_reviews.append(review)
+            else:
+                copies[id] = kept
+        return kept_ids, kept_reviews, copies
+
+    def _clusters(self, ids: Sequence[int]) -> np.ndarray:
+        """Representative of every id, ids outside of the index are their own cluster"""
+        ids = np.asarray(ids, dtype=np.int64)
+        positions = self._index.get_indexer(ids)
+        return np.where(positions >= 0, self.representatives[positions], ids)
+
+    def cluster_sizes(self) -> pd.Series:
+        """Number of reviews per cluster by representative id, largest first"""
+        return pd.Series(self.representatives).value_counts()
+
+    def save(self, path: str) -> None:
+        table = pa.table(
+            {"review_id": self.review_ids, "representative": self.representatives}
+        )
+        metadata = {
+            b"dedup_parameters": json.dumps(self.parameters).encode(),
+            b"dedup_stats": json.dumps(self.stats).encode(),
+        }
+        feather.write_feather(
+            table.replace_schema_metadata(metadata), path, compression="uncompressed"
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "DedupIndex":
+        table = feather.read_table(path)
+        metadata = table.schema.metadata or {}
+        return cls(
+            table["review_id"].to_numpy(),
+            table["representative"].to_numpy(),
+            json.loads(metadata.get(b"dedup_parameters", b"{}")),
+            json.loads(metadata.get(b"dedup_stats", b"{}")),
+        )
+
+
+def build_index(
+    items: Iterable[tuple[int, str]],
+    num_perm: int = 64,
+    bands: int = 16,
+    threshold: float = 0.8,
+    shingle_size: int = 3,
+    seed: int = 0,
+    batch_size: int = 10_000,
+) -> DedupIndex:
+    """Clusters a stream of (review id, text) pairs into exact and near duplicates
+
+    Only the first review of every distinct normalized text gets a signature,
+    memory is 8 bytes per review plus `num_perm * 4` bytes per distinct text.
+    """
+    hasher = MinHasher(num_perm, shingle_size, seed)
+    ids: list[int] = []
+    distinct: list[int] = []
+    first_of_hash: dict[int, int] = {}
+    signatures = []
+    items = iter(items)
+    while batch := list(islice(items, batch_size)):
+        new_texts = []
+        for id, text in batch:
+            normalized = normalize(text)
+            h = exact_hash(normalized)
+            if h not in first_of_hash:
+                first_of_hash[h] = len(first_of_hash)
+                new_texts.append(normalized)
+            ids.append(id)
+            distinct.append(first_of_hash[h])
+        if new_texts:
+            signatures.append(hasher.signatures(new_texts))
+
+    review_ids = np.asarray(ids, dtype=np.int64)
+    if not ids:
+        return DedupIndex(review_ids, review_ids.copy(), {}, {})
+    components = near_duplicate_components(np.vstack(signatures), bands, threshold)
+    cluster = components[np.asarray(distinct)]
+    # the first review of a cluster represents it
+    _, first, inverse = np.unique(cluster, return_index=True, return_inverse=True)
+    representatives = review_ids[first[inverse]]
+
+    stats = {
+        "reviews": len(ids),
+        "exact_duplicates": len(ids) - len(first_of_hash),
+        "near_duplicates": len(first_of_hash) - len(first),
+        "clusters": len(first),
+    }
+    parameters = {
+        "num_perm": num_perm,
+        "bands": bands,
+        "threshold": threshold,
+        "shingle_size": shingle_size,
+        "seed": seed,
+    }
+    return DedupIndex(review_ids, representatives, parameters, stats)
+
+
+def fan_out(
+    results: Mapping[int, list[str]], copies: Mapping[int, int]
+) -> dict[int, list[str]]:
+    """Copies the topics of the kept reviews to the reviews that were dropped by `collapse`"""
+    res = dict(results)
+    res.update({id: results[kept] for id, kept in copies.items() if kept in results})
+    return res
+
+
+def checkpoint_copies(checkpoint: JsonlCheckpoint, copies: Mapping[int, int]) -> int:
+    """Writes the copies whose kept review is in the checkpoint into it (answer "dedup")
+
+    A resumed run then has the copies of an interrupted run without the `copies`
+    of that run.
+
+    Returns:
+        number of written copies
+    """
+    results = checkpoint.results()
+    records = [
+        (id, results[kept], DEDUP_ANSWER)
+        for id, kept in copies.items()
+        if kept in results and id not in checkpoint
+    ]
+    checkpoint.extend(records)
+    return len(records)
+
+
+def collapse_reviews(
+    path: str, ids: Sequence[int], reviews: Sequence[str], done: Iterable[int] = ()
+) -> tuple[list[int], list[str], dict[int, int]]:
+    """`DedupIndex.collapse` with the index at `path`, printing the saved share"""
+    kept_ids, kept_reviews, copies = DedupIndex.load(path).collapse(ids, reviews, done)
+    print(
+        f"dedup: {len(kept_ids)} of {len(ids)} reviews are classified "
+        f"({len(copies) / max(len(ids), 1):.1%} of the requests saved)"
+    )
+    return kept_ids, kept_reviews, copies
+
+
+def main():
+    ap = ArgumentParser()
+    ap.add_argument(
+        "--corpus", type=str, required=True, help="corpus CSV with review_id and review"
+    )
+    ap.add_argument("-o", "--out", type=str, required=True, help="index file (Arrow)")
+    ap.add_argument(
+        "--threshold",
+        type=float,
+        default=0.8,
+        help="jaccard similarity of near duplicates",
+    )
+    ap.add_argument("--num-perm", type=int, default=64)
+    ap.add_argument("--bands", type=int, default=16)
+    ap.add_argument("--shingle-size", type=int, default=3, help="words per shingle")
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+
+    index = build_index(
+        iter_reviews(args.corpus),
+        num_perm=args.num_perm,
+        bands=args.bands,
+        threshold=args.threshold,
+        shingle_size=args.shingle_size,
+        seed=args.seed,
+    )
+    index.save(args.out)
+    stats = index.stats
+    print(
+        f"{stats['reviews']} reviews, {stats['exact_duplicates']} exact and "
+        f"{stats['near_duplicates']} near duplicates in {stats['clusters']} clusters: "
+        f"{1 - stats['clusters'] / max(stats['reviews'], 1):.1%} of the LLM requests saved"
+    )
+    print(f"largest clusters:\n{index.cluster_sizes().head(10).to_string()}")
+    print(f"index in {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,18 @@ from argparse import ArgumentParser
 from datetime import datetime
 from sys import stderr
 
-from multilabel_classification_evaluator import MultiLabelEvaluator
-from ollama_topic_classification import Model
-from sklearn.metrics import accuracy_score, hamming_loss
-from sklearn.preprocessing import MultiLabelBinarizer
+from agreement import (
+    agreement_report,
+    align,
+    krippendorff_alpha,
+    load_results,
+    pairwise_exact_match,
+    pairwise_kappa,
+    pairwise_label_agreement,
+)
+from bootstrap import confidence_intervals, paired_matrices, paired_test
+from multilabel_classification_evaluator import MultiLabelEvaluator, annotation_labels
+from ollama_topic_classification import DEFAULT_TOPICS, Model
 
 JSON_PATH = "../../data/lstudio_annotations.json"
 JSON_MIN_PATH = "../../data/lstudio_min_annotations.json"
@@ -15,6 +23,13 @@ def setup_args():
     ap = ArgumentParser()
     ap.add_argument("-f", "--file", type=str, help="File to evaluate")
     ap.add_argument("-f2", "--file2", type=str, help="optional file two if you want to compare one eval with another")
+    ap.add_argument("--ci", action="store_true", help="bootstrap confidence intervals of micro/macro F1 and jaccard")
+    ap.add_argument("--significance", action="store_true", help="paired bootstrap and permutation test of file2 against file (needs -f2)")
+    ap.add_argument("--resamples", type=int, default=2000, help="bootstrap resamples and permutations [default] 2000")
+    ap.add_argument("--confidence", type=float, default=0.95, help="confidence level of the intervals [default] 0.95")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--agreement", type=str, nargs="+", default=None, help="pairwise agreement and krippendorff's alpha of these result files")
+    ap.add_argument("--missing", choices=["pairwise", "common", "empty"], default="pairwise", help="how --agreement handles reviews some files have no answer for")
 
     return ap.parse_args()
 
@@ -31,50 +46,82 @@ def model_v_model(file: str, file2: str):
     model1 = get_model(file)
     model2 = get_model(file2)
 
-    with open(file, "r") as f:
-        data1 = json.load(f)
-
-    with open(file2, "r") as f:
-        data2 = json.load(f)
-
-    # evaluate accuracy_score and hamming_loss for the both the models
-    evaluator = MultiLabelBinarizer(classes=[
-            "gamemode",
-            "bugs",
-            "visuals",
-            "sound",
-            "hardware_requirements",
-            "price",
-            "gameplay",
-            "story",
-            "support",
-            "online_play",
-            "updates",
-            "seasonal_content",
-        ])
-
-    bin1 = evaluator.fit_transform([data1[key] for key in data1.keys()])
-    bin2 = evaluator.transform([data2[key] for key in data2.keys()])
-
-    acc1 = accuracy_score(bin1, bin2)
-    ham1 = hamming_loss(bin1, bin2)
-
-    same_count = 0
-    total = 0
-    for key in data1.keys():
-        if sorted(data1[key]) == sorted(data2[key]):
-            same_count += 1
-        total += 1
+    data1 = load_results(file)
+    data2 = load_results(file2)
+
+    # aligned by review id, reviews only one of the files has are counted and left out
+    aligned = align(
+        [data1, data2], names=[model1, model2], categories=DEFAULT_TOPICS, missing="common"
+    )
+    total = len(aligned.review_ids)
+    accuracy = float(pairwise_exact_match(aligned).iloc[0, 1])
+    result = {
+        "total": total,
+        "same_count": round(accuracy * total),
+        "accuracy": accuracy,
+        "hamming_loss": 1 - float(pairwise_label_agreement(aligned).iloc[0, 1]),
+        "only_in_file": len(data1.keys() - data2.keys()),
+        "only_in_file2": len(data2.keys() - data1.keys()),
+        "mean_kappa": float(pairwise_kappa(aligned).iloc[0, 1]),
+        "krippendorff_alpha": float(krippendorff_alpha(aligned)["all topics"]),
+    }
 
     json_file = f"./eval/eval_{model1}_vs_{model2}_{datetime.now().isoformat().replace(":", "_")}.json"
     with open(json_file, "w") as f:
-        f.write(json.dumps({"total": total, "same_count": same_count, "accuracy": acc1, "hamming_loss": ham1}))
-    print({"total": total, "same_count": same_count, "accuracy": acc1, "hamming_loss": ham1})
+        f.write(json.dumps(result))
+    print(result)
+
+
+def agreement(files: list[str], missing: str):
+    """Agreement tables of all pairs of the result files and the alpha of all of them"""
+    aligned = align(
+        [load_results(file) for file in files],
+        names=[f"{i}:{get_model(file)}" for i, file in enumerate(files)],
+        categories=DEFAULT_TOPICS,
+        missing=missing,
+    )
+    print(f"{len(aligned.review_ids)} reviews, missing policy {missing}")
+    report = agreement_report(aligned)
+    for name, table in report.items():
+        print(f"\n{name}\n{table.round(3).to_string()}")
+    json_file = f"./eval/agreement_{len(files)}_files_{datetime.now().isoformat().replace(":", "_")}.json"
+    with open(json_file, "w") as f:
+        json.dump({"files": files, **{k: json.loads(v.to_json()) for k, v in report.items()}}, f)
+
+
+def significance(file: str, file2: str, args):
+    """Paired test whether the results of file2 are better than the ones of file against the annotations"""
+    with open(JSON_PATH, "r", encoding="utf-8") as f:
+        true_labels, _ = annotation_labels(json.load(f))
+    preds = []
+    for name in (file, file2):
+        with open(name, "r") as f:
+            preds.append({int(k): v for k, v in json.load(f).items()})
+
+    true_matrix, pred_a, pred_b = paired_matrices(true_labels, *preds)
+    df = paired_test(
+        true_matrix,
+        pred_a,
+        pred_b,
+        resamples=args.resamples,
+        permutations=args.resamples,
+        confidence=args.confidence,
+        seed=args.seed,
+    )
+    print(f"A: {file}\nB: {file2}")
+    print(df.to_string())
+    json_file = f"./eval/significance_{get_model(file)}_vs_{get_model(file2)}_{datetime.now().isoformat().replace(":", "_")}.json"
+    with open(json_file, "w") as f:
+        f.write(df.to_json())
 
 
 def main():
     args = setup_args()
-    if args.file2:
+    if args.agreement:
+        agreement(args.agreement, args.missing)
+    elif args.file2 and args.significance:
+        significance(args.file, args.file2, args)
+    elif args.file2:
         model_v_model(args.file, args.file2)
     else:
         evaluator = MultiLabelEvaluator(JSON_PATH , args.file)
@@ -88,6 +135,17 @@ def main():
             exit(1)
         with open(json_file, "w") as f:
             f.write(json)
+        if args.ci:
+            ci = confidence_intervals(
+                evaluator.true_matrix,
+                evaluator.pred_matrix,
+                resamples=args.resamples,
+                confidence=args.confidence,
+                seed=args.seed,
+            )
+            print(ci.to_string())
+            with open(json_file.removesuffix(".json") + "_ci.json", "w") as f:
+                f.write(ci.to_json())
 
 
 if __name__ == "__main__":
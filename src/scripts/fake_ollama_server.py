@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""minimal fake ollama HTTP server
+
+Answers `/api/chat` like an ollama server would (also streamed), but with a
+canned answer and an artificial latency. It is meant to exercise the request engine of the
+`OllamaClassifier` (concurrency, timeouts, retries) without a GPU.
+
+Usage:
+    python fake_ollama_server.py --port 11435 --latency 0.2
+
+    from fake_ollama_server import FakeOllamaServer
+    with FakeOllamaServer(latency=0.1) as server:
+        client = Client(host=server.host)
+"""
+
+import json
+import threading
+import time
+from argparse import ArgumentParser
+from collections.abc import Callable
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_ANSWER = 'predicted_topics: ["Gameplay"]'
+
+
+class FakeOllamaServer:
+    """Fake ollama server running in a background thread
+
+    Args:
+        answer: fixed answer or a function that gets the chat messages and
+            returns the answer
+        latency: seconds every chat request takes
+        fail_every: every n-th chat request fails with a 500 (0 => never)
+        host: interface to bind to
+        port: port to bind to (0 => random free port)
+    """
+
+    def __init__(
+        self,
+        answer: str | Callable[[list[dict]], str] = DEFAULT_ANSWER,
+        latency: float = 0.0,
+        fail_every: int = 0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ) -> None:
+        self.answer = answer
+        self.latency = latency
+        self.fail_every = fail_every
+        self.requests = 0
+        # bodies of all chat requests, e.g. to check the messages that were sent
+        self.received: list[dict] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def host(self) -> str:
+        address, port = self._server.server_address[:2]
+        return f"http://{address}:{port}"
+
+    def start(self) -> "FakeOllamaServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> "FakeOllamaServer":
+        return self.start()
+
+    def __exit__(self, *_) -> None:
+        self.stop()
+
+    def _answer_for(self, messages: list[dict]) -> str:
+        if callable(self.answer):
+            return self.answer(messages)
+        return self.answer
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status: int, body: dict) -> None:
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path in ("/api/tags", "/api/ps"):
+                    self._send_json(200, {"models": []})
+                else:
+                    self._send_json(200, {})
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.end_headers()
+
+            def _send_stream(self, chunks: list[dict], delay: float) -> None:
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.end_headers()
+                for chunk in chunks:
+                    self.wfile.write(json.dumps(chunk).encode("utf-8") + b"\n")
+                    self.wfile.flush()
+                    time.sleep(delay)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                if self.path != "/api/chat":
+                    self._send_json(
+                        200, {"model": request.get("model", ""), "done": True}
+                    )
+                    return
+
+                with server._lock:
+                    server.received.append(request)
+                    server.requests += 1
+                    number = server.requests
+                    server.in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+                try:
+                    stream = request.get("stream", False)
+                    # a streamed answer spends half of the latency before the first
+                    # token ("prefill") and the rest between the tokens
+                    time.sleep(server.latency / 2 if stream else server.latency)
+                    if server.fail_every and number % server.fail_every == 0:
+                        self._send_json(500, {"error": "fake failure"})
+                        return
+                    content = server._answer_for(request.get("messages", []))
+                    pieces = [f"{word} " for word in content.split(" ")]
+                    pieces[-1] = pieces[-1][:-1]
+                    prefill = int(server.latency / 2 * 1e9)
+                    final = {
+                        "model": request.get("model", ""),
+                        "created_at": datetime.now(timezone.utc).isoformat(),
+                        "message": {"role": "assistant", "content": content},
+                        "done": True,
+                        "done_reason": "stop",
+                        "total_duration": int(server.latency * 1e9),
+                        "load_duration": 0,
+                        "prompt_eval_count": sum(
+                            len(str(m.get("content", "")).split())
+                            for m in request.get("messages", [])
+                        ),
+                        "prompt_eval_duration": prefill,
+                        "eval_count": len(pieces),
+                        "eval_duration": int(server.latency * 1e9) - prefill,
+                    }
+                    if not stream:
+                        self._send_json(200, final)
+                        return
+                    chunks = [
+                        {
+                            "model": final["model"],
+                            "created_at": final["created_at"],
+                            "message": {"role": "assistant", "content": piece},
+                            "done": False,
+                        }
+                        for piece in pieces
+                    ]
+                    chunks.append(
+                        {**final, "message": {"role": "assistant", "content": ""}}
+                    )
+                    self._send_stream(chunks, server.latency / 2 / len(chunks))
+                finally:
+                    with server._lock:
+                        server.in_flight -= 1
+
+        return Handler
+
+
+def main():
+    ap = ArgumentParser()
+    ap.add_argument("-p", "--port", type=int, default=11435)
+    ap.add_argument("-l", "--latency", type=float, default=0.1)
+    ap.add_argument("-a", "--answer", type=str, default=DEFAULT_ANSWER)
+    ap.add_argument("--fail-every", type=int, default=0)
+    args = ap.parse_args()
+
+    server = FakeOllamaServer(
+        answer=args.answer,
+        latency=args.latency,
+        fail_every=args.fail_every,
+        port=args.port,
+    )
+    print(f"fake ollama listening on {server.host}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
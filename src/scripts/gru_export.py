@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""CPU inference variants of the GRU classifiers: export, parity check and benchmark
+
+`export` writes the TorchScript files of the float model and of its int8
+dynamic quantization (`nn.GRU` and `nn.Linear`, the embedding stays float)
+next to the float weights, e.g. `gru_classifier.ts.pt` and
+`gru_classifier.int8.ts.pt`. The files contain the architecture, so they load
+without the `GRUClassifier` class (`torch.jit.load` or
+`GRUPredictor.load(..., variant="int8-torchscript")`).
+
+`parity` compares the probabilities of every variant with the float model on
+the annotated reviews and fails if the TorchScript float model deviates by more
+than `--float-tolerance` or an int8 variant changes more than
+`--max-flipped` of the decisions at 0.5.
+
+`bench` reports the model size, the median latency per batch size and the
+throughput on all reviews of every variant.
+
+Usage:
+    python gru_export.py export -m ../../models/gru_classifier.pth
+    python gru_export.py parity -m ../../models/gru_classifier.pth
+    python gru_export.py bench -m ../../models/gru_classifier.pth --batch-sizes 1 8 32 128 512
+"""
+
+import io
+import json
+import os
+import time
+from argparse import ArgumentParser
+from collections.abc import Sequence
+
+import numpy as np
+import pandas as pd
+import torch
+
+from gru_classifier import (
+    DEFAULT_MODEL_PATH,
+    DEFAULT_TOKENIZER_PATH,
+    TORCHSCRIPT_SUFFIXES,
+    VARIANTS,
+    GRUPredictor,
+    load_model,
+    variant_path,
+)
+
+
+def export(model_path: str) -> dict[str, str]:
+    """Writes the TorchScript variants of the model next to its float weights
+
+    Returns:
+        path of every exported variant
+    """
+    paths = {}
+    for variant in TORCHSCRIPT_SUFFIXES:
+        # "int8-torchscript" scripts the int8 model, "torchscript" the float one
+        eager = "int8" if variant.startswith("int8") else "float"
+        scripted = torch.jit.script(load_model(model_path, eager))
+        paths[variant] = variant_path(model_path, variant)
+        torch.jit.save(scripted, paths[variant])
+    return paths
+
+
+def model_size(model_path: str, variant: str) -> int:
+    """Bytes of the serialized variant (the file on disk where there is one)"""
+    if variant == "float":
+        return os.path.getsize(model_path)
+    if variant in TORCHSCRIPT_SUFFIXES:
+        return os.path.getsize(variant_path(model_path, variant))
+    buffer = io.BytesIO()
+    torch.save(load_model(model_path, variant).state_dict(), buffer)
+    return buffer.tell()
+
+
+def parity(reference: np.ndarray, probabilities: np.ndarray) -> dict[str, float]:
+    """Deviation of the probabilities of a variant from the float model"""
+    diff = np.abs(probabilities - reference)
+    return {
+        "max abs diff": float(diff.max()),
+        "mean abs diff": float(diff.mean()),
+        "flipped": float(np.mean((probabilities >= 0.5) != (reference >= 0.5))),
+    }
+
+
+def latency(
+    predictor: GRUPredictor, texts: Sequence[str], batch_size: int, repeats: int
+) -> float:
+    """Median seconds of one `predict` call with `batch_size` reviews"""
+    predictor.batch_size = max(batch_size, 1)
+    batches = [
+        (texts[start:] + texts)[:batch_size]
+        for start in range(0, repeats * batch_size, batch_size)
+    ]
+    predictor.predict(batches[0])
+    seconds = []
+    for batch in batches:
+        start = time.perf_counter()
+        predictor.predict(batch)
+        seconds.append(time.perf_counter() - start)
+    return float(np.median(seconds))
+
+
+def load_texts(annotations: str) -> list[str]:
+    with open(annotations, "r", encoding="utf-8") as f:
+        return [task["data"]["review"] for task in json.load(f)]
+
+
+def available_variants(model_path: str) -> list[str]:
+    return [
+        v
+        for v in VARIANTS
+        if v not in TORCHSCRIPT_SUFFIXES or os.path.exists(variant_path(model_path, v))
+    ]
+
+
+def check_parity(args) -> None:
+    texts = load_texts(args.annotations)
+    float_probabilities = GRUPredictor.load(args.model, args.tokenizer).predict(texts)
+    failed = []
+    rows = {}
+    for variant in available_variants(args.model)[1:]:
+        probabilities = GRUPredictor.load(args.model, args.tokenizer, variant).predict(
+            texts
+        )
+        rows[variant] = parity(float_probabilities, probabilities)
+        if variant.startswith("int8"):
+            ok = rows[variant]["flipped"] <= args.max_flipped
+        else:
+            ok = rows[variant]["max abs diff"] <= args.float_tolerance
+        if not ok:
+            failed.append(variant)
+    print(f"parity with the float model on {len(texts)} reviews")
+    print(pd.DataFrame(rows).transpose().to_string())
+    if failed:
+        raise AssertionError(f"variants out of tolerance: {', '.join(failed)}")
+    print("all variants within tolerance")
+
+
+def bench(args) -> None:
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    texts = load_texts(args.annotations)
+    # enough reviews for the largest batch, the throughput is measured on all of them
+    texts = (texts * (max(args.batch_sizes) // len(texts) + 1))[
+        : max(len(texts), max(args.batch_sizes))
+    ]
+    rows = {}
+    for variant in available_variants(args.model):
+        predictor = GRUPredictor.load(args.model, args.tokenizer, variant)
+        row = {"size MB": model_size(args.model, variant) / 1e6}
+        for batch_size in args.batch_sizes:
+            row[f"ms @ {batch_size}"] = (
+                latency(predictor, texts, batch_size, args.repeats) * 1000
+            )
+        predictor.batch_size = 256
+        start = time.perf_counter()
+        predictor.predict(texts)
+        row["reviews/sec"] = len(texts) / (time.perf_counter() - start)
+        rows[variant] = row
+    table = pd.DataFrame(rows).transpose()
+    table["speedup"] = table["reviews/sec"] / table.loc["float", "reviews/sec"]
+    print(f"{len(texts)} reviews, {torch.get_num_threads()} threads")
+    print(table.round(2).to_string())
+
+
+def main():
+    ap = ArgumentParser()
+    sub = ap.add_subparsers(dest="command", required=True)
+    e = sub.add_parser(
+        "export", help="write the TorchScript variants next to the weights"
+    )
+    p = sub.add_parser("parity", help="compare every variant with the float model")
+    b = sub.add_parser(
+        "bench", help="size, latency per batch size and throughput of every variant"
+    )
+    for s in (e, p, b):
+        s.add_argument("-m", "--model", type=str, default=DEFAULT_MODEL_PATH)
+    for s in (p, b):
+        s.add_argument("-t", "--tokenizer", type=str, default=DEFAULT_TOKENIZER_PATH)
+        s.add_argument(
+            "--annotations",
+            type=str,
+            default="../../data/lstudio_annotations.json",
+            help="reviews to run on",
+        )
+    p.add_argument(
+        "--float-tolerance",
+        type=float,
+        default=1e-5,
+        help="max abs diff of the float TorchScript model",
+    )
+    p.add_argument(
+        "--max-flipped",
+        type=float,
+        default=0.02,
+        help="max share of decisions an int8 variant may change",
+    )
+    b.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 128, 512])
+    b.add_argument(
+        "--repeats", type=int, default=20, help="timed predict calls per batch size"
+    )
+    b.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="torch threads [default] torch default",
+    )
+
+    args = ap.parse_args()
+    if args.command == "export":
+        for variant, path in export(args.model).items():
+            print(f"{variant}: {path} ({os.path.getsize(path) / 1e6:.2f} MB)")
+    elif args.command == "parity":
+        check_parity(args)
+    else:
+        bench(args)
+
+
+if __name__ == "__main__":
+    main()
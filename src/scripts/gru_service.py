@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""local HTTP service for the GRU classifiers with micro-batching
+
+Every request is put into a queue. A single worker thread takes the first
+waiting request, collects more requests for at most `--max-wait` ms (or until
+`--max-batch` reviews are together) and runs one `GRUPredictor.predict` call
+for all of them, so many small concurrent requests share one forward pass.
+
+Endpoints:
+    POST /predict  {"reviews": ["...", ...]} -> {"probabilities": [[p, ...], ...], "labels": [...]}
+    GET  /health   number of requests, reviews and forward passes so far
+
+Usage:
+    python gru_service.py serve -m ../../models/gru_classifier.pth --port 8765 --variant int8
+    python gru_service.py bench --clients 32 --reviews-per-request 4
+"""
+
+import http.client
+import json
+import queue
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from gru_classifier import (
+    DEFAULT_MODEL_PATH,
+    DEFAULT_TOKENIZER_PATH,
+    VARIANTS,
+    GRUPredictor,
+)
+
+
+class MicroBatcher:
+    """Collects the reviews of concurrent requests into shared forward passes
+
+    Args:
+        predictor: predictor running the forward passes
+        max_batch: maximum number of reviews per forward pass
+        max_wait: seconds to wait for more requests after the first one
+    """
+
+    def __init__(
+        self, predictor: GRUPredictor, max_batch: int = 1024, max_wait: float = 0.005
+    ) -> None:
+        self.predictor = predictor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = 0
+        self.reviews = 0
+        self.batches = 0
+        self._queue: queue.Queue[tuple[list[str], Future] | None] = queue.Queue()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> "MicroBatcher":
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join()
+
+    def submit(self, reviews: list[str]) -> Future:
+        """Queues the reviews of one request, the future resolves to their probabilities"""
+        future = Future()
+        self._queue.put((reviews, future))
+        return future
+
+    def predict(self, reviews: list[str]) -> np.ndarray:
+        return self.submit(reviews).result()
+
+    def _collect(self, first: tuple[list[str], Future]) -> tuple[list, bool]:
+        pending = [first]
+        size = len(first[0])
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                return pending, True
+            pending.append(item)
+            size += len(item[0])
+        return pending, False
+
+    def _run(self) -> None:
+        stopped = False
+        while not stopped:
+            first = self._queue.get()
+            if first is None:
+                return
+            pending, stopped = self._collect(first)
+            reviews = [review for request, _ in pending for review in request]
+            try:
+                probabilities = self.predictor.predict(reviews)
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            self.requests += len(pending)
+            self.reviews += len(reviews)
+            self.batches += 1
+            start = 0
+            for request, future in pending:
+                future.set_result(probabilities[start : start + len(request)])
+                start += len(request)
+
+
+class GRUService:
+    """HTTP server in front of a `MicroBatcher`, running in a background thread
+
+    Args:
+        batcher: micro-batcher running the forward passes
+        host: interface to bind to
+        port: port to bind to (0 => random free port)
+    """
+
+    def __init__(
+        self, batcher: MicroBatcher, host: str = "127.0.0.1", port: int = 8765
+    ) -> None:
+        self.batcher = batcher
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def host(self) -> str:
+        address, port = self._server.server_address[:2]
+        return f"http://{address}:{port}"
+
+    def start(self) -> "GRUService":
+        self.batcher.start()
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+        self.batcher.stop()
+
+    def __enter__(self) -> "GRUService":
+        return self.start()
+
+    def __exit__(self, *_) -> None:
+        self.stop()
+
+    def _make_handler(self):
+        batcher = self.batcher
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, clients send many small requests
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status: int, body: dict) -> None:
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path != "/health":
+                    self._send_json(404, {"error": f"unknown path {self.path}"})
+                    return
+                self._send_json(
+                    200,
+                    {
+                        "status": "ok",
+                        "requests": batcher.requests,
+                        "reviews": batcher.reviews,
+                        "batches": batcher.batches,
+                    },
+                )
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                if self.path != "/predict":
+                    self._send_json(404, {"error": f"unknown path {self.path}"})
+                    return
+                try:
+                    reviews = json.loads(body or b"{}")["reviews"]
+                    if not isinstance(reviews, list):
+                        raise TypeError("reviews has to be a list")
+                except (ValueError, KeyError, TypeError) as e:
+                    self._send_json(
+                        400, {"error": f'expected {{"reviews": [...]}}: {e}'}
+                    )
+                    return
+                try:
+                    probabilities = batcher.predict([str(r) for r in reviews])
+                except Exception as e:
+                    self._send_json(500, {"error": str(e)})
+                    return
+                self._send_json(
+                    200,
+                    {
+                        "probabilities": probabilities.tolist(),
+                        "labels": batcher.predictor.labels,
+                    },
+                )
+
+        return Handler
+
+
+def make_predictor(args) -> GRUPredictor:
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    labels = None
+    if args.labels:
+        with open(args.labels, "r", encoding="utf-8") as f:
+            labels = json.load(f)
+    return GRUPredictor.load(
+        args.model,
+        args.tokenizer,
+        variant=args.variant,
+        max_len=args.max_len,
+        batch_size=args.batch_size,
+        pad_to_max_len=args.pad_to_max_len,
+        labels=labels,
+    )
+
+
+def serve(args) -> None:
+    batcher = MicroBatcher(make_predictor(args), args.max_batch, args.max_wait / 1000)
+    service = GRUService(batcher, args.host, args.port)
+    print(f"GRU service listening on {service.host}")
+    batcher.start()
+    try:
+        service._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service._server.server_close()
+        batcher.stop()
+
+
+def bench(args) -> None:
+    """Starts the service on a random port and sends requests from concurrent clients"""
+    with open(args.annotations, "r", encoding="utf-8") as f:
+        texts = [task["data"]["review"] for task in json.load(f)]
+    batcher = MicroBatcher(make_predictor(args), args.max_batch, args.max_wait / 1000)
+    k = args.reviews_per_request
+
+    def client(number: int) -> list[float]:
+        latencies = []
+        conn = http.client.HTTPConnection(*service._server.server_address[:2])
+        try:
+            for i in range(args.requests):
+                start = (number * args.requests + i) * k % len(texts)
+                body = json.dumps({"reviews": (texts[start:] + texts)[:k]})
+                sent = time.perf_counter()
+                conn.request(
+                    "POST", "/predict", body, {"Content-Type": "application/json"}
+                )
+                response = conn.getresponse()
+                json.loads(response.read())
+                if response.status != 200:
+                    raise RuntimeError(f"request failed with {response.status}")
+                latencies.append(time.perf_counter() - sent)
+        finally:
+            conn.close()
+        return latencies
+
+    with GRUService(batcher, port=0) as service:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.clients) as executor:
+            latencies = [
+                l for ls in executor.map(client, range(args.clients)) for l in ls
+            ]
+        seconds = time.perf_counter() - start
+    reviews = len(latencies) * k
+    print(
+        f"{args.clients} clients x {args.requests} requests of {k} reviews: "
+        f"{reviews / seconds:.0f} reviews/sec, {batcher.batches} forward passes "
+        f"({batcher.reviews / max(batcher.batches, 1):.1f} reviews each), latency "
+        f"p50 {np.percentile(latencies, 50) * 1000:.1f}ms p99 {np.percentile(latencies, 99) * 1000:.1f}ms"
+    )
+
+
+def main():
+    ap = ArgumentParser()
+    sub = ap.add_subparsers(dest="command", required=True)
+    parsers = [
+        sub.add_parser("serve", help="run the service"),
+        sub.add_parser("bench", help="measure the throughput with concurrent clients"),
+    ]
+    for p in parsers:
+        p.add_argument("-m", "--model", type=str, default=DEFAULT_MODEL_PATH)
+        p.add_argument("-t", "--tokenizer", type=str, default=DEFAULT_TOKENIZER_PATH)
+        p.add_argument(
+            "--variant",
+            choices=VARIANTS,
+            default="float",
+            help="model variant, see gru_export.py",
+        )
+        p.add_argument(
+            "--labels",
+            type=str,
+            default=None,
+            help="json list with the name of every output",
+        )
+        p.add_argument("--max-len", type=int, default=200)
+        p.add_argument(
+            "--batch-size",
+            type=int,
+            default=256,
+            help="reviews per forward pass of the predictor",
+        )
+        p.add_argument(
+            "--pad-to-max-len",
+            action="store_true",
+            default=False,
+            help="pad like the notebooks instead of packing",
+        )
+        p.add_argument(
+            "--max-batch",
+            type=int,
+            default=1024,
+            help="maximum reviews collected per micro-batch",
+        )
+        p.add_argument(
+            "--max-wait",
+            type=float,
+            default=5.0,
+            help="ms to collect requests for a micro-batch",
+        )
+        p.add_argument(
+            "--threads",
+            type=int,
+            default=None,
+            help="torch threads [default] torch default",
+        )
+    parsers[0].add_argument("--host", type=str, default="127.0.0.1")
+    parsers[0].add_argument("-p", "--port", type=int, default=8765)
+    parsers[0].set_defaults(run=serve)
+    parsers[1].add_argument(
+        "--annotations",
+        type=str,
+        default="../../data/lstudio_annotations.json",
+        help="reviews to send",
+    )
+    parsers[1].add_argument("--clients", type=int, default=32)
+    parsers[1].add_argument(
+        "--requests", type=int, default=100, help="requests per client"
+    )
+    parsers[1].add_argument("--reviews-per-request", type=int, default=4)
+    parsers[1].set_defaults(run=bench)
+
+    args = ap.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,7 @@ This is a little scripts that helps with classifying topics by hand and/or
 generating topics by reading some topics by hand.
 
 Installation:
-pip/conda install pandas termcolor
+pip/conda install pandas pyarrow termcolor
 """
 
 import signal
@@ -14,9 +14,11 @@ from datetime import datetime
 from logging import getLogger
 from textwrap import wrap
 
-from pandas import DataFrame, Series, read_csv
+from pandas import DataFrame, Series
 from termcolor import colored
 
+from corpus import reservoir_sample
+
 logger = getLogger(__name__)
 
 TOPICS = []
@@ -39,9 +41,7 @@ def eval_topics(topics):
 
 def classification_main(samplesize: int):
     file = "reviews_100k_raw.csv.bz2"
-    csv: DataFrame = read_csv(file, compression="bz2", low_memory=False)
-
-    sample: DataFrame = csv.sample(n=samplesize)
+    sample: DataFrame = reservoir_sample(file, samplesize)
     res = []
 
     def handle_interrupt():
@@ -80,9 +80,7 @@ def classification_main(samplesize: int):
 def identification_main(samplesize: int):
     # read csv
     file = "reviews_100k_raw.csv.bz2"
-    csv: DataFrame = read_csv(file, compression="bz2", low_memory=False)
-
-    sample: DataFrame = csv.sample(n=samplesize)
+    sample: DataFrame = reservoir_sample(file, samplesize)
     res = []
 
     def handle_interrupt():
@@ -0,0 +1,188 @@
+"""per request metrics of the ollama classification runs
+
+Every chat request of the `OllamaClassifier` is recorded as a `RequestMetrics`
+with the wall time and the token counts and durations ollama reports in its
+response. `MetricsRecorder.summary` aggregates them into latency percentiles,
+throughput, error rate and cost numbers, `MetricsRecorder.write` stores the
+summary as sidecar JSON next to the results of a run.
+"""
+
+import json
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Any
+
+import numpy as np
+from ollama import ChatResponse
+
+NS_PER_SECOND = 1e9
+
+
+@dataclass
+class RequestMetrics:
+    """Metrics of one chat request
+
+    Durations are in seconds, token counts as reported by ollama (0 for cached
+    answers and failed requests). `prompt_duration` is the prefill and
+    `eval_duration` the decoding time of the server, `ttft` the time to the first
+    token (only known for streamed requests).
+    """
+
+    latency: float
+    reviews: int = 1
+    prompt_tokens: int = 0
+    eval_tokens: int = 0
+    prompt_duration: float = 0.0
+    eval_duration: float = 0.0
+    load_duration: float = 0.0
+    ttft: float | None = None
+    cached: bool = False
+    error: bool = False
+
+    @classmethod
+    def from_response(
+        cls,
+        response: ChatResponse,
+        latency: float,
+        reviews: int = 1,
+        ttft: float | None = None,
+    ) -> "RequestMetrics":
+        return cls(
+            latency=latency,
+            reviews=reviews,
+            prompt_tokens=response.prompt_eval_count or 0,
+            eval_tokens=response.eval_count or 0,
+            prompt_duration=(response.prompt_eval_duration or 0) / NS_PER_SECOND,
+            eval_duration=(response.eval_duration or 0) / NS_PER_SECOND,
+            load_duration=(response.load_duration or 0) / NS_PER_SECOND,
+            ttft=ttft,
+        )
+
+
+class MetricsRecorder:
+    """Thread safe collection of `RequestMetrics`"""
+
+    def __init__(self) -> None:
+        self.requests: list[RequestMetrics] = []
+        self._lock = threading.Lock()
+        self._first_start: float | None = None
+        self._last_end: float | None = None
+
+    def record(self, metrics: RequestMetrics) -> None:
+        now = time.perf_counter()
+        with self._lock:
+            self.requests.append(metrics)
+            start = now - metrics.latency
+            if self._first_start is None or start < self._first_start:
+                self._first_start = start
+            self._last_end = now
+
+    def __len__(self) -> int:
+        return len(self.requests)
+
+    def summary(self, cost_per_hour: float | None = None) -> dict[str, Any]:
+        """Aggregates the recorded requests
+
+        Args:
+            cost_per_hour: price of an hour of the hosts (e.g. GPU rent), if given
+                the price of 1k reviews is part of the summary
+
+        Returns:
+            request, review and token counts, latency percentiles of the
+            answered requests, the error rate, the generation and prompt
+            processing speed of the server in tokens/sec, the tokens per
+            classified review, the wall seconds (and cost) per 1k reviews and
+            the tokens and server seconds per 1k reviews that were sent to the
+            model (cache hits cost neither)
+        """
+        with self._lock:
+            requests = list(self.requests)
+            wall = (
+                self._last_end - self._first_start
+                if self._first_start is not None
+                else 0.0
+            )
+        answered = [r for r in requests if not r.error and not r.cached]
+        reviews = sum(r.reviews for r in requests if not r.error)
+        prompt_tokens = sum(r.prompt_tokens for r in answered)
+        eval_tokens = sum(r.eval_tokens for r in answered)
+        prompt_duration = sum(r.prompt_duration for r in answered)
+        eval_duration = sum(r.eval_duration for r in answered)
+        answered_reviews = sum(r.reviews for r in answered)
+        ttfts = [r.ttft for r in answered if r.ttft is not None]
+        server_seconds = (
+            prompt_duration + eval_duration + sum(r.load_duration for r in answered)
+        )
+        latencies = np.array([r.latency for r in answered])
+        p50, p95, p99 = (
+            np.percentile(latencies, [50, 95, 99]).tolist()
+            if len(latencies)
+            else (None,) * 3
+        )
+        per_1k = 1000 / reviews if reviews else 0.0
+        per_1k_sent = 1000 / answered_reviews if answered_reviews else 0.0
+        res = {
+            "requests": len(requests),
+            "reviews": reviews,
+            "cached": sum(r.cached for r in requests),
+            "errors": sum(r.error for r in requests),
+            "error rate": (
+                sum(r.error for r in requests) / len(requests) if requests else 0.0
+            ),
+            "wall seconds": wall,
+            "reviews/sec": reviews / wall if wall else 0.0,
+            "latency p50": p50,
+            "latency p95": p95,
+            "latency p99": p99,
+            "prompt_tokens": prompt_tokens,
+            "eval_tokens": eval_tokens,
+            "prompt tokens/sec": (
+                prompt_tokens / prompt_duration if prompt_duration else 0.0
+            ),
+            "eval tokens/sec": eval_tokens / eval_duration if eval_duration else 0.0,
+            "prompt tokens/review": (
+                prompt_tokens / answered_reviews if answered_reviews else 0.0
+            ),
+            "eval tokens/review": (
+                eval_tokens / answered_reviews if answered_reviews else 0.0
+            ),
+            "prefill seconds": prompt_duration,
+            "decode seconds": eval_duration,
+            "load seconds": sum(r.load_duration for r in answered),
+            "mean ttft": sum(ttfts) / len(ttfts) if ttfts else None,
+            "wall seconds/1k reviews": wall * per_1k,
+            "server seconds/1k reviews": server_seconds * per_1k_sent,
+            "tokens/1k reviews": (prompt_tokens + eval_tokens) * per_1k_sent,
+        }
+        if cost_per_hour is not None:
+            res["cost/1k reviews"] = wall * per_1k / 3600 * cost_per_hour
+        return res
+
+    def write(
+        self,
+        path: str,
+        cost_per_hour: float | None = None,
+        per_request: bool = False,
+        **run: Any,
+    ) -> dict[str, Any]:
+        """Writes the summary (and optionally every request) as JSON
+
+        Args:
+            path: file to write, usually `<results>.metrics.json`
+            cost_per_hour: see `summary`
+            per_request: also write the metrics of every single request
+            **run: description of the run (model, prompt version, ...) stored
+                along with the summary
+
+        Returns:
+            the summary
+        """
+        summary = self.summary(cost_per_hour)
+        data: dict[str, Any] = {"run": run, "summary": summary}
+        if per_request:
+            with self._lock:
+                data["requests"] = [asdict(r) for r in self.requests]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, default=str)
+        return summary
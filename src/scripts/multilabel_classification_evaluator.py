@@ -1,15 +1,88 @@
 import json
+from collections import Counter
+from collections.abc import Iterable, Mapping
+from itertools import chain
 
+import numpy as np
 import pandas as pd
-from sklearn.metrics import (accuracy_score, classification_report, f1_score,
-                             hamming_loss, jaccard_score, precision_score,
-                             recall_score)
+
+
+def _divide(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    """Elementweise Division, 0 bei Nenner 0 (wie sklearn mit zero_division=0)."""
+    res = np.zeros(np.shape(numerator), dtype=np.float64)
+    np.divide(numerator, denominator, out=res, where=denominator != 0)
+    return res
+
+
+def precision_recall_f1(
+    tp: np.ndarray, pred: np.ndarray, true: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Precision, Recall und F1 aus TP-, Vorhersage- und Ground-Truth-Zählungen."""
+    precision = _divide(tp, pred)
+    recall = _divide(tp, true)
+    f1 = _divide(
+        2.0 * np.asarray(tp, dtype=np.float64), np.asarray(true + pred, dtype=np.float64)
+    )
+    return precision, recall, f1
+
+
+def annotation_labels(annotations_data: list[dict]) -> tuple[dict[int, set[str]], dict[int, str]]:
+    """Extrahiert die Labels und Texte der Reviews aus dem Label-Studio-Export.
+
+    Returns:
+        Labels und Text pro Review-ID
+    """
+    labels_per_review = {}
+    texts = {}
+    for entry in annotations_data:
+        review_id = entry["data"]["review_id"]
+        labels = set()
+        if entry["annotations"]:
+            for annotation in entry["annotations"]:
+                for result in annotation["result"]:
+                    labels.update(result["value"]["choices"])
+        labels_per_review[review_id] = labels
+        texts[review_id] = entry["data"].get("review", "")
+    return labels_per_review, texts
+
+
+def binarize(
+    labels: Mapping[int, Iterable[str]], review_ids: pd.Index, categories: pd.Index
+) -> np.ndarray:
+    """Boolesche Matrix (Reviews x Kategorien) der Labels in einem Schritt.
+
+    Reviews, die in `labels` fehlen, bleiben leer; alle Labels müssen in
+    `categories` und alle Review-IDs in `review_ids` vorkommen.
+    """
+    matrix = np.zeros((len(review_ids), len(categories)), dtype=bool)
+    if not labels:
+        return matrix
+    rows = review_ids.get_indexer(list(labels.keys()))
+    counts = np.fromiter((len(v) for v in labels.values()), dtype=np.int64, count=len(labels))
+    cols = categories.get_indexer(list(chain.from_iterable(labels.values())))
+    matrix[np.repeat(rows, counts), cols] = True
+    return matrix
 
 
 class MultiLabelEvaluator:
-    def __init__(self, annotations_path: str, results_path: str):
+    """Evaluiert vorhergesagte Topics gegen die Annotationen
+
+    Die Labels werden einmal in boolesche Matrizen (Reviews x Kategorien)
+    überführt, alle Metriken werden vektorisiert aus den TP/FP/FN-Zählungen
+    berechnet. Die Ergebnisse entsprechen denen von sklearn
+    (`classification_report`, `f1_score`, `jaccard_score`, ...).
+
+    Mit `only_predicted` werden nur die Reviews der Ergebnisdatei evaluiert,
+    z.B. bei einem Lauf über die ersten n annotierten Reviews. Sonst zählen
+    nicht klassifizierte Reviews als leere Vorhersage.
+    """
+
+    def __init__(
+        self, annotations_path: str, results_path: str, only_predicted: bool = False
+    ):
         self.annotations_path = annotations_path
         self.results_path = results_path
+        self.only_predicted = only_predicted
         self.true_labels = {}
         self.pred_labels = {}
         self.all_categories = set()
@@ -19,6 +92,24 @@ class MultiLabelEvaluator:
         self._load_data()
         self._prepare_data()
 
+    @classmethod
+    def from_labels(
+        cls,
+        true_labels: Mapping[int, Iterable[str]],
+        pred_labels: Mapping[int, Iterable[str]],
+        review_texts: Mapping[int, str] | None = None,
+    ) -> "MultiLabelEvaluator":
+        """Erstellt einen Evaluator direkt aus Labels statt aus JSON-Dateien."""
+        evaluator = cls.__new__(cls)
+        evaluator.annotations_path = None
+        evaluator.results_path = None
+        evaluator.only_predicted = False
+        evaluator.true_labels = {k: set(v) for k, v in true_labels.items()}
+        evaluator.pred_labels = {k: set(v) for k, v in pred_labels.items()}
+        evaluator.review_texts = dict(review_texts or {})
+        evaluator._prepare_data()
+        return evaluator
+
     def _load_data(self):
         """Lädt die JSON-Daten."""
         with open(self.annotations_path, "r", encoding="utf-8") as f:
@@ -27,19 +118,16 @@ class MultiLabelEvaluator:
             results_data = json.load(f)
 
         # Ground Truth aus den Annotationen extrahieren
-        for entry in annotations_data:
-            review_id = entry["data"]["review_id"]
-            labels = set()
-            if entry["annotations"]:
-                for annotation in entry["annotations"]:
-                    for result in annotation["result"]:
-                        labels.update(result["value"]["choices"])
-            self.true_labels[review_id] = labels
-            self.review_texts[review_id] = entry["data"].get("review", "")
+        self.true_labels, self.review_texts = annotation_labels(annotations_data)
 
         # Vorhergesagte Labels extrahieren
         self.pred_labels = {int(k): set(v) for k, v in results_data.items()}
 
+        if self.only_predicted:
+            self.true_labels = {
+                k: v for k, v in self.true_labels.items() if k in self.pred_labels
+            }
+
     def _prepare_data(self):
         """Erstellt die benötigten Datenstrukturen für die Evaluation."""
         self.all_review_ids = sorted(
@@ -50,65 +138,78 @@ class MultiLabelEvaluator:
                 {label for labels in self.pred_labels.values() for label in labels}
             )
         )
+        review_index = pd.Index(self.all_review_ids)
+        category_index = pd.Index(self.all_categories)
+        self.true_matrix = binarize(self.true_labels, review_index, category_index)
+        self.pred_matrix = binarize(self.pred_labels, review_index, category_index)
+
+    def counts(self) -> dict[str, np.ndarray]:
+        """TP-, Vorhersage- und Ground-Truth-Zählungen pro Kategorie und pro Review."""
+        intersection = self.true_matrix & self.pred_matrix
+        return {
+            "tp": intersection.sum(axis=0),
+            "pred": self.pred_matrix.sum(axis=0),
+            "true": self.true_matrix.sum(axis=0),
+            "tp_review": intersection.sum(axis=1),
+            "pred_review": self.pred_matrix.sum(axis=1),
+            "true_review": self.true_matrix.sum(axis=1),
+        }
 
     def evaluate(self):
         """Führt die Evaluation durch und gibt ein DataFrame mit den Ergebnissen zurück."""
-        true_matrix = []
-        pred_matrix = []
-        correct_per_review = []
-
-        for review_id in self.all_review_ids:
-            true_set = self.true_labels.get(review_id, set())
-            pred_set = self.pred_labels.get(review_id, set())
-
-            true_vector = [
-                1 if category in true_set else 0 for category in self.all_categories
-            ]
-            pred_vector = [
-                1 if category in pred_set else 0 for category in self.all_categories
-            ]
-
-            true_matrix.append(true_vector)
-            pred_matrix.append(pred_vector)
-
-            if true_set:
-                correct_count = len(true_set.intersection(pred_set)) / len(true_set)
-            else:
-                correct_count = 1.0 if not pred_set else 0.0
-
-            correct_per_review.append(correct_count)
-
-        # DataFrames erstellen
-        df_true = pd.DataFrame(
-            true_matrix, columns=self.all_categories, index=self.all_review_ids
-        )
-        df_pred = pd.DataFrame(
-            pred_matrix, columns=self.all_categories, index=self.all_review_ids
-        )
+        c = self.counts()
+        support = c["true"]
 
-        # Berechnung der Metriken
-        classification_metrics = classification_report(
-            df_true,
-            df_pred,
-            target_names=self.all_categories,
-            zero_division=0,
-            output_dict=True,
-        )
-        metrics_df = pd.DataFrame(classification_metrics).transpose()
+        # Pro Kategorie
+        precision, recall, f1 = precision_recall_f1(c["tp"], c["pred"], c["true"])
+        report = {
+            category: {
+                "precision": float(p),
+                "recall": float(r),
+                "f1-score": float(f),
+                "support": float(s),
+            }
+            for category, p, r, f, s in zip(
+                self.all_categories, precision, recall, f1, support
+            )
+        }
+
+        # Durchschnitte wie im classification_report
+        micro = precision_recall_f1(c["tp"].sum(), c["pred"].sum(), c["true"].sum())
+        weights = support if support.sum() > 0 else None
+        samples = precision_recall_f1(c["tp_review"], c["pred_review"], c["true_review"])
+        averages = {
+            "micro avg": [float(m) for m in micro],
+            "macro avg": [float(np.mean(m)) for m in (precision, recall, f1)],
+            "weighted avg": [
+                float(np.average(m, weights=weights)) for m in (precision, recall, f1)
+            ],
+            "samples avg": [float(np.mean(m)) for m in samples],
+        }
+        for name, (p, r, f) in averages.items():
+            report[name] = {
+                "precision": p,
+                "recall": r,
+                "f1-score": f,
+                "support": float(support.sum()),
+            }
+        metrics_df = pd.DataFrame(report).transpose()
 
         # Weitere Multilabel-Metriken
-        overall_accuracy = accuracy_score(
-            df_true.values.flatten(), df_pred.values.flatten()
+        overall_accuracy = float(np.mean(self.true_matrix == self.pred_matrix))
+        hamming = float(
+            np.count_nonzero(self.true_matrix != self.pred_matrix) / self.true_matrix.size
         )
-        hamming = hamming_loss(df_true, df_pred)
-        jaccard = jaccard_score(df_true, df_pred, average="samples")
-        avg_correct_per_review = sum(correct_per_review) / len(correct_per_review)
-        micro_f1 = f1_score(df_true, df_pred, average="micro")
-        macro_f1 = f1_score(df_true, df_pred, average="macro")
-        micro_precision = precision_score(df_true, df_pred, average="micro")
-        macro_precision = precision_score(df_true, df_pred, average="macro")
-        micro_recall = recall_score(df_true, df_pred, average="micro")
-        macro_recall = recall_score(df_true, df_pred, average="macro")
+        union = c["true_review"] + c["pred_review"] - c["tp_review"]
+        jaccard = float(np.mean(_divide(c["tp_review"], union)))
+        correct_per_review = np.where(
+            c["true_review"] > 0,
+            _divide(c["tp_review"], c["true_review"]),
+            (c["pred_review"] == 0).astype(np.float64),
+        )
+        avg_correct_per_review = sum(correct_per_review.tolist()) / len(correct_per_review)
+        micro_precision, micro_recall, micro_f1 = averages["micro avg"]
+        macro_precision, macro_recall, macro_f1 = averages["macro avg"]
 
         # Zusätzliche Metriken hinzufügen
         metrics_df.loc["Overall Accuracy"] = [overall_accuracy, "-", "-", "-"]
@@ -131,37 +232,178 @@ class MultiLabelEvaluator:
 
     def review_metrics(self):
         """Erstellt einen DataFrame mit allen Reviews, deren Text, den gefundenen Topics und Multilabel-Metriken."""
-        review_data = []
-        for review_id in self.all_review_ids:
-            true_set = self.true_labels.get(review_id, set())
-            pred_set = self.pred_labels.get(review_id, set())
-            review_text = self.review_texts.get(review_id, "")
-
-            correctly_classified = len(true_set.intersection(pred_set))
-            total_true = len(true_set)
-            correctly_ratio = (
-                correctly_classified / total_true
-                if total_true > 0
-                else 1.0
-                if not pred_set
-                else 0.0
-            )
+        c = self.counts()
+        correctly_classified = c["tp_review"]
+        total_true = c["true_review"]
+        union = c["true_review"] + c["pred_review"] - c["tp_review"]
 
-            union = len(true_set.union(pred_set))
-            intersection = len(true_set.intersection(pred_set))
-            jaccard = intersection / union if union > 0 else 1.0
-
-            review_data.append(
-                {
-                    "Review ID": review_id,
-                    "Review Text": review_text,
-                    "True Topics": list(true_set),
-                    "Predicted Topics": list(pred_set),
-                    "Correctly Classified Topics": correctly_classified,
-                    "Total Topics": total_true,
-                    "Accuracy per Review": correctly_ratio,
-                    "Jaccard Score": jaccard,
-                }
-            )
+        correctly_ratio = np.where(
+            total_true > 0,
+            _divide(correctly_classified, total_true),
+            (c["pred_review"] == 0).astype(np.float64),
+        )
+        jaccard = np.where(union > 0, _divide(correctly_classified, union), 1.0)
+
+        empty = set()
+        return pd.DataFrame(
+            {
+                "Review ID": self.all_review_ids,
+                "Review Text": [self.review_texts.get(i, "") for i in self.all_review_ids],
+                "True Topics": [
+                    list(self.true_labels.get(i, empty)) for i in self.all_review_ids
+                ],
+                "Predicted Topics": [
+                    list(self.pred_labels.get(i, empty)) for i in self.all_review_ids
+                ],
+                "Correctly Classified Topics": correctly_classified,
+                "Total Topics": total_true,
+                "Accuracy per Review": correctly_ratio,
+                "Jaccard Score": jaccard,
+            }
+        )
+
+
+class IncrementalEvaluator:
+    """Evaluiert Vorhersagen laufend, sobald sie eintreffen
+
+    Hält nur die TP-, Vorhersage- und Ground-Truth-Zählungen pro Kategorie und
+    die Summen der Review-Metriken, so dass `summary` jederzeit die aktuellen
+    Micro/Macro-Scores liefert. Zählungen mehrerer Shards werden mit `merge`
+    (bzw. `save`/`load` über Prozesse hinweg) zusammengeführt.
+
+    Nach `add_missing` (annotierte, aber nicht vorhergesagte Reviews zählen
+    als leere Vorhersage) entsprechen die Scores denen von
+    `MultiLabelEvaluator.evaluate` (bis auf Rundung der Summen).
+    """
+
+    def __init__(self, true_labels: Mapping[int, Iterable[str]]):
+        self.true_labels = {k: set(v) for k, v in true_labels.items()}
+        self._seen: set[int] = set()
+        self._tp: Counter[str] = Counter()
+        self._pred: Counter[str] = Counter()
+        self._true: Counter[str] = Counter()
+        self._categories: set[str] = set()
+        self._errors = 0
+        self._jaccard_sum = 0.0
+        self._correct_sum = 0.0
+
+    @classmethod
+    def from_annotations(cls, annotations_path: str) -> "IncrementalEvaluator":
+        with open(annotations_path, "r", encoding="utf-8") as f:
+            true_labels, _ = annotation_labels(json.load(f))
+        return cls(true_labels)
+
+    @property
+    def reviews(self) -> int:
+        return len(self._seen)
 
-        return pd.DataFrame(review_data)
+    def __contains__(self, review_id: int) -> bool:
+        return review_id in self._seen
+
+    def update(self, review_id: int, predicted: Iterable[str]) -> None:
+        """Zählt die Vorhersage eines Reviews.
+
+        Raises:
+            ValueError: wenn das Review schon gezählt wurde
+        """
+        if review_id in self._seen:
+            raise ValueError(f"review {review_id} was already counted")
+        self._seen.add(review_id)
+        true_set = self.true_labels.get(review_id, set())
+        pred_set = set(predicted)
+        intersection = true_set & pred_set
+        self._tp.update(intersection)
+        self._pred.update(pred_set)
+        self._true.update(true_set)
+        self._categories.update(true_set, pred_set)
+
+        union = len(true_set) + len(pred_set) - len(intersection)
+        self._errors += union - len(intersection)
+        self._jaccard_sum += len(intersection) / union if union else 0.0
+        if true_set:
+            self._correct_sum += len(intersection) / len(true_set)
+        else:
+            self._correct_sum += 1.0 if not pred_set else 0.0
+
+    def add_missing(self) -> None:
+        """Zählt alle annotierten, noch nicht gezählten Reviews als leere Vorhersage."""
+        for review_id in self.true_labels.keys() - self._seen:
+            self.update(review_id, ())
+
+    def merge(self, other: "IncrementalEvaluator") -> "IncrementalEvaluator":
+        """Addiert die Zählungen eines anderen Shards.
+
+        Raises:
+            ValueError: wenn beide Shards dasselbe Review gezählt haben
+        """
+        overlap = self._seen & other._seen
+        if overlap:
+            raise ValueError(f"{len(overlap)} reviews are counted in both shards")
+        self._seen |= other._seen
+        self._tp += other._tp
+        self._pred += other._pred
+        self._true += other._true
+        self._categories |= other._categories
+        self._errors += other._errors
+        self._jaccard_sum += other._jaccard_sum
+        self._correct_sum += other._correct_sum
+        return self
+
+    def save(self, path: str) -> None:
+        """Schreibt die Zählungen (ohne Annotationen) als JSON."""
+        state = {
+            "reviews": sorted(self._seen),
+            "tp": self._tp,
+            "pred": self._pred,
+            "true": self._true,
+            "categories": sorted(self._categories),
+            "errors": self._errors,
+            "jaccard_sum": self._jaccard_sum,
+            "correct_sum": self._correct_sum,
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+
+    @classmethod
+    def load(cls, path: str, true_labels: Mapping[int, Iterable[str]]) -> "IncrementalEvaluator":
+        """Lädt die mit `save` geschriebenen Zählungen eines Shards."""
+        with open(path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        evaluator = cls(true_labels)
+        evaluator._seen = set(state["reviews"])
+        evaluator._tp = Counter(state["tp"])
+        evaluator._pred = Counter(state["pred"])
+        evaluator._true = Counter(state["true"])
+        evaluator._categories = set(state["categories"])
+        evaluator._errors = state["errors"]
+        evaluator._jaccard_sum = state["jaccard_sum"]
+        evaluator._correct_sum = state["correct_sum"]
+        return evaluator
+
+    def summary(self) -> dict[str, float]:
+        """Aktuelle Scores mit denselben Namen wie die Zeilen von `MultiLabelEvaluator.evaluate`."""
+        n = len(self._seen)
+        categories = sorted(self._categories)
+        tp = np.array([self._tp[c] for c in categories], dtype=np.int64)
+        pred = np.array([self._pred[c] for c in categories], dtype=np.int64)
+        true = np.array([self._true[c] for c in categories], dtype=np.int64)
+
+        precision, recall, f1 = precision_recall_f1(tp, pred, true)
+        micro_precision, micro_recall, micro_f1 = (
+            float(m) for m in precision_recall_f1(tp.sum(), pred.sum(), true.sum())
+        )
+        macro = [float(np.mean(m)) if categories else 0.0 for m in (precision, recall, f1)]
+        size = n * len(categories)
+        return {
+            "reviews": n,
+            "Overall Accuracy": (size - self._errors) / size if size else 0.0,
+            "Hamming Loss": self._errors / size if size else 0.0,
+            "Jaccard Score": self._jaccard_sum / n if n else 0.0,
+            "Avg Correct per Review": self._correct_sum / n if n else 0.0,
+            "Micro F1": micro_f1,
+            "Macro F1": macro[2],
+            "Micro Precision": micro_precision,
+            "Macro Precision": macro[0],
+            "Micro Recall": micro_recall,
+            "Macro Recall": macro[1],
+        }
@@ -3,65 +3,98 @@ import sys
 from datetime import datetime
 from logging import INFO, basicConfig
 
-import pandas as pd
-
 sys.path.append("scripts")
-from ollama_topic_classification import OllamaClassifier, Topic, setup_args
-
-PROMPTDIR = "./assets/"
-
-def _sample_reviews(n: int = 1000) -> tuple[int, pd.DataFrame]:
-    # load the original dataset
-    reviews_df = pd.read_csv("../../data/reviews_100k_cleaned_new.csv.bz2", low_memory=False)
-    reviews_df["review"] = reviews_df["review"].astype(str)
+from cascade import prelabel
+from corpus import reservoir_sample
+from dedup import checkpoint_copies, collapse_reviews, fan_out
+from ollama_topic_classification import (
+    OllamaClassifier,
+    default_topics,
+    load_batch_prompt,
+    load_prompts,
+    make_cache,
+    make_checkpoint,
+    make_client,
+    setup_args,
+    write_failed_ids,
+    write_metrics,
+)
+from topic_matcher import load_synonyms
 
-    samples = reviews_df.sample(n = n)
+def _sample_reviews(
+    n: int = 1000, exclude: set[int] = set()
+) -> tuple[list[int], list[str]]:
+    # stream the original dataset and keep a uniform sample of n reviews
+    samples = reservoir_sample(
+        "../../data/reviews_100k_cleaned_new.csv.bz2",
+        n,
+        columns=["review_id", "review"],
+        # reviews that were already annotated by a previous (interrupted) run
+        filter=lambda batch: ~batch["review_id"].isin(exclude),
+    )
 
     return (list(samples["review_id"]), list(samples["review"]))
 
 if __name__ == "__main__":
     args = setup_args()    
-    versions = {
-        1: {
-            "promptfile": f"{PROMPTDIR}prompt_v1.txt",
-            "systemfile": f"{PROMPTDIR}system_v1.txt",
-        },
-        2: {
-            "promptfile": f"{PROMPTDIR}prompt_v2.txt",
-            "systemfile": f"{PROMPTDIR}system_v2.txt",
-        },
-        3: {
-            "promptfile": f"{PROMPTDIR}prompt_v3.txt",
-            "systemfile": f"{PROMPTDIR}system_v3.txt",
-        },
-    }
     basicConfig(level=INFO, filename="./ollama_log.txt", filemode="w")
-    with open(versions[args.prompt_version]["systemfile"], "r", encoding='utf-8') as f:
-        sys_prompt = f.read()
-    with open(versions[args.prompt_version]["promptfile"], "r", encoding='utf-8') as f:
-        prompt_template = f.read()
+    sys_prompt, prompt_template = load_prompts(args.prompt_version)
 
-    ids, reviews = _sample_reviews(n=args.number)
+    cache = make_cache(args)
+    pool = make_client(args)
+    checkpoint = make_checkpoint(args, "annotations-checkpoint")
+    # on resume only sample the reviews that are still missing
+    n = max(args.number - len(checkpoint), 0) if args.number > 0 else args.number
+    ids, reviews = _sample_reviews(n=n, exclude=checkpoint.done_ids)
     print(f"info: Prepared {len(reviews)} (id, review) pairs")
-    topics = [
-        Topic(t)
-        for t in [
-            "gamemode",
-            "bugs",
-            "visuals",
-            "sound",
-            "hardware_requirements",
-            "price",
-            "gameplay",
-            "story",
-            "support",
-            "online_play",
-            "updates",
-            "seasonal_content",
-        ]
-    ]
-    o = OllamaClassifier(args.model, sys_prompt, prompt_template, reviews, ids, topics)
-    data = o.get_all_topic_eval()
+    copies = {}
+    if args.dedup:
+        # reviews of clusters that were annotated by the interrupted run become copies
+        ids, reviews, copies = collapse_reviews(
+            args.dedup, ids, reviews, done=checkpoint.done_ids
+        )
+    if args.cascade:
+        prelabel(args.cascade, ids, reviews, checkpoint)
+    topics = default_topics()
+    o = OllamaClassifier(
+        args.model,
+        sys_prompt,
+        prompt_template,
+        reviews,
+        ids,
+        topics,
+        concurrency=args.concurrency,
+        timeout=args.timeout,
+        retries=args.retries,
+        cache=cache,
+        synonyms=load_synonyms(args.synonyms) if args.synonyms else None,
+        batch_size=args.batch_size,
+        batch_tokens=args.batch_tokens,
+        batch_prompt_template=load_batch_prompt(args),
+        structured=args.structured,
+        num_predict=args.num_predict,
+        client=pool,
+        keep_alive=args.keep_alive,
+        stream=args.stream,
+        log_every=args.log_every,
+    )
+    if pool is not None:
+        o.preload()
+    try:
+        data = {**checkpoint.results(), **o.get_all_topic_eval(checkpoint=checkpoint)}
+    finally:
+        # the copies only live in memory, an interrupted run keeps them in the checkpoint
+        checkpoint_copies(checkpoint, copies)
+    data = fan_out(data, copies)
+    checkpoint.close()
+    if args.batch_size > 1:
+        print(f"batches: {o.batch_stats}")
+    if pool is not None:
+        print(f"hosts: {pool.stats()}")
+        pool.close()
+    if cache is not None:
+        print(f"cache: {cache.stats()}")
+        cache.close()
     json_file_name = f"./results/annotations-v{args.prompt_version}-{datetime.now().isoformat()}-n{args.number if args.number > 0 else "all"}-{str(args.model)}.json".replace(
         ":", "_"
     )
@@ -71,3 +104,5 @@ if __name__ == "__main__":
         "w",
     ) as f:
         json.dump(data, f)
+    write_failed_ids(o, json_file_name)
+    write_metrics(o, json_file_name, args)
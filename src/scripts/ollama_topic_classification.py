@@ -1,21 +1,37 @@
 #!/usr/bin/env python3
 
 import csv
+import hashlib
+import itertools
 import json
+import re
 import string
+import threading
+import time
 from argparse import ArgumentParser
+from collections.abc import Iterable, Iterator
 from datetime import datetime
 from enum import StrEnum
 from logging import INFO, Logger, basicConfig, getLogger
 from types import FunctionType
 from typing import Literal
 
+import httpx
 from tqdm import tqdm
 
 from annotations import lstudio_label_mapping_to_dict, update_df_review_labels
-from ollama import ChatResponse, Client, Message, Options, RequestError
-from pandas import read_csv
+from backend_pool import RETRYABLE_ERRORS, BackendPool, is_retryable
+from cascade import prelabel
+from checkpoint import JsonlCheckpoint
+from corpus import load_corpus
+from dedup import collapse_reviews, fan_out
+from metrics import MetricsRecorder, RequestMetrics
+from multilabel_classification_evaluator import IncrementalEvaluator
+from ollama import ChatResponse, Client, Message, Options, RequestError, ResponseError
+from request_engine import bounded_map, call_with_retries
+from response_cache import DEFAULT_CACHE_PATH, ResponseCache
 from termcolor import colored
+from topic_matcher import TopicMatcher, load_synonyms
 
 PROMPTDIR = "./assets/"
 DATA_DIR = "../../data/"
@@ -23,6 +39,72 @@ RAW_DATA_FILE = "reviews_100k_raw.csv.bz2"
 JSON_PATH = "../../data/lstudio_annotations.json"
 JSON_MIN_PATH = "../../data/lstudio_min_annotations.json"
 CLEANED_DATA_FILE = "reviews_fetch_100k_cleaned_v2.csv.bz2"
+BATCH_PROMPT_FILE = f"{PROMPTDIR}prompt_batch_v1.txt"
+
+# system prompt and prompt template of every prompt version
+PROMPT_VERSIONS = {
+    1: {
+        "promptfile": f"{PROMPTDIR}prompt_v1.txt",
+        "systemfile": f"{PROMPTDIR}system_v1.txt",
+    },
+    2: {
+        "promptfile": f"{PROMPTDIR}prompt_v2.txt",
+        "systemfile": f"{PROMPTDIR}system_v2.txt",
+    },
+    3: {
+        "promptfile": f"{PROMPTDIR}prompt_v3.txt",
+        "systemfile": f"{PROMPTDIR}system_v3.txt",
+    },
+}
+
+# the topics the reviews are annotated with
+DEFAULT_TOPICS = [
+    "gamemode",
+    "bugs",
+    "visuals",
+    "sound",
+    "hardware_requirements",
+    "price",
+    "gameplay",
+    "story",
+    "support",
+    "online_play",
+    "updates",
+    "seasonal_content",
+]
+
+# rough number of characters per token, used to fill batch prompts up to a token budget
+CHARS_PER_TOKEN = 4
+
+# arguments besides version, number and model that change the answers of a run, see `make_checkpoint`
+RUN_CONFIG_ARGS = [
+    "structured",
+    "batch_size",
+    "batch_tokens",
+    "synonyms",
+    "num_predict",
+    "cascade",
+    "dedup",
+]
+
+# log labels, colored once instead of for every log line
+LOG_REVIEW = colored("Review:", color="green")
+LOG_ANSWER = colored("Answer:", color="green")
+LOG_TOPICS = colored("Topics:", color="green")
+LOG_PROMPT = colored("Full prompt:", color="green")
+LOG_SPLIT = colored("lower after split:", color="green")
+LOG_FAILED = colored("Request failed for", color="red")
+LOG_NO_TOPICS = colored("No topics found", color="red")
+
+# `<number>: <topics>` line of a batch answer, tolerating `[2]`, `review 2`, `**2.**` and so on
+BATCH_ANSWER_LINE = re.compile(
+    r"^[ \t*#>-]*\[?(?:review[ \t]*)?#?(\d+)\]?[ \t*]*[:.)\]-]+[ \t*]*(.*)$",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+
+class RunAborted(Exception):
+    """The live evaluation of a run fell below the abort threshold"""
 
 
 class Model(StrEnum):
@@ -87,7 +169,43 @@ class Topic:
 
 
 class OllamaClassifier:
-    """OllamaClassifier classifies reviews with the help of ollama to a specific list of topics"""
+    """OllamaClassifier classifies reviews with the help of ollama to a specific list of topics
+
+    Requests are sent by a bounded worker pool: `concurrency` requests are kept in
+    flight (ollama has to be started with `OLLAMA_NUM_PARALLEL` >= concurrency to
+    actually process them in parallel). Each request times out after `timeout`
+    seconds and is retried `retries` times on transient errors. If a `cache` is
+    given, answers are looked up there before asking the server.
+
+    Answers are matched against the topics (and their optional `synonyms`, see
+    `topic_matcher.load_synonyms`) with a `TopicMatcher` compiled once here.
+
+    With `batch_size` > 1 up to `batch_size` reviews (and at most about
+    `batch_tokens` tokens of reviews) are numbered and sent in one prompt built
+    from `batch_prompt_template`, so the instructions are processed once per
+    batch instead of once per review. Reviews whose line can not be found in the
+    answer are classified again with a single review prompt.
+
+    With `structured` the model is constrained to answer a JSON object whose
+    topics are an enum of the configured topics (ollama `format`), which is
+    parsed directly instead of searching the text. `num_predict` caps the
+    generated tokens. Token counts and speeds of all requests are collected in
+    `metrics`.
+
+    To spread the requests over several ollama hosts pass a `BackendPool` as
+    `client`. Reviews whose request failed in the end are not part of the
+    results but listed in `failed_ids`.
+
+    Every request starts with the system prompt as system message, so the
+    server can reuse the processed prefix of the previous request. `preload`
+    loads the model on every host, keeps it loaded for `keep_alive` and
+    processes the system prompt once up front; it runs on construction when no
+    `client` is given. With `stream` the answers are streamed to measure the
+    time to the first token.
+
+    Prompts, answers and topics are only logged for every `log_every`-th
+    review (0 => never), failures are always logged.
+    """
 
     def __init__(
         self,
@@ -100,62 +218,399 @@ class OllamaClassifier:
         logger: Logger = getLogger(__name__),
         client: Client | None = None,
         options: Options | None = None,
+        concurrency: int = 1,
+        timeout: float | None = None,
+        retries: int = 2,
+        cache: ResponseCache | None = None,
+        synonyms: dict[str, list[str]] | None = None,
+        batch_size: int = 1,
+        batch_tokens: int = 1024,
+        batch_prompt_template: str | None = None,
+        structured: bool = False,
+        num_predict: int | None = None,
+        keep_alive: float | str | None = None,
+        stream: bool = False,
+        log_every: int = 1,
     ) -> None:
+        if batch_size > 1 and batch_prompt_template is None:
+            raise ValueError("batch_size > 1 needs a batch_prompt_template")
         self._reviews = reviews
         self._topics = topics
+        self._matcher = self._make_matcher(topics, synonyms)
         self._ids = ids
         self._model = model
         self._prompt_template = prompt_template
         self._system_prompt = system_prompt
         self._logger = logger
+        self._concurrency = concurrency
+        self._timeout = timeout
+        self._retries = retries
+        self._cache = cache
+        self._batch_size = batch_size
+        self._batch_tokens = batch_tokens
+        self._batch_prompt_template = batch_prompt_template
+        self.batch_stats = {"batches": 0, "reviews": 0, "fallbacks": 0}
+        self._stats_lock = threading.Lock()
+        self._structured = structured
+        self._topics_by_value = {t.value.lower(): t for t in topics}
+        self.metrics = MetricsRecorder()
+        self.failed_ids: list[int] = []
+        self._keep_alive = keep_alive
+        self._stream = stream
+        self._log_every = log_every
+        self._review_log_counter = itertools.count()
+        self._prompt_log_counter = itertools.count()
         self._options: Options = (
             self._make_default_options() if options is None else options
         )
-        # options have to be defined before the client because client uses options
-        self._client = (
-            self._make_default_client(self._options) if client is None else client
-        )
+        if num_predict is not None:
+            self._options = self._options.model_copy(update={"num_predict": num_predict})
+        self._client = self._make_default_client() if client is None else client
+        if client is None:
+            self.preload()
+
+    def preload(self) -> None:
+        """Loads the model on every host and primes it with the system prompt
+
+        The system prompt is sent alone with a single token to generate, so the
+        first real requests find its processed prefix in the prompt cache.
+        """
+        clients = getattr(self._client, "clients", [self._client])
+        msg: Message = Message(role="system", content=self._system_prompt)
+        options = self._options.model_copy(update={"num_predict": 1})
+        for client in clients:
+            try:
+                client.chat(
+                    str(self._model),
+                    messages=[msg],
+                    options=options,
+                    keep_alive=self._keep_alive,
+                )
+            except (RequestError, *RETRYABLE_ERRORS) as e:
+                self._logger.warning(f"preloading {self._model} failed: {e!r}")
 
     def get_all_topic_eval(
-        self, eval_answer_function: FunctionType | None = None
+        self,
+        eval_answer_function: FunctionType | None = None,
+        concurrency: int | None = None,
+        checkpoint: JsonlCheckpoint | None = None,
+        evaluator: IncrementalEvaluator | None = None,
+        abort_below: float | None = None,
+        abort_after: int = 200,
     ) -> dict[int, list[str]]:
+        """Classifies all reviews of the classifier
+
+        Args:
+            eval_answer_function: function that parses the answer of the model
+                [default] `evaluate_answer`
+            concurrency: number of requests in flight [default] the one of the classifier
+            checkpoint: every finished review is appended to this checkpoint and
+                reviews that are already in it are not classified again
+            evaluator: every finished review is counted by this evaluator and the
+                current micro/macro F1 is shown in the progress bar
+            abort_below: abort the run if the micro F1 of the evaluator is below
+                this value after `abort_after` reviews
+            abort_after: reviews to classify before the run may be aborted
+
+        Returns:
+            mapping of review id to the list of found topics (in the order of the
+            ids) without the reviews in `failed_ids`
+
+        Raises:
+            RunAborted: the micro F1 fell below `abort_below`, the finished reviews
+                are in the checkpoint
+        """
+        res = {}
+        total = len(self._ids)
+        if checkpoint is not None:
+            wanted = set(self._ids)
+            res = {id: t for id, t in checkpoint.results().items() if id in wanted}
+            total -= len(res)
+        if evaluator is not None:
+            for id, topics_list in res.items():
+                if id not in evaluator:
+                    evaluator.update(id, topics_list)
+
+        print(f"loading {self._model} ..")
+        results = self.classify_stream(
+            zip(self._ids, self._reviews),
+            eval_answer_function=eval_answer_function,
+            concurrency=concurrency,
+            checkpoint=checkpoint,
+        )
+        progress = tqdm(results, total=total)
+        for id, topics_list in progress:
+            res[id] = topics_list
+            if evaluator is None:
+                continue
+            evaluator.update(id, topics_list)
+            scores = evaluator.summary()
+            progress.set_postfix(
+                micro_f1=f"{scores['Micro F1']:.3f}",
+                macro_f1=f"{scores['Macro F1']:.3f}",
+                refresh=False,
+            )
+            if (
+                abort_below is not None
+                and scores["reviews"] >= abort_after
+                and scores["Micro F1"] < abort_below
+            ):
+                progress.close()
+                results.close()
+                raise RunAborted(
+                    f"micro F1 {scores['Micro F1']:.3f} < {abort_below} after {scores['reviews']} reviews"
+                )
+
+        # answers arrive in completion order, hand them back in input order
+        return {id: res[id] for id in self._ids if id in res}
+
+    def classify_stream(
+        self,
+        items: Iterable[tuple[int, str]],
+        eval_answer_function: FunctionType | None = None,
+        concurrency: int | None = None,
+        checkpoint: JsonlCheckpoint | None = None,
+    ) -> Iterator[tuple[int, list[str]]]:
+        """Classifies a (lazy) stream of (review id, review) pairs
+
+        Reviews are pulled from `items` only as fast as the server answers, so a
+        streamed corpus (see `corpus.iter_reviews`) is never held in memory.
+
+        Args:
+            items: iterable of (review id, review) pairs
+            eval_answer_function: function that parses the answer of the model
+                [default] `evaluate_answer`
+            concurrency: number of requests in flight [default] the one of the classifier
+            checkpoint: every finished review is appended to this checkpoint and
+                reviews that are already in it are skipped
+
+        Yields:
+            (review id, topics) in completion order, reviews whose request failed
+            are left out and added to `failed_ids`
+        """
         if eval_answer_function is None:
             eval_answer = self.evaluate_answer
         else:
             eval_answer = eval_answer_function
-
-        res = {}
-        
-        print(f"loading {self._model} ..")
-        for id, review in tqdm(zip(self._ids, self._reviews), total=len(self._ids)):
-            self._logger.info(f"{colored('Review:', color='green')}\n{review}")
-            answer = self.get_topic(review)
-            self._logger.info(f"{colored('Answer:', color='green')}\n{answer}")
+        if concurrency is None:
+            concurrency = self._concurrency
+        if checkpoint is not None:
+            items = ((id, r) for id, r in items if id not in checkpoint)
+
+        def classify(item: tuple[int, str]) -> tuple[int, str, str]:
+            id, review = item
+            return id, review, self.get_topic(review)
+
+        if self._batch_size > 1:
+            answers = (
+                answer
+                for batch in bounded_map(
+                    self.classify_batch, self._pack_batches(items), concurrency=concurrency
+                )
+                for answer in batch
+            )
+        else:
+            answers = bounded_map(classify, items, concurrency=concurrency)
+
+        for id, review, answer in answers:
+            log = self._sampled(self._review_log_counter)
+            if log:
+                self._logger.info("%s\n%s", LOG_REVIEW, review)
+                self._logger.info("%s\n%s", LOG_ANSWER, answer)
+            if answer == "RequestError":
+                # not checkpointed either, so that a resumed run retries the review
+                self._logger.warning("%s %s", LOG_FAILED, id)
+                self.failed_ids.append(id)
+                continue
             topics = eval_answer(answer)
-            self._logger.info(f"{colored('Topics:', color='green')}\n{topics}")
+            if log:
+                self._logger.info("%s\n%s", LOG_TOPICS, topics)
             if topics is None:
-                self._logger.warning(f"{colored('No topics found', color='red')}")
+                self._logger.warning("%s for %s", LOG_NO_TOPICS, id)
             topics_list = [t.value for t in (topics if topics is not None else [])]
-            res[id] = topics_list
-        return res
-
+            if checkpoint is not None:
+                checkpoint.append(id, topics_list, answer)
+            yield id, topics_list
 
     def get_topic_eval(self, review: str):
         answer = self.get_topic(review)
         return self.evaluate_answer(answer)
 
+    def classify_batch(
+        self, batch: list[tuple[int, str]]
+    ) -> list[tuple[int, str, str]]:
+        """Classifies several reviews with one batch prompt
+
+        Args:
+            batch: list of (review id, review) pairs
+
+        Returns:
+            list of (review id, review, answer for this review) in the order of the batch
+        """
+        reviews = [review for _, review in batch]
+        answer = self.get_topic_batch(reviews)
+        if answer == "RequestError":
+            lines: dict[int, str] = {}
+        elif self._structured:
+            lines = self.parse_structured_batch_answer(answer, len(batch))
+        else:
+            lines = self.parse_batch_answer(answer, len(batch))
+
+        res = []
+        fallbacks = 0
+        for number, (id, review) in enumerate(batch, start=1):
+            if number in lines:
+                res.append((id, review, lines[number]))
+            else:
+                fallbacks += 1
+                # the review is already counted by the metrics of the batch request
+                res.append((id, review, self._get_topic(review, reviews=0)))
+        with self._stats_lock:
+            self.batch_stats["batches"] += 1
+            self.batch_stats["reviews"] += len(batch)
+            self.batch_stats["fallbacks"] += fallbacks
+        return res
+
+    def get_topic_batch(self, reviews: list[str]) -> str | Literal["RequestError", "None"]:
+        format = topics_schema(self._topics, len(reviews)) if self._structured else None
+        return self._chat(self._build_batch_prompt(reviews), format, len(reviews))
+
+    @staticmethod
+    def parse_batch_answer(answer: str, n: int) -> dict[int, str]:
+        """Splits the answer to a batch prompt into the answers of the reviews
+
+        If a number shows up more than once (e.g. in the reasoning before the
+        actual answer) the last line wins.
+
+        Args:
+            answer: answer of the model to a prompt with `n` numbered reviews
+            n: number of reviews in the prompt
+
+        Returns:
+            mapping of review number (starting at 1) to its part of the answer
+        """
+        lines = {}
+        for m in BATCH_ANSWER_LINE.finditer(answer):
+            number = int(m.group(1))
+            if 1 <= number <= n:
+                lines[number] = m.group(2)
+        return lines
+
+    @staticmethod
+    def parse_structured_batch_answer(answer: str, n: int) -> dict[int, str]:
+        """Splits the JSON answer to a structured batch prompt into single answers
+
+        Returns:
+            mapping of review number (starting at 1) to a single review JSON
+            answer (`{"topics": [...]}`), empty if the answer is no valid JSON
+        """
+        try:
+            parsed = json.loads(answer)
+        except json.JSONDecodeError:
+            return {}
+        if not isinstance(parsed, dict):
+            return {}
+        lines = {}
+        for number in range(1, n + 1):
+            topics = parsed.get(str(number))
+            if isinstance(topics, list):
+                lines[number] = json.dumps({"topics": topics})
+        return lines
+
     def get_topic(self, review: str) -> str | Literal["RequestError", "None"]:
-        prompt = self._build_prompt(review)
-        self._logger.info(f"{colored("Full prompt:", color="green")}:\n{prompt}")
-        msg: Message = Message(role="user", content=prompt)
+        return self._get_topic(review)
+
+    def _get_topic(self, review: str, reviews: int = 1) -> str | Literal["RequestError", "None"]:
+        format = topics_schema(self._topics) if self._structured else None
+        return self._chat(self._build_prompt(review), format, reviews)
+
+    def _chat(
+        self, prompt: str, format: dict | None = None, reviews: int = 1
+    ) -> str | Literal["RequestError", "None"]:
+        if self._sampled(self._prompt_log_counter):
+            self._logger.info("%s:\n%s", LOG_PROMPT, prompt)
+        start = time.perf_counter()
+        cache_key = None
+        if self._cache is not None:
+            cache_key = ResponseCache.make_key(
+                self._model, prompt, self._options, format, system=self._system_prompt
+            )
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                self.metrics.record(
+                    RequestMetrics(time.perf_counter() - start, reviews, cached=True)
+                )
+                return cached
+
+        # same system message first in every request => shared prompt prefix
+        messages: list[Message] = [
+            Message(role="system", content=self._system_prompt),
+            Message(role="user", content=prompt),
+        ]
         try:
-            answer: ChatResponse = self._client.chat(
-                model=self._model, messages=[msg], options=self._options
+            answer, ttft = call_with_retries(
+                lambda: self._send(messages, format),
+                retries=self._retries,
+                retry_on=RETRYABLE_ERRORS,
+                retry_if=is_retryable,
+                logger=self._logger,
+            )
+        except (RequestError, *RETRYABLE_ERRORS):
+            self.metrics.record(
+                RequestMetrics(time.perf_counter() - start, reviews, error=True)
             )
-        except RequestError:
             return "RequestError"
+        self.metrics.record(
+            RequestMetrics.from_response(
+                answer, time.perf_counter() - start, reviews, ttft=ttft
+            )
+        )
 
-        return answer.message.content if answer.message.content is not None else "None"
+        content = (
+            answer.message.content if answer.message.content is not None else "None"
+        )
+        if cache_key is not None:
+            self._cache.put(cache_key, content)
+        return content
+
+    def _sampled(self, counter: itertools.count) -> bool:
+        """Whether the next review or prompt is logged (see `log_every`)"""
+        if self._log_every <= 0 or not self._logger.isEnabledFor(INFO):
+            return False
+        return next(counter) % self._log_every == 0
+
+    def _send(
+        self, messages: list[Message], format: dict | None
+    ) -> tuple[ChatResponse, float | None]:
+        """Sends one chat request
+
+        Returns:
+            the response and, when streaming, the seconds until the first token
+        """
+        kwargs = dict(
+            model=self._model,
+            messages=messages,
+            options=self._options,
+            format=format,
+            keep_alive=self._keep_alive,
+        )
+        if not self._stream:
+            return self._client.chat(**kwargs), None
+
+        start = time.perf_counter()
+        ttft = None
+        parts = []
+        last: ChatResponse | None = None
+        for chunk in self._client.chat(**kwargs, stream=True):
+            if ttft is None and chunk.message.content:
+                ttft = time.perf_counter() - start
+            parts.append(chunk.message.content or "")
+            last = chunk
+        if last is None:
+            raise ResponseError("empty streamed response", status_code=502)
+        # the last chunk carries the counts and durations, give it the whole answer
+        last.message.content = "".join(parts)
+        return last, ttft
 
     def evaluate_answer(self, answer: str) -> list[Topic] | None:
         """Evaluates the answer of the model
@@ -166,20 +621,40 @@ class OllamaClassifier:
         Returns:
             Topic if the answer is valid else None
         """
-        topics: set[Topic] = set()
+        if self._structured:
+            topics = self.parse_structured_answer(answer)
+            if topics is not None:
+                return topics if bool(topics) else None
+
         lower = answer.lower()
 
         # hopefully dodge the reasoning
         if "predicted_topics:" in lower:
             lower = lower.split("predicted_topics:")[1]
-            self._logger.info(f"{colored("lower after split:", color="green")}: {lower}")
+            self._logger.debug("%s: %s", LOG_SPLIT, lower)
+
+        topics = self._matcher.match(lower)
+        return topics if bool(topics) else None
 
-        generated_topics = self.generate_topic_options(self._topics)
-        for k, v in generated_topics.items():
-            if k in lower:
-                topics.add(v)
+    def parse_structured_answer(self, answer: str) -> list[Topic] | None:
+        """Parses a `{"topics": [...]}` answer of the structured mode
 
-        return list(topics) if bool(topics) else None
+        Returns:
+            the topics of the answer or None if the answer does not follow the
+            schema (the caller then falls back to searching the text)
+        """
+        try:
+            parsed = json.loads(answer)
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(parsed, dict) or not isinstance(parsed.get("topics"), list):
+            return None
+        topics: dict[Topic, None] = {}
+        for value in parsed["topics"]:
+            if not isinstance(value, str) or value.lower() not in self._topics_by_value:
+                return None
+            topics.setdefault(self._topics_by_value[value.lower()], None)
+        return list(topics)
 
     @staticmethod
     def generate_topic_options(topics: list[Topic]) -> dict[str, Topic]:
@@ -193,21 +668,116 @@ class OllamaClassifier:
 
         return res
 
+    @classmethod
+    def _make_matcher(
+        cls, topics: list[Topic], synonyms: dict[str, list[str]] | None
+    ) -> TopicMatcher[Topic]:
+        aliases = cls.generate_topic_options(topics)
+        for topic in topics:
+            for synonym in (synonyms or {}).get(topic.value.lower(), []):
+                # the topic names themselves take precedence over synonyms
+                aliases.setdefault(synonym, topic)
+        return TopicMatcher(aliases)
+
     def _build_prompt(self, review: str) -> str:
         return self._prompt_template.replace("$Review$", review).replace(
             "$Topics$", ",".join([t.value for t in self._topics])
         )
 
+    def _build_batch_prompt(self, reviews: list[str]) -> str:
+        numbered = "\n".join(
+            f"  [{number}] {" ".join(review.split())}"
+            for number, review in enumerate(reviews, start=1)
+        )
+        return self._batch_prompt_template.replace("$Reviews$", numbered).replace(
+            "$Topics$", ",".join([t.value for t in self._topics])
+        )
+
+    def _pack_batches(
+        self, items: Iterable[tuple[int, str]]
+    ) -> Iterator[list[tuple[int, str]]]:
+        """Groups a stream of reviews into batches of at most `batch_size` reviews
+
+        A batch is also closed before its reviews would exceed `batch_tokens`
+        (estimated from the length), a longer review makes up a batch on its own.
+        """
+        batch: list[tuple[int, str]] = []
+        tokens = 0
+        for id, review in items:
+            review_tokens = len(review) // CHARS_PER_TOKEN + 1
+            if batch and (
+                len(batch) == self._batch_size
+                or tokens + review_tokens > self._batch_tokens
+            ):
+                yield batch
+                batch, tokens = [], 0
+            batch.append((id, review))
+            tokens += review_tokens
+        if batch:
+            yield batch
+
     def _make_default_options(self):
         return Options(temperature=0.3)
 
-    def _make_default_client(self, options: Options):
-        client = Client()
+    def _make_default_client(self):
+        # one pooled keep-alive connection per request in flight
+        return Client(
+            timeout=self._timeout,
+            limits=httpx.Limits(max_keepalive_connections=max(self._concurrency, 20)),
+        )
 
-        msg: Message = Message(role="system", content=self._system_prompt)
-        client.chat(str(self._model), messages=[msg], options=options)
 
-        return client
+def topics_schema(topics: list[Topic], reviews: int | None = None) -> dict:
+    """JSON schema of a structured answer, used as ollama `format`
+
+    Args:
+        topics: the allowed topics
+        reviews: number of reviews of a batch prompt, None for a single review
+
+    Returns:
+        schema of `{"topics": [...]}` or for batches `{"1": [...], "2": [...], ...}`
+    """
+    topic_list = {
+        "type": "array",
+        "items": {"type": "string", "enum": [t.value for t in topics]},
+    }
+    if reviews is None:
+        keys = ["topics"]
+    else:
+        keys = [str(number) for number in range(1, reviews + 1)]
+    return {
+        "type": "object",
+        "properties": {key: topic_list for key in keys},
+        "required": keys,
+    }
+
+
+def default_topics() -> list[Topic]:
+    return [Topic(t) for t in DEFAULT_TOPICS]
+
+
+def load_prompts(version: int) -> tuple[str, str]:
+    """Reads the prompts of a prompt version
+
+    Returns:
+        system prompt and prompt template
+    """
+    with open(PROMPT_VERSIONS[version]["systemfile"], "r", encoding="utf-8") as f:
+        sys_prompt = f.read()
+    with open(PROMPT_VERSIONS[version]["promptfile"], "r", encoding="utf-8") as f:
+        prompt_template = f.read()
+    return sys_prompt, prompt_template
+
+
+def annotated_reviews(n: int = -1) -> tuple[list[int], list[str]]:
+    """Review ids and texts of the label studio export (the ground truth)"""
+    with open(JSON_PATH, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    if n > 0:
+        entries = entries[:n]
+    ids = [entry["data"]["review_id"] for entry in entries]
+    reviews = [str(entry["data"]["review"]) for entry in entries]
+    return ids, reviews
 
 
 def read_review_csv(file: str, rrow: str = "review"):
@@ -223,7 +793,7 @@ def read_review_csv(file: str, rrow: str = "review"):
 def read_review_panda(
     file: str, columns: list[str] = ["recommendationid", "review"], n: int = 100
 ):
-    csv = read_csv(file, compression="bz2", low_memory=False)
+    csv = load_corpus(file)
 
     print(csv.columns)
     sample = csv.sample(n=n)
@@ -241,11 +811,10 @@ def ids_reviews_from_json(n: int = -1):
     ann_mappings = lstudio_label_mapping_to_dict(JSON_MIN_PATH)
 
     # load the original dataset
-    reviews_df = read_csv("../../data/reviews_100k.csv.bz2", low_memory=False)
-    reviews_df["review"] = reviews_df["review"].astype(str)
+    reviews_df = load_corpus(f"{DATA_DIR}reviews_100k.csv.bz2")
 
     # update the dataset with the new annotations (all rows not covered will have NaN)
-    reviews_labeled = update_df_review_labels(reviews_df, ann_mappings, mode="dummy")
+    reviews_labeled, _ = update_df_review_labels(reviews_df, ann_mappings, mode="dummy")
 
     # drop all reviews which are not yet annotated
     ann_reviews = reviews_labeled.dropna()
@@ -260,6 +829,19 @@ def ids_reviews_from_json(n: int = -1):
     return ids, reviews
 
 
+def keep_alive_value(value: str) -> float | str:
+    """`--keep-alive` argument: numbers are seconds (-1 = forever), others durations like "30m"
+
+    ollama parses a string as a Go duration, which needs a unit, so "-1" has
+    to be sent as a number.
+    """
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    return int(number) if number.is_integer() else number
+
+
 def setup_args():
     """Set up arguments for ollama script
 
@@ -289,52 +871,330 @@ def setup_args():
         default=Model.LLAMA3B,
         help="Model to use [default] LLAMA3B",
     )
+    ap.add_argument(
+        "-j",
+        "--concurrency",
+        type=int,
+        default=1,
+        help="number of requests kept in flight [default] 1",
+    )
+    ap.add_argument(
+        "-t",
+        "--timeout",
+        type=float,
+        default=None,
+        help="timeout per request in seconds [default] no timeout",
+    )
+    ap.add_argument(
+        "-r",
+        "--retries",
+        type=int,
+        default=2,
+        help="retries per request on transient errors [default] 2",
+    )
+    ap.add_argument(
+        "--cache",
+        type=str,
+        default=DEFAULT_CACHE_PATH,
+        help=f"response cache file [default] {DEFAULT_CACHE_PATH}",
+    )
+    ap.add_argument(
+        "--no-cache",
+        action="store_true",
+        default=False,
+        help="always ask the model, do not read or write the response cache",
+    )
+    ap.add_argument(
+        "--cache-max-entries",
+        type=int,
+        default=None,
+        help="evict least recently used cache entries above this count",
+    )
+    ap.add_argument(
+        "--cache-max-age",
+        type=float,
+        default=None,
+        help="evict cache entries older than this many days",
+    )
+    ap.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="continue the run from its checkpoint and skip finished reviews",
+    )
+    ap.add_argument(
+        "--checkpoint",
+        type=str,
+        default=None,
+        help="checkpoint file [default] ./results/<prefix>-v<version>-n<number>-<model>-<config hash>.jsonl",
+    )
+    ap.add_argument(
+        "--synonyms",
+        type=str,
+        default=None,
+        help="also match the synonyms of this file (format of docs/topics.txt) in the answers",
+    )
+    ap.add_argument(
+        "-k",
+        "--batch-size",
+        type=int,
+        default=1,
+        help="reviews per prompt (> 1 uses the batch prompt template)",
+    )
+    ap.add_argument(
+        "--batch-tokens",
+        type=int,
+        default=1024,
+        help="estimated token budget of the reviews of one batch prompt",
+    )
+    ap.add_argument(
+        "--structured",
+        action="store_true",
+        default=False,
+        help="constrain the answers to a JSON list of the topics",
+    )
+    ap.add_argument(
+        "--num-predict",
+        type=int,
+        default=None,
+        help="maximum number of tokens the model may generate per request",
+    )
+    ap.add_argument(
+        "--hosts",
+        type=str,
+        nargs="+",
+        default=None,
+        help="spread the requests over these ollama hosts (e.g. http://gpu1:11434)",
+    )
+    ap.add_argument(
+        "--routing",
+        choices=["least_loaded", "round_robin"],
+        default="least_loaded",
+        help="how requests are assigned to the --hosts",
+    )
+    ap.add_argument(
+        "--keep-alive",
+        type=keep_alive_value,
+        default="30m",
+        help="how long ollama keeps the model loaded after a request (e.g. 30m, -1 = forever)",
+    )
+    ap.add_argument(
+        "--stream",
+        action="store_true",
+        default=False,
+        help="stream the answers to measure the time to the first token",
+    )
+    ap.add_argument(
+        "--log-every",
+        type=int,
+        default=100,
+        help="log prompt, answer and topics of every n-th review only (0 => never)",
+    )
+    ap.add_argument(
+        "--cost-per-hour",
+        type=float,
+        default=None,
+        help="price of an hour of the ollama hosts, to report the cost per 1k reviews",
+    )
+    ap.add_argument(
+        "--live-eval",
+        action="store_true",
+        default=False,
+        help="evaluate the answers against the annotations while the run is going",
+    )
+    ap.add_argument(
+        "--abort-below",
+        type=float,
+        default=None,
+        help="abort the run if the live micro F1 is below this value (implies --live-eval)",
+    )
+    ap.add_argument(
+        "--abort-after",
+        type=int,
+        default=200,
+        help="reviews to classify before --abort-below applies [default] 200",
+    )
+    ap.add_argument(
+        "--cascade",
+        type=str,
+        default=None,
+        help="label confident reviews with this local pre-classifier (see cascade.py) instead of the LLM",
+    )
+    ap.add_argument(
+        "--dedup",
+        type=str,
+        default=None,
+        help="classify one review per duplicate cluster of this index (see dedup.py) and copy its topics",
+    )
     return ap.parse_args()
 
 
+def make_client(args) -> BackendPool | None:
+    """Creates the backend pool if the arguments list several hosts
+
+    Returns:
+        the pool or None to let the classifier create its default client
+    """
+    if not args.hosts:
+        return None
+    pool = BackendPool(args.hosts, routing=args.routing, timeout=args.timeout)
+    print(f"hosts: {pool.health_check()}")
+    pool.start_health_checks()
+    return pool
+
+
+def write_failed_ids(o: OllamaClassifier, results_file: str) -> None:
+    """Writes the ids of the reviews whose request failed next to the results"""
+    if not o.failed_ids:
+        return
+    failed_file = results_file.removesuffix(".json") + ".failed.json"
+    print(f"{len(o.failed_ids)} requests failed, ids in {failed_file}")
+    with open(failed_file, "w") as f:
+        json.dump(o.failed_ids, f)
+
+
+def write_metrics(o: OllamaClassifier, results_file: str, args) -> None:
+    """Writes the metrics summary of the run to `<results>.metrics.json`"""
+    metrics_file = results_file.removesuffix(".json") + ".metrics.json"
+    summary = o.metrics.write(
+        metrics_file,
+        cost_per_hour=args.cost_per_hour,
+        model=str(args.model),
+        prompt_version=args.prompt_version,
+        number=args.number,
+        concurrency=args.concurrency,
+        batch_size=args.batch_size,
+        structured=args.structured,
+        hosts=args.hosts,
+    )
+    latency = "/".join(
+        "-" if summary[f"latency {p}"] is None else f"{summary[f"latency {p}"]:.2f}"
+        for p in ("p50", "p95", "p99")
+    )
+    print(
+        f"{summary['reviews']} reviews in {summary['wall seconds']:.1f}s "
+        f"({summary['reviews/sec']:.2f}/s), latency p50/p95/p99 {latency}s, "
+        f"error rate {summary['error rate']:.3f}, metrics in {metrics_file}"
+    )
+
+
+def load_batch_prompt(args) -> str | None:
+    """Reads the batch prompt template if the arguments ask for batches"""
+    if args.batch_size <= 1:
+        return None
+    with open(BATCH_PROMPT_FILE, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def run_fingerprint(args, **settings) -> str:
+    """Short hash of the arguments that change the answers of a run
+
+    Args:
+        args: command line arguments, `RUN_CONFIG_ARGS` missing in them count as None
+        settings: further settings of the run, e.g. the ollama options of a sweep run
+    """
+    config = {name: getattr(args, name, None) for name in RUN_CONFIG_ARGS}
+    config.update(settings)
+    payload = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=4).hexdigest()
+
+
+def make_checkpoint(args, prefix: str) -> JsonlCheckpoint:
+    """Opens the checkpoint of the run configured by the command line arguments
+
+    The default file name has no timestamp so that `--resume` finds the
+    checkpoint of the interrupted run with the same version, number, model and
+    `run_fingerprint`, runs with other settings never continue each other.
+    """
+    path = args.checkpoint
+    if path is None:
+        path = f"./results/{prefix}-v{args.prompt_version}-n{args.number if args.number > 0 else "all"}-{str(args.model)}-{run_fingerprint(args)}.jsonl".replace(
+            ":", "_"
+        )
+    return JsonlCheckpoint(path, resume=args.resume)
+
+
+def make_cache(args) -> ResponseCache | None:
+    """Opens the response cache configured by the command line arguments"""
+    if args.no_cache:
+        return None
+    return ResponseCache(
+        args.cache,
+        max_entries=args.cache_max_entries,
+        max_age=args.cache_max_age * 24 * 3600 if args.cache_max_age else None,
+    )
+
+
 def main():
     args = setup_args()
-    versions = {
-        1: {
-            "promptfile": f"{PROMPTDIR}prompt_v1.txt",
-            "systemfile": f"{PROMPTDIR}system_v1.txt",
-        },
-        2: {
-            "promptfile": f"{PROMPTDIR}prompt_v2.txt",
-            "systemfile": f"{PROMPTDIR}system_v2.txt",
-        },
-        3: {
-            "promptfile": f"{PROMPTDIR}prompt_v3.txt",
-            "systemfile": f"{PROMPTDIR}system_v3.txt",
-        },
-    }
     basicConfig(level=INFO, filename="./ollama_log.txt", filemode="w")
-    with open(versions[args.prompt_version]["systemfile"], "r", encoding='utf-8') as f:
-        sys_prompt = f.read()
-    with open(versions[args.prompt_version]["promptfile"], "r", encoding='utf-8') as f:
-        prompt_template = f.read()
+    sys_prompt, prompt_template = load_prompts(args.prompt_version)
 
+    cache = make_cache(args)
+    pool = make_client(args)
     ids, reviews = ids_reviews_from_json(n=args.number)
+    copies = {}
+    if args.dedup:
+        ids, reviews, copies = collapse_reviews(args.dedup, ids, reviews)
     print(f"info: {len(reviews)}")
-    topics = [
-        Topic(t)
-        for t in [
-            "gamemode",
-            "bugs",
-            "visuals",
-            "sound",
-            "hardware_requirements",
-            "price",
-            "gameplay",
-            "story",
-            "support",
-            "online_play",
-            "updates",
-            "seasonal_content",
-        ]
-    ]
-    o = OllamaClassifier(args.model, sys_prompt, prompt_template, reviews, ids, topics)
-    data = o.get_all_topic_eval()
+    topics = default_topics()
+    o = OllamaClassifier(
+        args.model,
+        sys_prompt,
+        prompt_template,
+        reviews,
+        ids,
+        topics,
+        concurrency=args.concurrency,
+        timeout=args.timeout,
+        retries=args.retries,
+        cache=cache,
+        synonyms=load_synonyms(args.synonyms) if args.synonyms else None,
+        batch_size=args.batch_size,
+        batch_tokens=args.batch_tokens,
+        batch_prompt_template=load_batch_prompt(args),
+        structured=args.structured,
+        num_predict=args.num_predict,
+        client=pool,
+        keep_alive=args.keep_alive,
+        stream=args.stream,
+        log_every=args.log_every,
+    )
+    if pool is not None:
+        o.preload()
+    evaluator = None
+    if args.live_eval or args.abort_below is not None:
+        evaluator = IncrementalEvaluator.from_annotations(JSON_PATH)
+    try:
+        with make_checkpoint(args, "checkpoint") as checkpoint:
+            if args.cascade:
+                prelabel(args.cascade, ids, reviews, checkpoint)
+            data = o.get_all_topic_eval(
+                checkpoint=checkpoint,
+                evaluator=evaluator,
+                abort_below=args.abort_below,
+                abort_after=args.abort_after,
+            )
+    except RunAborted as e:
+        print(f"aborted: {e}, continue with --resume")
+        data = None
+    if evaluator is not None:
+        scores = evaluator.summary()
+        print(
+            f"live evaluation of {scores['reviews']} reviews: "
+            f"micro F1 {scores['Micro F1']:.3f}, macro F1 {scores['Macro F1']:.3f}"
+        )
+    if args.batch_size > 1:
+        print(f"batches: {o.batch_stats}")
+    if pool is not None:
+        print(f"hosts: {pool.stats()}")
+        pool.close()
+    if cache is not None:
+        print(f"cache: {cache.stats()}")
+        cache.close()
+    if data is None:
+        return
+    data = fan_out(data, copies)
     json_file_name = f"./results/results-v{args.prompt_version}-{datetime.now().isoformat()}-n{args.number if args.number > 0 else "all"}-{str(args.model)}.json".replace(
         ":", "_"
     )
@@ -344,6 +1204,8 @@ def main():
         "w",
     ) as f:
         json.dump(data, f)
+    write_failed_ids(o, json_file_name)
+    write_metrics(o, json_file_name, args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,103 @@
+"""bounded concurrent execution of blocking requests
+
+Small helpers to keep a fixed number of (blocking) LLM requests in flight
+without reading the whole input into memory and to retry transient failures.
+"""
+
+import time
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from logging import Logger, getLogger
+from typing import TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def bounded_map(
+    fn: Callable[[T], R],
+    items: Iterable[T],
+    concurrency: int = 1,
+    max_pending: int | None = None,
+) -> Iterator[R]:
+    """Applies `fn` to every item on a bounded worker pool
+
+    Results are yielded in completion order. `items` is consumed lazily: a new
+    item is only pulled once fewer than `max_pending` calls are in flight, so a
+    slow server applies backpressure all the way up to the reader.
+
+    Args:
+        fn: blocking function that is called once per item
+        items: (possibly lazy) iterable of inputs
+        concurrency: number of worker threads, 1 runs everything inline
+        max_pending: maximum number of submitted but unfinished calls
+            [default] 2 * concurrency
+
+    Yields:
+        the results of `fn` as they complete
+    """
+    if concurrency <= 1:
+        yield from map(fn, items)
+        return
+
+    if max_pending is None:
+        max_pending = 2 * concurrency
+    max_pending = max(max_pending, concurrency)
+
+    pool = ThreadPoolExecutor(max_workers=concurrency)
+    pending: set[Future[R]] = set()
+    try:
+        for item in items:
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(pool.submit(fn, item))
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        # on Ctrl-C or an early break do not wait for queued requests
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def call_with_retries(
+    fn: Callable[[], R],
+    retries: int = 2,
+    retry_on: tuple[type[BaseException], ...] = (Exception,),
+    backoff: float = 0.5,
+    logger: Logger = getLogger(__name__),
+    retry_if: Callable[[BaseException], bool] | None = None,
+) -> R:
+    """Calls `fn` and retries it with exponential backoff on transient errors
+
+    Args:
+        fn: function without arguments to call
+        retries: number of additional attempts after the first failure
+        retry_on: exception types that are considered transient
+        retry_if: further filter of the `retry_on` exceptions, the ones it
+            returns False for are raised right away
+        backoff: sleep before the first retry in seconds, doubled every retry
+        logger: logger for the retry warnings
+
+    Raises:
+        the last exception if all attempts failed
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except retry_on as e:
+            if attempt >= retries or (retry_if is not None and not retry_if(e)):
+                raise
+            delay = backoff * 2**attempt
+            attempt += 1
+            logger.warning(
+                f"request failed ({type(e).__name__}: {e}), "
+                f"retry {attempt}/{retries} in {delay:.1f}s"
+            )
+            time.sleep(delay)
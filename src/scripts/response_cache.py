@@ -0,0 +1,176 @@
+"""persistent content-addressed cache for LLM responses
+
+The cache maps a hash of (model, rendered prompt, options) to the answer of the
+model and lives in a single SQLite file, so re-running an evaluation with the
+same prompt version, model and options does not hit the ollama server again.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Mapping
+from typing import Any
+
+DEFAULT_CACHE_PATH = "./cache/responses.sqlite"
+
+
+class ResponseCache:
+    """SQLite backed response cache with size and age based eviction
+
+    Args:
+        path: path of the SQLite file (parent directories are created)
+        max_entries: keep at most this many entries, least recently used
+            entries are evicted first (None => unbounded)
+        max_age: evict entries older than this many seconds (None => never)
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_PATH,
+        max_entries: int | None = None,
+        max_age: float | None = None,
+    ) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # the classifier calls the cache from its worker threads
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )""")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+        )
+        self._conn.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(
+        model: str,
+        prompt: str,
+        options: Mapping[str, Any] | None,
+        format: str | dict[str, Any] | None = None,
+        system: str | None = None,
+    ) -> str:
+        """Builds the cache key for a request
+
+        Args:
+            model: name of the model
+            prompt: fully rendered prompt
+            options: ollama options of the request
+            format: output format (e.g. a JSON schema) of the request
+            system: system prompt sent with the request
+
+        Returns:
+            hex sha256 digest of the canonical JSON of all inputs
+        """
+        if options is None:
+            opts = {}
+        elif hasattr(options, "model_dump"):
+            opts = options.model_dump(exclude_none=True)
+        else:
+            opts = {k: v for k, v in dict(options).items() if v is not None}
+        inputs = {"model": str(model), "prompt": prompt, "options": opts}
+        # only added when set so that keys of plain requests stay the same
+        if format is not None:
+            inputs["format"] = format
+        if system is not None:
+            inputs["system"] = system
+        payload = json.dumps(
+            inputs,
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (
+                self.max_age is not None and now - row[1] > self.max_age
+            ):
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, response: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, response, now, now),
+            )
+            self._conn.commit()
+
+    def evict(self) -> int:
+        """Removes expired entries and shrinks the cache to `max_entries`
+
+        Returns:
+            number of evicted entries
+        """
+        evicted = 0
+        with self._lock:
+            if self.max_age is not None:
+                cur = self._conn.execute(
+                    "DELETE FROM responses WHERE created < ?",
+                    (time.time() - self.max_age,),
+                )
+                evicted += cur.rowcount
+            if self.max_entries is not None:
+                cur = self._conn.execute(
+                    """DELETE FROM responses WHERE key IN (
+                        SELECT key FROM responses ORDER BY accessed DESC
+                        LIMIT -1 OFFSET ?
+                    )""",
+                    (self.max_entries,),
+                )
+                evicted += cur.rowcount
+            self._conn.commit()
+        return evicted
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def stats(self) -> dict[str, int | float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self),
+        }
+
+    def close(self) -> None:
+        self.evict()
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self) -> "ResponseCache":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
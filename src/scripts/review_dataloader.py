@@ -1,6 +1,8 @@
 import pandas as pd
 from torch.utils.data import Dataset
 
+from corpus import load_corpus
+
 
 class SteamReviewDataset_old(Dataset):
     """Minimal PyTorch Dataloader for our dataset, see also https://pytorch.org/tutorials/beginner/basics/data_tutorial.html
@@ -20,8 +22,7 @@ class SteamReviewDataset_old(Dataset):
     def __init__(
         self, fi_path: str = None, target: str = "voted_up", shuffle: bool = False
     ):
-        self.reviews_df = pd.read_csv(fi_path, low_memory=False)
-        self.reviews_df["review"] = self.reviews_df["review"].astype(str)
+        self.reviews_df = load_corpus(fi_path)
 
         if shuffle:
             self.reviews_df = self.reviews_df.sample(frac=1).reset_index(drop=True)
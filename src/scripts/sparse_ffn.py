@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+"""sparse training of the TF-IDF feed-forward classifier
+
+`ffn_review_classifier.ipynb` turns every TF-IDF row into a dense vector of
+all (3.3M) n-gram features before it reaches the model, although a review
+only has a few hundred non-zero features. Here the batches stay sparse from
+the vectorizer to the first layer:
+
+- `fit_vectorizer` fits a `TfidfVectorizer` (optionally capped with
+  `max_features`/`min_df`) or a `HashingVectorizer` + TF-IDF weighting with a
+  fixed number of features, and caches the fitted vectorizer and the
+  transformed training matrix under a hash of the parameters and the texts
+- `SparseBatches` slices batches of CSR rows and hands them to the model as
+  `nn.EmbeddingBag` input (indices, offsets, TF-IDF weights) or as
+  `torch.sparse` CSR tensors
+- `SparseFFN` is the `BinaryClassifier` of the notebook whose first layer
+  (`SparseLinear`) is an `nn.EmbeddingBag` in sum mode, i.e. a sparse matmul.
+  With bag input its gradient is sparse as well, so `SparseAdam` only updates
+  the rows of the n-grams in the batch instead of all 3.3M x 128 weights
+
+Usage:
+    python sparse_ffn.py --csv ../../data/reviews_100k.csv.bz2
+    python sparse_ffn.py --vectorizer hashing --n-features 1048576 --epochs 3
+    python sparse_ffn.py --max-features 500000 --input sparse
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser
+from collections.abc import Iterator, Sequence
+from typing import Literal
+
+import numpy as np
+import scipy.sparse as sp
+import torch
+import torch.nn as nn
+from sklearn.feature_extraction.text import (
+    HashingVectorizer,
+    TfidfTransformer,
+    TfidfVectorizer,
+)
+from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score
+from sklearn.model_selection import train_test_split
+from sklearn.pipeline import make_pipeline
+from tqdm import tqdm
+
+from corpus import load_corpus
+from token_store import texts_fingerprint
+
+DEFAULT_CACHE_DIR = "../../data/vectorizer_cache"
+
+Input = Literal["bag", "sparse"]
+# (indices, offsets, per sample weights) of an `nn.EmbeddingBag`
+BagInput = tuple[torch.Tensor, torch.Tensor, torch.Tensor]
+
+
+def make_vectorizer(
+    kind: Literal["tfidf", "hashing"] = "tfidf",
+    ngram_max: int = 3,
+    max_features: int | None = None,
+    min_df: int = 1,
+    n_features: int = 2**22,
+):
+    """TF-IDF vectorizer of word 1..`ngram_max`-grams
+
+    Args:
+        kind: "tfidf" learns the vocabulary, "hashing" hashes the n-grams into
+            `n_features` columns (no vocabulary in memory, collisions possible)
+        max_features: keep only the most frequent n-grams (tfidf only)
+        min_df: drop n-grams in fewer reviews (tfidf only)
+        n_features: number of hash buckets (hashing only)
+    """
+    if kind == "tfidf":
+        return TfidfVectorizer(
+            ngram_range=(1, ngram_max),
+            max_features=max_features,
+            min_df=min_df,
+            dtype=np.float32,
+        )
+    if kind == "hashing":
+        return make_pipeline(
+            HashingVectorizer(
+                ngram_range=(1, ngram_max),
+                n_features=n_features,
+                alternate_sign=False,
+                norm=None,
+                dtype=np.float32,
+            ),
+            TfidfTransformer(),
+        )
+    raise ValueError(f"unknown vectorizer '{kind}'")
+
+
+def fit_vectorizer(
+    texts: Sequence[str], cache_dir: str | None = DEFAULT_CACHE_DIR, **params
+) -> tuple[object, sp.csr_matrix]:
+    """Fits the vectorizer of `make_vectorizer(**params)` on the texts and transforms them
+
+    The fitted vectorizer and the matrix are cached in
+    `<cache_dir>/<hash of params and texts>/`, so a second run on the same
+    training split skips the fit. `cache_dir=None` disables the cache.
+
+    Returns:
+        fitted vectorizer and (texts, features) float32 CSR matrix
+    """
+    key = json.dumps(params, sort_keys=True) + texts_fingerprint(texts)
+    directory = None
+    if cache_dir is not None:
+        directory = os.path.join(
+            cache_dir, hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+        )
+        if os.path.exists(os.path.join(directory, "matrix.npz")):
+            with open(os.path.join(directory, "vectorizer.pkl"), "rb") as f:
+                vectorizer = pickle.load(f)
+            return (
+                vectorizer,
+                sp.load_npz(os.path.join(directory, "matrix.npz")).tocsr(),
+            )
+
+    vectorizer = make_vectorizer(**params)
+    matrix = vectorizer.fit_transform(texts).astype(np.float32).tocsr()
+    if directory is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp-")
+        try:
+            with open(os.path.join(tmp, "vectorizer.pkl"), "wb") as f:
+                pickle.dump(vectorizer, f)
+            sp.save_npz(os.path.join(tmp, "matrix.npz"), matrix, compressed=False)
+            if os.path.exists(directory):
+                shutil.rmtree(directory)
+            os.replace(tmp, directory)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+    return vectorizer, matrix
+
+
+def to_bag(rows: sp.csr_matrix) -> BagInput:
+    """`nn.EmbeddingBag` input of CSR rows: column indices, row offsets and values"""
+    return (
+        torch.from_numpy(rows.indices.astype(np.int64)),
+        torch.from_numpy(rows.indptr[:-1].astype(np.int64)),
+        torch.from_numpy(rows.data.astype(np.float32)),
+    )
+
+
+def to_sparse_tensor(rows: sp.csr_matrix) -> torch.Tensor:
+    """CSR rows as a `torch.sparse_csr_tensor`"""
+    return torch.sparse_csr_tensor(
+        torch.from_numpy(rows.indptr.astype(np.int64)),
+        torch.from_numpy(rows.indices.astype(np.int64)),
+        torch.from_numpy(rows.data.astype(np.float32)),
+        size=rows.shape,
+        check_invariants=False,
+    )
+
+
+class SparseBatches:
+    """Batches of sparse feature rows and labels, sliced from a CSR matrix
+
+    Args:
+        x: (reviews, features) CSR matrix
+        y: labels, (reviews,) or (reviews, outputs)
+        batch_size: reviews per batch
+        shuffle: new random order every epoch
+        input: "bag" yields `nn.EmbeddingBag` input, "sparse" a torch sparse CSR tensor
+        seed: seed of the shuffling
+    """
+
+    def __init__(
+        self,
+        x: sp.csr_matrix,
+        y: np.ndarray,
+        batch_size: int = 256,
+        shuffle: bool = True,
+        input: Input = "bag",
+        seed: int | None = None,
+    ) -> None:
+        if input not in ("bag", "sparse"):
+            raise ValueError(f"unknown input '{input}'")
+        self.x = x.tocsr().astype(np.float32)
+        self.y = torch.from_numpy(np.asarray(y, dtype=np.float32))
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.input = input
+        self.rng = np.random.default_rng(seed)
+
+    def __len__(self) -> int:
+        return (self.x.shape[0] + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self) -> Iterator[tuple[BagInput | torch.Tensor, torch.Tensor]]:
+        n = self.x.shape[0]
+        order = self.rng.permutation(n) if self.shuffle else np.arange(n)
+        convert = to_bag if self.input == "bag" else to_sparse_tensor
+        for start in range(0, n, self.batch_size):
+            idx = order[start : start + self.batch_size]
+            yield convert(self.x[idx]), self.y[idx]
+
+
+def to_device(
+    inputs: BagInput | torch.Tensor, device: torch.device
+) -> BagInput | torch.Tensor:
+    if isinstance(inputs, tuple):
+        return tuple(t.to(device) for t in inputs)
+    return inputs.to(device)
+
+
+class SparseLinear(nn.Module):
+    """Linear layer on sparse input, the weight (in, out) is stored in an `nn.EmbeddingBag`
+
+    Bag input is a weighted sum of the weight rows of the present features,
+    which is exactly `x @ weight`; with `sparse_grad` its gradient only
+    contains those rows (train with `SparseAdam`, see `make_optimizers`).
+    A torch sparse tensor is multiplied with `torch.sparse.mm`, its gradient
+    is dense, so it needs `sparse_grad=False`.
+    """
+
+    def __init__(
+        self, in_features: int, out_features: int, sparse_grad: bool = True
+    ) -> None:
+        super().__init__()
+        self.bag = nn.EmbeddingBag(
+            in_features, out_features, mode="sum", sparse=sparse_grad
+        )
+        self.bias = nn.Parameter(torch.empty(out_features))
+        # same initialization as nn.Linear
+        bound = 1 / in_features**0.5
+        nn.init.uniform_(self.bag.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x: BagInput | torch.Tensor) -> torch.Tensor:
+        if isinstance(x, tuple):
+            indices, offsets, weights = x
+            return self.bag(indices, offsets, per_sample_weights=weights) + self.bias
+        if self.bag.sparse and torch.is_grad_enabled():
+            raise ValueError(
+                "torch sparse tensor input needs SparseLinear(sparse_grad=False)"
+            )
+        return torch.sparse.mm(x, self.bag.weight) + self.bias
+
+
+class SparseFFN(nn.Module):
+    """BinaryClassifier of `ffn_review_classifier.ipynb` with a sparse first layer
+
+    Returns logits (train with `BCEWithLogitsLoss`) instead of the sigmoid
+    outputs of the notebook.
+
+    Args:
+        input_dim: number of features of the vectorizer
+        hidden_dims: sizes of the hidden layers
+        dropout: dropout after every hidden layer
+        output_dim: 1 for the sentiment, one per topic
+        sparse_grad: sparse gradient of the first layer (bag input only)
+    """
+
+    def __init__(
+        self,
+        input_dim: int,
+        hidden_dims: Sequence[int] = (128, 64),
+        dropout: float = 0.3,
+        output_dim: int = 1,
+        sparse_grad: bool = True,
+    ) -> None:
+        super().__init__()
+        self.input = SparseLinear(input_dim, hidden_dims[0], sparse_grad)
+        layers: list[nn.Module] = [nn.ReLU(), nn.Dropout(dropout)]
+        for a, b in zip(hidden_dims, hidden_dims[1:]):
+            layers += [nn.Linear(a, b), nn.ReLU(), nn.Dropout(dropout)]
+        layers.append(nn.Linear(hidden_dims[-1], output_dim))
+        self.head = nn.Sequential(*layers)
+
+    def forward(self, x: BagInput | torch.Tensor) -> torch.Tensor:
+        return self.head(self.input(x))
+
+
+def make_optimizers(model: nn.Module, lr: float) -> list[torch.optim.Optimizer]:
+    """`SparseAdam` for the embedding bags with sparse gradients, `Adam` for the rest"""
+    sparse = {
+        id(p)
+        for m in model.modules()
+        if isinstance(m, nn.EmbeddingBag) and m.sparse
+        for p in m.parameters()
+    }
+    sparse_params = [p for p in model.parameters() if id(p) in sparse]
+    dense_params = [p for p in model.parameters() if id(p) not in sparse]
+    optimizers: list[torch.optim.Optimizer] = [torch.optim.Adam(dense_params, lr=lr)]
+    if sparse_params:
+        optimizers.append(torch.optim.SparseAdam(sparse_params, lr=lr))
+    return optimizers
+
+
+def train_model(
+    model: SparseFFN,
+    batches: SparseBatches,
+    epochs: int = 5,
+    lr: float = 1e-3,
+    device: torch.device = torch.device("cpu"),
+) -> list[float]:
+    """Trains the model, returns the average loss of every epoch"""
+    model.to(device)
+    criterion = nn.BCEWithLogitsLoss()
+    optimizers = make_optimizers(model, lr)
+    losses = []
+    for epoch in range(epochs):
+        model.train()
+        total_loss = 0.0
+        progress = tqdm(batches, desc=f"Epoch {epoch + 1}/{epochs}", unit="batch")
+        for inputs, labels in progress:
+            inputs, labels = to_device(inputs, device), labels.to(device)
+            for optimizer in optimizers:
+                optimizer.zero_grad()
+            outputs = model(inputs)
+            loss = criterion(outputs.view_as(labels), labels)
+            loss.backward()
+            for optimizer in optimizers:
+                optimizer.step()
+            total_loss += loss.item()
+        losses.append(total_loss / max(len(batches), 1))
+        print(f"Epoch {epoch + 1}/{epochs} completed. Average Loss: {losses[-1]:.4f}")
+    return losses
+
+
+def predict_proba(
+    model: SparseFFN,
+    x: sp.csr_matrix,
+    batch_size: int = 1024,
+    input: Input = "bag",
+    device: torch.device = torch.device("cpu"),
+) -> np.ndarray:
+    """Probabilities (reviews, outputs) of the rows of a CSR matrix"""
+    model.to(device).eval()
+    batches = SparseBatches(
+        x, np.zeros(x.shape[0]), batch_size, shuffle=False, input=input
+    )
+    res = []
+    with torch.inference_mode():
+        for inputs, _ in batches:
+            res.append(torch.sigmoid(model(to_device(inputs, device))).cpu().numpy())
+    return (
+        np.concatenate(res)
+        if res
+        else np.empty((0, model.head[-1].out_features), dtype=np.float32)
+    )
+
+
+def main():
+    ap = ArgumentParser()
+    ap.add_argument("-c", "--csv", type=str, default="../../data/reviews_100k.csv.bz2")
+    ap.add_argument(
+        "-n", "--number", type=int, default=None, help="reviews to use [default] all"
+    )
+    ap.add_argument("--vectorizer", choices=["tfidf", "hashing"], default="tfidf")
+    ap.add_argument("--ngram-max", type=int, default=3)
+    ap.add_argument(
+        "--max-features", type=int, default=None, help="cap of the tfidf vocabulary"
+    )
+    ap.add_argument(
+        "--min-df",
+        type=int,
+        default=1,
+        help="minimum document frequency of the tfidf vocabulary",
+    )
+    ap.add_argument(
+        "--n-features",
+        type=int,
+        default=2**22,
+        help="hash buckets of the hashing vectorizer",
+    )
+    ap.add_argument("--cache-dir", type=str, default=DEFAULT_CACHE_DIR)
+    ap.add_argument("--no-cache", action="store_true", default=False)
+    ap.add_argument("--input", choices=["bag", "sparse"], default="bag")
+    ap.add_argument("--epochs", type=int, default=5)
+    ap.add_argument("--batch-size", type=int, default=256)
+    ap.add_argument("--lr", type=float, default=1e-3)
+    ap.add_argument("--seed", type=int, default=42)
+    args = ap.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(args.seed)
+    df = load_corpus(args.csv, columns=["review", "voted_up"])
+    df = df.sample(frac=1, random_state=args.seed).reset_index(drop=True)
+    if args.number is not None:
+        df = df.head(args.number)
+    x_train_raw, x_test_raw, y_train, y_test = train_test_split(
+        df["review"].astype(str).tolist(),
+        df["voted_up"].to_numpy(dtype=np.float32),
+        test_size=0.33,
+        random_state=42,
+    )
+
+    params = {"kind": args.vectorizer, "ngram_max": args.ngram_max}
+    if args.vectorizer == "tfidf":
+        params.update(max_features=args.max_features, min_df=args.min_df)
+    else:
+        params.update(n_features=args.n_features)
+    start = time.perf_counter()
+    vectorizer, x_train = fit_vectorizer(
+        x_train_raw, cache_dir=None if args.no_cache else args.cache_dir, **params
+    )
+    x_test = vectorizer.transform(x_test_raw).astype(np.float32).tocsr()
+    print(
+        f"vectorized {len(df):,} reviews into {x_train.shape[1]:,} features "
+        f"({x_train.nnz / x_train.shape[0]:.0f} non-zero per review) in {time.perf_counter() - start:.1f}s"
+    )
+
+    model = SparseFFN(x_train.shape[1], sparse_grad=args.input == "bag")
+    batches = SparseBatches(
+        x_train, y_train, args.batch_size, input=args.input, seed=args.seed
+    )
+    start = time.perf_counter()
+    train_model(model, batches, args.epochs, args.lr, device)
+    seconds = time.perf_counter() - start
+    print(
+        f"trained {args.epochs} epochs in {seconds:.1f}s ({args.epochs * len(y_train) / seconds:,.0f} reviews/sec) on {device}"
+    )
+
+    preds = (
+        predict_proba(model, x_test, input=args.input, device=device)[:, 0] >= 0.5
+    ).astype(np.float32)
+    print(f"Accuracy: {accuracy_score(y_test, preds):.4f}")
+    print(f"Precision: {precision_score(y_test, preds, zero_division=0):.4f}")
+    print(f"Recall: {recall_score(y_test, preds, zero_division=0):.4f}")
+    print(f"F1 Score: {f1_score(y_test, preds, zero_division=0):.4f}")
+
+
+if __name__ == "__main__":
+    main()
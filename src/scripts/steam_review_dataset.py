@@ -1,8 +1,13 @@
+from typing import Literal
+
+import numpy as np
 import pandas as pd
 import sentencepiece as spm
 import torch
 from torch.utils.data import Dataset
 
+from token_store import TokenStore
+
 
 class SteamReviewDataset(Dataset):
     def __init__(
@@ -10,16 +15,22 @@ class SteamReviewDataset(Dataset):
         data: pd.DataFrame,
         tokenizer: spm.SentencePieceProcessor,
         max_len: int = 200,
-        padding: bool = True,
+        padding: bool | Literal["longest"] = True,
         topic_mode: bool = False,
         topics: list[str] = None,
+        cache_dir: str | None = None,
     ):
         """
         Args:
             data: DataFrame mit den Reviews und Labels.
             tokenizer: SentencePiece-Tokenizer.
             max_len: Maximale Länge der Sequenzen (Padding/Truncation).
-            padding: Padding ja/nein.
+            padding: Padding ja/nein. Bei "longest" wird nur auf `max_len`
+                gekürzt und erst `batching.pad_collate` paddet auf die längste
+                Review im Batch.
+            cache_dir: Verzeichnis für den vortokenisierten TokenStore. Ist es
+                gesetzt, werden die Reviews einmalig tokenisiert und danach aus
+                der memory mapped Datei gelesen.
         """
         self.data = data
         self.tokenizer = tokenizer
@@ -29,6 +40,20 @@ class SteamReviewDataset(Dataset):
         self.topic_mode = topic_mode
         self.topics = topics
 
+        # einmal pro Split statt einmal pro Beispiel und Epoche
+        self.reviews: list[str] = self.data["review"].astype(str).tolist()
+        if self.topic_mode and self.topics is not None:
+            label_values = self.data[self.topics].to_numpy(dtype=np.float32)
+        else:
+            label_values = self.data["voted_up"].to_numpy(dtype=np.float32)
+        self.labels: torch.Tensor = torch.from_numpy(label_values)
+
+        self.token_store: TokenStore | None = None
+        if cache_dir is not None:
+            self.token_store = TokenStore.open_or_build(
+                self.reviews, tokenizer, cache_dir
+            )
+
     def __len__(self):
         return len(self.data)
 
@@ -41,21 +66,49 @@ class SteamReviewDataset(Dataset):
             tokens: Tokenisierte Review.
             label: Label des Beispiels
         """
-        row = self.data.iloc[idx]
-        review = row["review"]
+        return self.__getitems__([idx])[0]
 
-        if self.topic_mode and self.topics is not None:
-            label = self.data[self.topics].iloc[idx].values
+    def __getitems__(self, idxs: list[int]) -> list[tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Holt einen ganzen Batch mit einem Tokenizer-Aufruf und einem Label-Zugriff.
+        Wird vom DataLoader automatisch statt `__getitem__` verwendet.
+        Args:
+            idxs: Indizes der Beispiele.
+        Returns:
+            Liste von (tokens, label) Paaren wie bei `__getitem__`.
+        """
+        labels = self.labels[idxs]
+        return [
+            (self._pad(tokens), label)
+            for tokens, label in zip(self._tokens(idxs), labels)
+        ]
+
+    def token_lengths(self) -> np.ndarray:
+        """Länge jeder Review in Tokens (nach Truncation), z.B. für `LengthBucketBatchSampler`."""
+        if self.token_store is not None:
+            lengths = self.token_store.lengths
         else:
-            label = row["voted_up"]
+            lengths = np.array([len(t) for t in self._tokens(range(len(self)))])
+        if self.padding:
+            lengths = np.minimum(lengths, self.max_len)
+        return lengths
 
-        tokens = self.tokenizer.encode(review, out_type=int)
+    def _tokens(self, idxs) -> list[np.ndarray]:
+        if self.token_store is not None:
+            return [self.token_store[idx] for idx in idxs]
+        reviews = [self.reviews[idx] for idx in idxs]
+        return [
+            np.asarray(t, dtype=np.int64)
+            for t in self.tokenizer.encode(reviews, out_type=int)
+        ]
 
+    def _pad(self, tokens: np.ndarray) -> torch.Tensor:
         # Padding und Truncation
         if self.padding:
-            if len(tokens) > self.max_len:
-                tokens = tokens[: self.max_len]
-            else:
-                tokens = tokens + [self.padding_char] * (self.max_len - len(tokens))
-        # print(f"tokens = {tokens}, label(s) = {label}")
-        return torch.tensor(tokens), torch.tensor(label, dtype=torch.float32)
+            tokens = tokens[: self.max_len]
+        out = torch.from_numpy(tokens.astype(np.int64))
+        if self.padding is True and len(out) < self.max_len:
+            out = torch.nn.functional.pad(
+                out, (0, self.max_len - len(out)), value=self.padding_char
+            )
+        return out
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""sweep over models x prompt versions x options
+
+Classifies the hand annotated reviews once per combination of model, prompt
+version and ollama options and writes one comparison table with the quality
+(`MultiLabelEvaluator` against the annotations) and the throughput of every run.
+
+The reviews are loaded once and all runs share one response cache and, with
+`--hosts`, one `BackendPool`. `--parallel` runs are in flight at the same time;
+runs of the same model are scheduled back to back so that the hosts do not
+have to swap models between every request. Every run has a checkpoint in the
+sweep directory, so an interrupted sweep is continued with `--resume`.
+With `--abort-below` every run is evaluated while it is going and stopped as
+soon as its micro F1 is below the threshold after `--abort-after` reviews.
+
+Usage:
+    python sweep.py -m llama3.2 mistral -v 1 2 3 -n 200
+    python sweep.py --options '{"temperature": 0.3}' '{"temperature": 0}' --hosts http://gpu1:11434 http://gpu2:11434 --parallel 2
+"""
+
+import json
+import os
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import product
+from logging import INFO, basicConfig
+
+import pandas as pd
+from ollama import Options
+
+from backend_pool import BackendPool
+from checkpoint import JsonlCheckpoint
+from multilabel_classification_evaluator import (
+    IncrementalEvaluator,
+    MultiLabelEvaluator,
+)
+from ollama_topic_classification import (
+    JSON_PATH,
+    PROMPT_VERSIONS,
+    Model,
+    OllamaClassifier,
+    RunAborted,
+    annotated_reviews,
+    default_topics,
+    keep_alive_value,
+    load_prompts,
+    run_fingerprint,
+)
+from response_cache import DEFAULT_CACHE_PATH, ResponseCache
+
+# rows of the `MultiLabelEvaluator` table that go into the comparison
+QUALITY_ROWS = [
+    "Micro F1",
+    "Macro F1",
+    "Jaccard Score",
+    "Hamming Loss",
+    "Overall Accuracy",
+]
+
+
+def run_name(model: Model, version: int, options_index: int) -> str:
+    return f"{str(model)}-v{version}-o{options_index}".replace(":", "_")
+
+
+def run_one(
+    model: Model,
+    version: int,
+    options_index: int,
+    options: dict,
+    ids: list[int],
+    reviews: list[str],
+    args,
+    cache: ResponseCache | None,
+    pool: BackendPool | None,
+) -> dict:
+    """Classifies the reviews with one configuration and evaluates the results
+
+    Returns:
+        row of the comparison table
+    """
+    name = run_name(model, version, options_index)
+    sys_prompt, prompt_template = load_prompts(version)
+    o = OllamaClassifier(
+        model,
+        sys_prompt,
+        prompt_template,
+        reviews,
+        ids,
+        default_topics(),
+        client=pool,
+        options=Options(**options),
+        concurrency=args.concurrency,
+        timeout=args.timeout,
+        retries=args.retries,
+        cache=cache,
+        keep_alive=args.keep_alive,
+        log_every=0,
+    )
+    if pool is not None:
+        o.preload()
+    # options and review selection in the name, --resume never mixes answers of other settings
+    fingerprint = run_fingerprint(args, options=options, number=args.number)
+    checkpoint_file = os.path.join(args.out, f"{name}-{fingerprint}.checkpoint.jsonl")
+    evaluator = None
+    if args.abort_below is not None:
+        evaluator = IncrementalEvaluator.from_annotations(JSON_PATH)
+    with JsonlCheckpoint(checkpoint_file, resume=args.resume) as checkpoint:
+        data = o.get_all_topic_eval(
+            checkpoint=checkpoint,
+            evaluator=evaluator,
+            abort_below=args.abort_below,
+            abort_after=args.abort_after,
+        )
+
+    results_file = os.path.join(args.out, f"{name}.json")
+    with open(results_file, "w") as f:
+        json.dump(data, f)
+    usage = o.metrics.write(
+        results_file.removesuffix(".json") + ".metrics.json",
+        model=str(model),
+        prompt_version=version,
+        options=options,
+    )
+    # with -n only the first n annotated reviews were classified
+    quality = MultiLabelEvaluator(
+        JSON_PATH, results_file, only_predicted=True
+    ).evaluate()
+
+    row = {
+        "model": str(model),
+        "prompt version": version,
+        "options": json.dumps(options),
+    }
+    row.update({metric: quality.loc[metric, "precision"] for metric in QUALITY_ROWS})
+    row.update(
+        {
+            "reviews": len(data),
+            "failed": len(o.failed_ids),
+            "reviews/sec": usage["reviews/sec"],
+            "latency p50": usage["latency p50"],
+            "eval tokens/review": usage["eval tokens/review"],
+            "results": results_file,
+        }
+    )
+    return row
+
+
+def main():
+    ap = ArgumentParser()
+    ap.add_argument(
+        "-m",
+        "--models",
+        type=Model,
+        nargs="+",
+        default=list(Model),
+        help="[default] all models",
+    )
+    ap.add_argument(
+        "-v",
+        "--prompt-versions",
+        type=int,
+        nargs="+",
+        default=list(PROMPT_VERSIONS),
+        choices=list(PROMPT_VERSIONS),
+    )
+    ap.add_argument(
+        "--options",
+        type=json.loads,
+        nargs="+",
+        default=[{"temperature": 0.3}],
+        help="ollama options of the runs as JSON objects",
+    )
+    ap.add_argument("-n", "--number", type=int, default=-1, help="reviews per run")
+    ap.add_argument(
+        "-p", "--parallel", type=int, default=1, help="runs in flight at once"
+    )
+    ap.add_argument(
+        "-j", "--concurrency", type=int, default=1, help="requests in flight per run"
+    )
+    ap.add_argument("-t", "--timeout", type=float, default=None)
+    ap.add_argument("-r", "--retries", type=int, default=2)
+    ap.add_argument("--hosts", type=str, nargs="+", default=None)
+    ap.add_argument(
+        "--routing", choices=["least_loaded", "round_robin"], default="least_loaded"
+    )
+    ap.add_argument(
+        "--keep-alive",
+        type=keep_alive_value,
+        default="30m",
+        help="how long ollama keeps the model loaded (e.g. 30m, -1 = forever)",
+    )
+    ap.add_argument("--cache", type=str, default=DEFAULT_CACHE_PATH)
+    ap.add_argument("--no-cache", action="store_true", default=False)
+    ap.add_argument("-o", "--out", type=str, default="./results/sweep")
+    ap.add_argument("--resume", action="store_true", default=False)
+    ap.add_argument(
+        "--abort-below",
+        type=float,
+        default=None,
+        help="stop runs below this live micro F1",
+    )
+    ap.add_argument("--abort-after", type=int, default=200)
+    args = ap.parse_args()
+
+    basicConfig(level=INFO, filename="./ollama_log.txt", filemode="w")
+    os.makedirs(args.out, exist_ok=True)
+    ids, reviews = annotated_reviews(args.number)
+    cache = None if args.no_cache else ResponseCache(args.cache)
+    pool = None
+    if args.hosts:
+        pool = BackendPool(args.hosts, routing=args.routing, timeout=args.timeout)
+        print(f"hosts: {pool.health_check()}")
+        pool.start_health_checks()
+
+    # same model back to back => fewer model swaps on the hosts
+    grid = sorted(
+        product(args.models, args.prompt_versions, enumerate(args.options)),
+        key=lambda run: (str(run[0]), run[1], run[2][0]),
+    )
+    print(f"{len(grid)} runs over {len(reviews)} reviews")
+
+    rows = []
+    with ThreadPoolExecutor(max_workers=args.parallel) as executor:
+        futures = {
+            executor.submit(
+                run_one, model, version, i, options, ids, reviews, args, cache, pool
+            ): run_name(model, version, i)
+            for model, version, (i, options) in grid
+        }
+        for future in as_completed(futures):
+            try:
+                rows.append(future.result())
+                print(f"finished {futures[future]}")
+            except RunAborted as e:
+                print(f"aborted {futures[future]}: {e}")
+            except Exception as e:
+                print(f"run {futures[future]} failed: {e!r}")
+
+    if pool is not None:
+        pool.close()
+    if cache is not None:
+        cache.close()
+    if not rows:
+        return
+
+    table = pd.DataFrame(rows).sort_values("Micro F1", ascending=False)
+    table_file = os.path.join(args.out, "comparison.csv")
+    table.to_csv(table_file, index=False)
+    print(table.drop(columns=["results"]).round(3).to_string(index=False))
+    print(f"comparison table in {table_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""ejection and failover of the BackendPool against fake ollama servers"""
+
+from backend_pool import BackendPool
+from fake_ollama_server import DEFAULT_ANSWER, FakeOllamaServer
+
+MESSAGES = [{"role": "user", "content": "review"}]
+
+
+def test_failing_host_is_ejected_and_requests_fail_over():
+    with FakeOllamaServer() as good, FakeOllamaServer(fail_every=1) as bad:
+        pool = BackendPool([good.host, bad.host], max_failures=2, eject_seconds=60)
+        answers = [
+            pool.chat(model="llama3.2", messages=MESSAGES).message.content
+            for _ in range(8)
+        ]
+        stats = pool.stats()
+    assert answers == [DEFAULT_ANSWER] * 8
+    assert bad.requests == 2
+    assert good.requests == 8
+    assert stats[bad.host]["ejected"]
+    assert not stats[good.host]["ejected"]
+
+
+def test_health_check_keeps_host_with_failing_chat_ejected():
+    with FakeOllamaServer() as good, FakeOllamaServer(fail_every=1) as bad:
+        pool = BackendPool([good.host, bad.host], max_failures=1, eject_seconds=60)
+        for _ in range(2):
+            pool.chat(model="llama3.2", messages=MESSAGES)
+        # the host lists its models but its chat requests still fail
+        assert pool.health_check() == {good.host: True, bad.host: True}
+        assert pool.stats()[bad.host]["ejected"]
+
+
+def test_health_check_reinstates_unreachable_host():
+    down = FakeOllamaServer().start()
+    port = down._server.server_address[1]
+    host = down.host
+    down.stop()
+    with FakeOllamaServer() as good:
+        pool = BackendPool([good.host, host], timeout=2, eject_seconds=60)
+        assert pool.health_check() == {good.host: True, host: False}
+        assert pool.stats()[host]["ejected"]
+        with FakeOllamaServer(port=port):
+            assert pool.health_check()[host]
+            assert not pool.stats()[host]["ejected"]
@@ -0,0 +1,20 @@
+"""resuming JSONL checkpoints with broken lines"""
+
+from checkpoint import JsonlCheckpoint
+
+
+def test_resume_skips_broken_lines_and_drops_cut_off_last_line(tmp_path):
+    path = tmp_path / "checkpoint.jsonl"
+    path.write_text(
+        '{"review_id": 1, "topics": ["price"], "answer": "a"}\n'
+        '{"review_id": 2, "top\n'
+        '{"review_id": 3, "topics": [], "answer": "b"}\n'
+        '{"review_id": 4, "topics": ["st',
+        encoding="utf-8",
+    )
+    with JsonlCheckpoint(str(path), resume=True) as checkpoint:
+        assert checkpoint.done_ids == {1, 3}
+        checkpoint.append(5, ["story"], "c")
+
+    with JsonlCheckpoint(str(path), resume=True) as checkpoint:
+        assert checkpoint.results() == {1: ["price"], 3: [], 5: ["story"]}
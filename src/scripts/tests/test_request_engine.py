@@ -0,0 +1,110 @@
+"""request engine and OllamaClassifier against the fake ollama server"""
+
+import threading
+import time
+
+import pytest
+from ollama import Client
+
+from fake_ollama_server import FakeOllamaServer
+from ollama_topic_classification import Model, OllamaClassifier, Topic
+from request_engine import bounded_map, call_with_retries
+
+TOPICS = ["price", "story", "sound"]
+
+
+def tracked():
+    """Function sleeping a varying time per item and the maximum of its parallel calls"""
+    state = {"in flight": 0, "max": 0}
+    lock = threading.Lock()
+
+    def fn(item: int) -> int:
+        with lock:
+            state["in flight"] += 1
+            state["max"] = max(state["max"], state["in flight"])
+        time.sleep(0.02 if item % 3 == 0 else 0.001)
+        with lock:
+            state["in flight"] -= 1
+        return item * 2
+
+    return fn, state
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_bounded_map_stays_within_bound(concurrency):
+    fn, state = tracked()
+    results = list(bounded_map(fn, range(30), concurrency=concurrency))
+    assert sorted(results) == [i * 2 for i in range(30)]
+    assert state["max"] <= concurrency
+
+
+def test_bounded_map_propagates_errors():
+    def fn(item: int) -> int:
+        if item == 5:
+            raise ValueError("boom")
+        return item
+
+    with pytest.raises(ValueError, match="boom"):
+        list(bounded_map(fn, range(10), concurrency=4))
+
+
+def test_call_with_retries_gives_up_after_retries():
+    calls = []
+
+    def fn():
+        calls.append(1)
+        raise ConnectionError("down")
+
+    with pytest.raises(ConnectionError):
+        call_with_retries(fn, retries=2, backoff=0)
+    assert len(calls) == 3
+
+
+def topic_of_review(messages: list[dict]) -> str:
+    """Answers the topic named in the review, slowly for some reviews to shuffle the order"""
+    review = messages[-1]["content"]
+    number = int(review.split()[-1])
+    time.sleep(0.03 if number % 4 == 0 else 0.0)
+    return f'predicted_topics: ["{TOPICS[number % len(TOPICS)]}"]'
+
+
+def make_classifier(server: FakeOllamaServer, n: int, **kwargs) -> OllamaClassifier:
+    ids = list(range(100, 100 + n))
+    reviews = [f"review number {i}" for i in range(n)]
+    return OllamaClassifier(
+        Model.LLAMA3B,
+        "system prompt",
+        "$Review$",
+        reviews,
+        ids,
+        [Topic(t) for t in TOPICS],
+        client=Client(host=server.host, timeout=5),
+        **kwargs,
+    )
+
+
+def test_classifier_results_in_input_order():
+    with FakeOllamaServer(topic_of_review) as server:
+        o = make_classifier(server, 24, concurrency=4)
+        results = o.get_all_topic_eval()
+    assert list(results) == list(range(100, 124))
+    assert all(results[100 + i] == [TOPICS[i % len(TOPICS)]] for i in range(24))
+    assert server.max_in_flight <= 4
+    assert o.failed_ids == []
+
+
+def test_failed_requests_do_not_abort_the_run():
+    with FakeOllamaServer(topic_of_review, fail_every=3) as server:
+        o = make_classifier(server, 12, concurrency=3, retries=0)
+        results = o.get_all_topic_eval()
+    assert len(o.failed_ids) == 4
+    assert set(results).isdisjoint(o.failed_ids)
+    assert set(results) | set(o.failed_ids) == set(range(100, 112))
+
+
+def test_failed_request_answers_request_error():
+    with FakeOllamaServer(fail_every=1) as server:
+        o = make_classifier(server, 1, retries=1)
+        assert o.get_topic("review number 1") == "RequestError"
+    # the first attempt and one retry
+    assert server.requests == 2
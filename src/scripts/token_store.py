@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""pre-tokenized, memory mapped token store
+
+The reviews are encoded once with the SentencePiece tokenizer into one flat
+token array (`tokens.bin`) plus an offsets index (`offsets.npy`), review `i`
+being `tokens[offsets[i]:offsets[i + 1]]`. Both files are memory mapped, so
+fetching a review is a slice of the mapped file instead of a tokenizer call.
+
+A store lives in `<cache_dir>/<fingerprint>/` where the fingerprint is a hash
+of the tokenizer model and the review texts, so changing the tokenizer or the
+source data automatically leads to a rebuild. Every split or subset gets its
+own store, `open_or_build` keeps the `max_stores` most recently used ones.
+
+Usage (one-time preprocessing of the whole corpus):
+    python token_store.py -c ../../data/reviews_100k_cleaned_new.csv.bz2
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from collections.abc import Iterable, Sequence
+
+import numpy as np
+import sentencepiece as spm
+
+from corpus import iter_corpus_batches
+
+DEFAULT_CACHE_DIR = "../../data/token_cache"
+ENCODE_CHUNK_SIZE = 10_000
+# stores kept in a cache dir by `open_or_build`, e.g. train/val/test of a few runs
+MAX_STORES = 8
+
+
+def tokenizer_fingerprint(tokenizer: spm.SentencePieceProcessor) -> str:
+    """Hash of the serialized tokenizer model"""
+    return hashlib.blake2b(
+        tokenizer.serialized_model_proto(), digest_size=16
+    ).hexdigest()
+
+
+def texts_fingerprint(texts: Iterable[str]) -> str:
+    """Hash of the texts including their order"""
+    h = hashlib.blake2b(digest_size=16)
+    for text in texts:
+        h.update(str(text).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class TokenStore:
+    """Memory mapped store of tokenized reviews
+
+    Args:
+        directory: directory of a store written by `TokenStore.build`
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.offsets: np.ndarray = np.load(
+            os.path.join(directory, "offsets.npy"), mmap_mode="r"
+        )
+        n_tokens = int(self.offsets[-1])
+        if n_tokens > 0:
+            self.tokens: np.ndarray = np.memmap(
+                os.path.join(directory, "tokens.bin"),
+                dtype=self.meta["dtype"],
+                mode="r",
+                shape=(n_tokens,),
+            )
+        else:
+            # np.memmap can not map empty files
+            self.tokens = np.empty(0, dtype=self.meta["dtype"])
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        """Returns the tokens of review `idx` as a (read only) view on the mapped file"""
+        return self.tokens[self.offsets[idx] : self.offsets[idx + 1]]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    @staticmethod
+    def fingerprint(tokenizer: spm.SentencePieceProcessor, texts: Sequence[str]) -> str:
+        return (
+            f"{tokenizer_fingerprint(tokenizer)[:16]}-{texts_fingerprint(texts)[:16]}"
+        )
+
+    @classmethod
+    def build(
+        cls,
+        directory: str,
+        texts: Iterable[str],
+        tokenizer: spm.SentencePieceProcessor,
+        fingerprint: str = "",
+    ) -> "TokenStore":
+        """Tokenizes all texts and writes a new store to `directory`
+
+        The store is written to a temporary directory first and moved into place
+        afterwards, so an interrupted build never leaves a half written store.
+        """
+        dtype = np.uint16 if tokenizer.get_piece_size() <= 2**16 else np.int32
+        parent = os.path.dirname(os.path.abspath(directory))
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+        try:
+            offsets = [0]
+            with open(os.path.join(tmp, "tokens.bin"), "wb") as f:
+                chunk: list[str] = []
+                for text in texts:
+                    chunk.append(str(text))
+                    if len(chunk) == ENCODE_CHUNK_SIZE:
+                        cls._write_chunk(f, chunk, tokenizer, dtype, offsets)
+                        chunk = []
+                if chunk:
+                    cls._write_chunk(f, chunk, tokenizer, dtype, offsets)
+            np.save(
+                os.path.join(tmp, "offsets.npy"), np.asarray(offsets, dtype=np.int64)
+            )
+            with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "dtype": np.dtype(dtype).name,
+                        "n_reviews": len(offsets) - 1,
+                        "n_tokens": offsets[-1],
+                        "fingerprint": fingerprint,
+                        "tokenizer": tokenizer_fingerprint(tokenizer),
+                    },
+                    f,
+                )
+            if os.path.exists(directory):
+                shutil.rmtree(directory)
+            os.replace(tmp, directory)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        return cls(directory)
+
+    @staticmethod
+    def _write_chunk(f, chunk, tokenizer, dtype, offsets: list[int]) -> None:
+        encoded = tokenizer.encode(chunk, out_type=int)
+        for tokens in encoded:
+            offsets.append(offsets[-1] + len(tokens))
+        if encoded:
+            np.concatenate([np.asarray(t, dtype=dtype) for t in encoded]).tofile(f)
+
+    @classmethod
+    def open_or_build(
+        cls,
+        texts: Sequence[str],
+        tokenizer: spm.SentencePieceProcessor,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+        max_stores: int = MAX_STORES,
+    ) -> "TokenStore":
+        """Opens the store for these texts and tokenizer, building it if needed
+
+        When a new store is built, the stores of other tokenizer models in
+        `cache_dir` are removed as stale and of the others only the
+        `max_stores` most recently opened ones are kept.
+        """
+        fingerprint = cls.fingerprint(tokenizer, texts)
+        directory = os.path.join(cache_dir, fingerprint)
+        meta = os.path.join(directory, "meta.json")
+        if os.path.exists(meta):
+            # the modification time of meta.json marks the last use
+            os.utime(meta)
+            return cls(directory)
+
+        print(f"tokenizing {len(texts):,} reviews into '{directory}' ..")
+        store = cls.build(directory, texts, tokenizer, fingerprint)
+        evict_stores(cache_dir, fingerprint.split("-")[0], max_stores)
+        return store
+
+
+def evict_stores(cache_dir: str, tokenizer_prefix: str, max_stores: int) -> list[str]:
+    """Removes the stores of other tokenizers and all but the `max_stores` most recently used
+
+    Returns:
+        the removed store directories
+    """
+    stores = []
+    removed = []
+    for entry in os.listdir(cache_dir):
+        directory = os.path.join(cache_dir, entry)
+        if entry.startswith("."):
+            continue
+        if not entry.startswith(tokenizer_prefix):
+            removed.append(directory)
+            continue
+        meta = os.path.join(directory, "meta.json")
+        stores.append(
+            (os.path.getmtime(meta) if os.path.exists(meta) else 0.0, directory)
+        )
+    stores.sort(reverse=True)
+    removed += [directory for _, directory in stores[max(max_stores, 1) :]]
+    for directory in removed:
+        shutil.rmtree(directory, ignore_errors=True)
+    return removed
+
+
+def corpus_fingerprint(path: str) -> str:
+    """Hash of the location, size and modification time of a corpus file"""
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def store_from_corpus(
+    path: str,
+    tokenizer: spm.SentencePieceProcessor,
+    cache_dir: str = DEFAULT_CACHE_DIR,
+    batch_size: int = ENCODE_CHUNK_SIZE,
+) -> TokenStore:
+    """Opens or builds the store of a whole corpus file, streaming it in batches
+
+    Unlike `TokenStore.open_or_build` the texts are never all in memory and the
+    fingerprint is taken from the corpus file, so the store is rebuilt when the
+    file changes.
+    """
+    fingerprint = (
+        f"{tokenizer_fingerprint(tokenizer)[:16]}-{corpus_fingerprint(path)[:16]}"
+    )
+    directory = os.path.join(cache_dir, fingerprint)
+    if os.path.exists(os.path.join(directory, "meta.json")):
+        return TokenStore(directory)
+
+    print(f"tokenizing '{path}' into '{directory}' ..")
+    texts = (
+        review
+        for batch in iter_corpus_batches(path, batch_size, columns=["review"])
+        for review in batch["review"]
+    )
+    return TokenStore.build(directory, texts, tokenizer, fingerprint)
+
+
+def main():
+    ap = ArgumentParser()
+    ap.add_argument(
+        "-c",
+        "--csv",
+        type=str,
+        default="../../data/reviews_100k_cleaned_new.csv.bz2",
+        help="review corpus to tokenize",
+    )
+    ap.add_argument(
+        "-m",
+        "--model",
+        type=str,
+        default="../../data/reviews_unigram.model",
+        help="SentencePiece model",
+    )
+    ap.add_argument("-o", "--out", type=str, default=DEFAULT_CACHE_DIR)
+    args = ap.parse_args()
+
+    tokenizer = spm.SentencePieceProcessor(model_file=args.model)
+    store = store_from_corpus(args.csv, tokenizer, args.out)
+    print(
+        f"{len(store):,} reviews, {len(store.tokens):,} tokens in '{store.directory}'"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""single pass matching of topic aliases in model answers
+
+All aliases of all topics are compiled into one regular expression whose
+alternatives are merged along a prefix trie. At every position of the answer the
+regex engine follows one path through the trie instead of trying every alias,
+so the matching cost hardly depends on the number of topics and aliases.
+
+Unlike the substring check it replaced, aliases only match as whole words (plus
+an optional plural "s"/"es"), so "price" matches "prices" but not "priceless"
+and "story" no longer matches "storyline"; such forms have to be synonyms.
+"""
+
+import re
+from collections.abc import Hashable, Iterable, Mapping
+from typing import Generic, TypeVar
+
+T = TypeVar("T", bound=Hashable)
+
+# characters that must not surround an alias for it to count as a match
+_WORD = "a-z0-9"
+# plural endings an alias may have when matching whole words
+_PLURAL = "(?:e?s)?"
+
+
+def _trie_pattern(words: Iterable[str]) -> str:
+    """Builds a regex pattern matching exactly the given words, merged by prefix"""
+    trie: dict = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def pattern(node: dict) -> str:
+        branches = [
+            re.escape(char) + pattern(child)
+            for char, child in sorted(node.items())
+            if char
+        ]
+        if not branches:
+            return ""
+        optional = "" in node
+        if len(branches) == 1 and not optional:
+            return branches[0]
+        group = f"(?:{'|'.join(branches)})"
+        return f"{group}?" if optional else group
+
+    return pattern(trie)
+
+
+class TopicMatcher(Generic[T]):
+    """Finds topics in a text by their (lowercase) aliases in a single pass
+
+    Args:
+        aliases: mapping of alias to the topic it stands for
+        word_boundaries: aliases only match as whole words, optionally in the
+            plural (e.g. "story" does not match inside "history", "price"
+            matches "prices")
+    """
+
+    def __init__(self, aliases: Mapping[str, T], word_boundaries: bool = True) -> None:
+        self.aliases = {
+            alias.lower(): topic for alias, topic in aliases.items() if alias
+        }
+        body = _trie_pattern(self.aliases.keys())
+        if word_boundaries:
+            body = f"(?<![{_WORD}])({body}){_PLURAL}(?![{_WORD}])"
+        else:
+            body = f"({body})"
+        self._regex = re.compile(body) if self.aliases else None
+
+    def match(self, text: str) -> list[T]:
+        """Returns the topics found in the (lowercased) text in order of appearance"""
+        if self._regex is None:
+            return []
+        found: dict[T, None] = {}
+        for m in self._regex.finditer(text.lower()):
+            found.setdefault(self.aliases[m.group(1)], None)
+        return list(found)
+
+
+def load_synonyms(path: str) -> dict[str, list[str]]:
+    """Reads a synonym list in the format of `docs/topics.txt`
+
+    Every line of the form `- topic (synonym, other synonym, ...)` adds the
+    synonyms of `topic`, all other lines are ignored.
+
+    Returns:
+        mapping of topic to its synonyms
+    """
+    line_format = re.compile(r"^\s*-\s*([\w ]+?)\s*\((.*)\)\s*$")
+    synonyms: dict[str, list[str]] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            m = line_format.match(line)
+            if m is None:
+                continue
+            words = [w.strip().lower() for w in m.group(2).split(",") if w.strip()]
+            synonyms.setdefault(m.group(1).strip().lower(), []).extend(words)
+    return synonyms